@@ -0,0 +1,564 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Benchmark parsing, emitting, filtering and proxying of Minecraft traffic.
+
+Traffic comes from DVR captures (CAPFILE.dvr, or CAPFILE.cli and CAPFILE.srv
+from older versions, as written by mc3p.plugin.dvr), or is generated for
+each protocol version in messages.protocol. For each source, the benchmarks
+are:
+
+    parse     parse_packet() over each side's stream, decoding every
+              packet ('decode') or skipping all of them ('skip').
+    emit      Parsem.emit() of every decoded message.
+    patch     emit_packet() of every decoded message with an x coordinate,
+              after changing it, against a full Parsem.emit().
+    filter    PluginManager.filter() of every message, through N instances
+              of a plugin that inspects all messages.
+    loopback  A client and server connected through a MinecraftProxy
+              session over loopback sockets, with N plugin instances.
+
+Each benchmark is run several times, and the fastest run is kept. Results
+are printed as a table, and can be saved as JSON with -o, for comparison
+with a later run with --compare.
+
+Usage:
+    python -m mc3p.benchmark [-c CAPFILE] [-v VERSION] [-o FILE] [--compare FILE]
+"""
+
+import sys, os, os.path, struct, zlib, random, json, logging, optparse
+import asyncore, socket, subprocess, platform
+from timeit import default_timer as clock
+
+if __name__ == "__main__":
+    mc3p_dir = os.path.dirname(os.path.abspath(os.path.join(__file__,'..')))
+    sys.path.insert(0, mc3p_dir)
+
+from mc3p import messages, eventloop, capture
+from mc3p.util import Stream, PartialPacketException
+from mc3p.plugins import PluginConfig, PluginManager
+from mc3p.eventloop import BufferedDispatcher
+from mc3p.proxy import MinecraftListener, parse_packet, emit_packet
+
+logger = logging.getLogger('mc3p.benchmark')
+
+RECV_SIZE = 64 * 1024
+
+### Traffic sources ###
+
+def load_capture(capfile):
+    """Return {'client': [packet,...], 'server': [packet,...]} from a DVR capture."""
+    packets = {'client': [], 'server': []}
+    for (t, source, msgtype, data) in capture.read_capture(capfile):
+        packets[source].append(data)
+    return packets
+
+def capture_version(packets):
+    """Return the protocol version requested by the client's login packet."""
+    for p in packets['client']:
+        if p[0] == '\x01':
+            return struct.unpack_from('>i', p, 1)[0]
+    raise ValueError("Capture does not contain a client login packet")
+
+def _chunk_data():
+    """Return a zlib-compressed 16x128x16 chunk of flat terrain."""
+    column = '\x07' + '\x01' * 59 + '\x03' * 3 + '\x02' + '\x00' * 64
+    blocks = column * 256
+    metadata = '\x00' * 16384
+    blocklight = '\x00' * 16384
+    skylight = ('\x00' * 32 + '\xff' * 32) * 256
+    return zlib.compress(blocks + metadata + blocklight + skylight)
+
+CHUNK_DATA = _chunk_data()
+
+def _login(version):
+    return [{'msgtype': 0x02, 'username': u'bench'},
+            {'msgtype': 0x01, 'proto_version': version, 'username': u'bench',
+             'nu1': 0, 'nu7': u'', 'nu2': 0, 'nu3': 0, 'nu4': 0, 'nu5': 0, 'nu6': 0}]
+
+def _srv_login(version):
+    return [{'msgtype': 0x02, 'hash': u'-'},
+            {'msgtype': 0x01, 'eid': 1, 'reserved': u'', 'map_seed': 42,
+             'level_type': u'default', 'server_mode': 0, 'dimension': 0,
+             'difficulty': 1, 'world_height': 128, 'max_players': 8}]
+
+def _eid(r): return r.randint(100, 400)
+def _d(r): return r.randint(-4, 4)
+def _angle(r): return r.randint(-128, 127)
+
+# Roughly the mix of messages sent by a client that walks around,
+# and by a busy server: mostly entity movement, and the odd chunk.
+CLIENT_MIX = [
+    (30, lambda r: {'msgtype': 0x0b, 'x': r.uniform(-500, 500), 'y': 65.0,
+                    'stance': 66.62, 'z': r.uniform(-500, 500), 'on_ground': True}),
+    (10, lambda r: {'msgtype': 0x0c, 'yaw': r.uniform(0, 360), 'pitch': r.uniform(-90, 90),
+                    'on_ground': True}),
+    (20, lambda r: {'msgtype': 0x0d, 'x': r.uniform(-500, 500), 'y': 65.0, 'stance': 66.62,
+                    'z': r.uniform(-500, 500), 'yaw': r.uniform(0, 360),
+                    'pitch': r.uniform(-90, 90), 'on_ground': True}),
+    (10, lambda r: {'msgtype': 0x0a, 'on_ground': True}),
+    (3,  lambda r: {'msgtype': 0x12, 'eid': 1, 'animation': 1}),
+    (2,  lambda r: {'msgtype': 0x0e, 'status': 0, 'x': r.randint(-500, 500), 'y': 64,
+                    'z': r.randint(-500, 500), 'face': 1}),
+    (1,  lambda r: {'msgtype': 0x03, 'chat_msg': u'hello from the benchmark'}),
+    (1,  lambda r: {'msgtype': 0x00, 'id': r.randint(0, 1 << 30)}),
+]
+
+SERVER_MIX = [
+    (20, lambda r: {'msgtype': 0x1f, 'eid': _eid(r), 'dx': _d(r), 'dy': _d(r), 'dz': _d(r)}),
+    (20, lambda r: {'msgtype': 0x21, 'eid': _eid(r), 'dx': _d(r), 'dy': _d(r), 'dz': _d(r),
+                    'yaw': _angle(r), 'pitch': _angle(r)}),
+    (8,  lambda r: {'msgtype': 0x20, 'eid': _eid(r), 'yaw': _angle(r), 'pitch': _angle(r)}),
+    (6,  lambda r: {'msgtype': 0x22, 'eid': _eid(r), 'x': r.randint(-16000, 16000), 'y': 2080,
+                    'z': r.randint(-16000, 16000), 'yaw': _angle(r), 'pitch': _angle(r)}),
+    (10, lambda r: {'msgtype': 0x1c, 'eid': _eid(r), 'vel_x': r.randint(-800, 800),
+                    'vel_y': r.randint(-800, 800), 'vel_z': r.randint(-800, 800)}),
+    (4,  lambda r: {'msgtype': 0x35, 'x': r.randint(-500, 500), 'y': r.randint(0, 127),
+                    'z': r.randint(-500, 500), 'block_type': r.randint(0, 90),
+                    'block_metadata': 0}),
+    (2,  lambda r: _multi_block_change(r)),
+    (2,  lambda r: {'msgtype': 0x12, 'eid': _eid(r), 'animation': 1}),
+    (2,  lambda r: {'msgtype': 0x04, 'time': r.randint(0, 24000)}),
+    (2,  lambda r: {'msgtype': 0x03, 'chat_msg': u'<player%d> hi there' % r.randint(0, 9)}),
+    (1,  lambda r: {'msgtype': 0x26, 'eid': _eid(r), 'status': 2}),
+    (1,  lambda r: {'msgtype': 0x1d, 'eid': _eid(r)}),
+    (1,  lambda r: {'msgtype': 0x00, 'id': r.randint(0, 1 << 30)}),
+    (1,  lambda r: {'msgtype': 0x32, 'x': r.randint(-30, 30), 'z': r.randint(-30, 30),
+                    'mode': True}),
+    (1,  lambda r: {'msgtype': 0x33, 'x': 16 * r.randint(-30, 30), 'y': 0,
+                    'z': 16 * r.randint(-30, 30), 'size_x': 15, 'size_y': 127, 'size_z': 15,
+                    'chunk': {'size': len(CHUNK_DATA), 'data': CHUNK_DATA}}),
+]
+
+def _multi_block_change(r):
+    n = r.randint(2, 20)
+    return {'msgtype': 0x34, 'chunk_x': r.randint(-30, 30), 'chunk_z': r.randint(-30, 30),
+            'changes': {'coord_array': [r.randint(0, 0x7fff) for i in xrange(n)],
+                        'type_array': [r.randint(0, 90) for i in xrange(n)],
+                        'metadata_array': [0] * n}}
+
+def _pick(r, mix, total):
+    x = r.uniform(0, total)
+    for (weight, make) in mix:
+        x -= weight
+        if x <= 0:
+            return make(r)
+    return mix[-1][1](r)
+
+def synthetic_session(version, count, seed=0):
+    """Return {'client': [packet,...], 'server': [packet,...]} for version.
+
+    Each side starts with its handshake and login packets, followed by
+    count packets drawn from CLIENT_MIX or SERVER_MIX.
+    """
+    r = random.Random(seed)
+    cli_spec, srv_spec = messages.protocol[version]
+    packets = {}
+    for (side, spec, login, mix) in (('client', cli_spec, _login, CLIENT_MIX),
+                                     ('server', srv_spec, _srv_login, SERVER_MIX)):
+        total = sum(weight for (weight, make) in mix)
+        msgs = login(version) + [_pick(r, mix, total) for i in xrange(count)]
+        packets[side] = [spec[msg['msgtype']].emit(msg) for msg in msgs]
+    return packets
+
+### Benchmarks ###
+
+def _result(benchmark, source, variant, packets, nbytes, seconds):
+    seconds = max(seconds, 1e-9)
+    return {'benchmark': benchmark, 'source': source, 'variant': variant,
+            'packets': packets, 'bytes': nbytes, 'seconds': seconds,
+            'packets_per_sec': packets / seconds, 'bytes_per_sec': nbytes / seconds}
+
+def _best_of(repeat, fn):
+    """Call fn() repeat times, and return the shortest time it took."""
+    best = None
+    for i in xrange(repeat):
+        t = clock()
+        fn()
+        t = clock() - t
+        if best is None or t < best:
+            best = t
+    return best
+
+def _parse_all(data, spec, side, inspected):
+    """Parse data fed in RECV_SIZE chunks, as MinecraftProxy would; return packets."""
+    stream = Stream()
+    packets = []
+    for i in xrange(0, len(data), RECV_SIZE):
+        stream.append(data[i:i+RECV_SIZE])
+        if not stream.ready():
+            continue
+        try:
+            while True:
+                packets.append(parse_packet(stream, spec, side, inspected))
+        except PartialPacketException:
+            pass
+    return packets
+
+def _specs(version):
+    cli_spec, srv_spec = messages.protocol[version]
+    return {'client': cli_spec, 'server': srv_spec}
+
+def bench_parse(source, packets, version, repeat):
+    results = []
+    specs = _specs(version)
+    for side in ('client', 'server'):
+        data = ''.join(packets[side])
+        for (mode, inspected) in (('decode', None), ('skip', frozenset())):
+            n = len(_parse_all(data, specs[side], side, inspected))
+            if n != len(packets[side]):
+                logger.error('%s: parsed %d of %d %s packets' % \
+                             (source, n, len(packets[side]), side))
+            t = _best_of(repeat, lambda: _parse_all(data, specs[side], side, inspected))
+            results.append(_result('parse', source, '%s/%s' % (side, mode), n, len(data), t))
+    return results
+
+def bench_emit(source, packets, version, repeat):
+    """Time emitting every decoded message that round-trips to its raw bytes."""
+    results = []
+    specs = _specs(version)
+    for side in ('client', 'server'):
+        spec = specs[side]
+        msgs = []
+        for msg in _parse_all(''.join(packets[side]), spec, side, None):
+            try:
+                if spec[msg['msgtype']].emit(msg) == msg['raw_bytes']:
+                    msgs.append(msg)
+                    continue
+                reason = 'differs from original'
+            except NotImplementedError:
+                reason = 'not implemented'
+            except Exception as e:
+                reason = str(e)
+            logger.debug('%s: not emitting %s msgtype 0x%02x: %s' % \
+                         (source, side, msg['msgtype'], reason))
+        pairs = [(spec[msg['msgtype']].emit, msg) for msg in msgs]
+        def emit_all():
+            for (emit, msg) in pairs:
+                emit(msg)
+        t = _best_of(repeat, emit_all)
+        nbytes = sum(len(msg['raw_bytes']) for msg in msgs)
+        results.append(_result('emit', source, side, len(msgs), nbytes, t))
+    return results
+
+def bench_patch(source, packets, version, repeat):
+    """Time re-encoding messages after changing their x coordinate.
+
+    Each message is re-encoded both by emit_packet(), which patches x into
+    its raw bytes, and by a full Parsem.emit().
+    """
+    results = []
+    specs = _specs(version)
+    for side in ('client', 'server'):
+        spec = specs[side]
+        msgs = []
+        for msg in _parse_all(''.join(packets[side]), spec, side, None):
+            x = msg.get('x')
+            if isinstance(x, (int, float)) and not isinstance(x, bool):
+                msg['x'] = x ^ 1 if isinstance(x, int) else x + 1.0
+                if emit_packet(msg, spec) == spec[msg['msgtype']].emit(msg):
+                    msgs.append(msg)
+        nbytes = sum(len(msg['raw_bytes']) for msg in msgs)
+        pairs = [(spec[msg['msgtype']].emit, msg) for msg in msgs]
+        def patch_all():
+            for msg in msgs:
+                emit_packet(msg, spec)
+        def emit_all():
+            for (emit, msg) in pairs:
+                emit(msg)
+        for (mode, fn) in (('patch', patch_all), ('emit', emit_all)):
+            t = _best_of(repeat, fn)
+            results.append(_result('patch', source, '%s/%s' % (side, mode),
+                                   len(msgs), nbytes, t))
+    return results
+
+
+class _MockProxy(object):
+    def send_injected_msgs(self):
+        pass
+
+def _plugin_config(plugin, n):
+    pcfg = PluginConfig()
+    for i in xrange(n):
+        pcfg.add(plugin, 'p%d' % i)
+    return pcfg
+
+def bench_filter(source, packets, version, repeat, plugin, counts):
+    """Time PluginManager.filter() of every message, after the handshake."""
+    results = []
+    specs = _specs(version)
+    msgs = []
+    for side in ('client', 'server'):
+        msgs.extend((msg, side) for msg in _parse_all(''.join(packets[side]), specs[side],
+                                                      side, None))
+    handshake = [m for m in msgs if m[0]['msgtype'] == 0x01]
+    msgs = [m for m in msgs if m[0]['msgtype'] not in (0x01, 0x02)]
+    nbytes = sum(len(msg['raw_bytes']) for (msg, side) in msgs)
+    for n in counts:
+        pmgr = PluginManager(_plugin_config(plugin, n), _MockProxy(), _MockProxy())
+        try:
+            for (msg, side) in sorted(handshake, key=lambda m: m[1]):
+                pmgr.filter(msg, side)
+            def filter_all():
+                for (msg, side) in msgs:
+                    pmgr.filter(msg, side)
+            t = _best_of(repeat, filter_all)
+        finally:
+            pmgr.destroy()
+        results.append(_result('filter', source, '%d plugins' % n, len(msgs), nbytes, t))
+    return results
+
+
+class Done(asyncore.ExitNow):
+    """Raised out of the event loop once a loopback run is over."""
+
+class _LoopbackEnd(BufferedDispatcher):
+    """One end of a loopback session, sending its packets and counting replies.
+
+    Only first is sent until bytes arrive from the other side. The client
+    sends its handshake first, and the server waits for it, so that the
+    proxy knows the protocol version before the rest is parsed.
+    """
+
+    def __init__(self, sock, first, rest, expected, run):
+        BufferedDispatcher.__init__(self, sock, high_water=sys.maxint)
+        self.rest = rest
+        self.expected = expected
+        self.received = 0
+        self.run = run
+        self.send(first)
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        n = len(self.recv(RECV_SIZE))
+        if n and self.received == 0:
+            self.send(self.rest)
+        self.received += n
+        if self.received >= self.expected:
+            self.run.finished()
+
+    def handle_close(self):
+        self.close()
+        self.run.finished()
+
+
+class _LoopbackServer(asyncore.dispatcher):
+    def __init__(self, packets, expected, run):
+        asyncore.dispatcher.__init__(self)
+        self.packets = packets
+        self.expected = expected
+        self.run = run
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.bind(('127.0.0.1', 0))
+        self.listen(1)
+        self.port = self.getsockname()[1]
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            self.run.ends.append(_LoopbackEnd(pair[0], '', ''.join(self.packets),
+                                              self.expected, self.run))
+            self.close()
+
+
+class _LoopbackRun(object):
+    def __init__(self, packets, pcfg):
+        self.ends = []
+        cli_bytes = sum(len(p) for p in packets['client'])
+        srv_bytes = sum(len(p) for p in packets['server'])
+        server = _LoopbackServer(packets['server'], cli_bytes, self)
+        self.listener = MinecraftListener(pcfg, 0, '127.0.0.1', server.port, max_buffer=None)
+        port = self.listener.getsockname()[1]
+        sock = socket.create_connection(('127.0.0.1', port))
+        self.ends.append(_LoopbackEnd(sock, ''.join(packets['client'][:2]),
+                                      ''.join(packets['client'][2:]), srv_bytes, self))
+
+    def finished(self):
+        if len(self.ends) == 2 and \
+           all(e.received >= e.expected or not e.connected for e in self.ends):
+            raise Done()
+
+    def complete(self):
+        return len(self.ends) == 2 and all(e.received >= e.expected for e in self.ends)
+
+
+def bench_loopback(source, packets, repeat, plugin, counts, loop=None, timeout=60.0):
+    """Time proxying both sides' packets through a session over loopback."""
+    results = []
+    nbytes = sum(len(p) for side in packets for p in packets[side])
+    npackets = sum(len(packets[side]) for side in packets)
+    for n in counts:
+        best = None
+        for i in xrange(repeat):
+            t = clock()
+            run = _LoopbackRun(packets, _plugin_config(plugin, n))
+            try:
+                while clock() - t < timeout:
+                    eventloop.loop(loop, 0.5, count=1000)
+            except Done:
+                pass
+            t = clock() - t
+            complete = run.complete()
+            asyncore.close_all()
+            if not complete:
+                logger.error('%s: loopback session with %d plugins did not complete' % \
+                             (source, n))
+                break
+            if best is None or t < best:
+                best = t
+        if best is not None:
+            results.append(_result('loopback', source, '%d plugins' % n,
+                                   npackets, nbytes, best))
+    return results
+
+def run_benchmarks(sources, opts):
+    """Run every selected benchmark on each (name, packets, version) source."""
+    results = []
+    for (source, packets, version) in sources:
+        logger.info('benchmarking %s (protocol version %d)' % (source, version))
+        if 'parse' in opts.benchmarks:
+            results += bench_parse(source, packets, version, opts.repeat)
+        if 'emit' in opts.benchmarks:
+            results += bench_emit(source, packets, version, opts.repeat)
+        if 'patch' in opts.benchmarks:
+            results += bench_patch(source, packets, version, opts.repeat)
+        if 'filter' in opts.benchmarks:
+            results += bench_filter(source, packets, version, opts.repeat,
+                                    opts.plugin, opts.plugin_counts)
+        if 'loopback' in opts.benchmarks:
+            results += bench_loopback(source, packets, opts.repeat, opts.plugin,
+                                      opts.plugin_counts, opts.event_loop)
+    return results
+
+### Reporting ###
+
+def _key(r):
+    return (r['benchmark'], r['source'], r['variant'])
+
+def environment():
+    """Describe the code and interpreter that produced the results."""
+    env = {'python': platform.python_version(),
+           'implementation': platform.python_implementation(),
+           'platform': platform.platform()}
+    try:
+        env['commit'] = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return env
+
+def format_results(results, baseline=None):
+    """Return results as a table, with the change from baseline results if given."""
+    base = dict((_key(r), r) for r in (baseline or []))
+    lines = ['%-10s %-18s %-16s %10s %14s %10s %8s' % \
+             ('benchmark', 'source', 'variant', 'packets', 'packets/s', 'MB/s',
+              'change' if baseline else '')]
+    for r in results:
+        change = ''
+        old = base.get(_key(r))
+        if old:
+            change = '%+.1f%%' % (100.0 * (r['packets_per_sec'] / old['packets_per_sec'] - 1))
+        lines.append('%-10s %-18s %-16s %10d %14.0f %10.2f %8s' % \
+                     (r['benchmark'], r['source'], r['variant'], r['packets'],
+                      r['packets_per_sec'], r['bytes_per_sec'] / 1e6, change))
+    return '\n'.join(lines)
+
+BENCHMARKS = ('parse', 'emit', 'patch', 'filter', 'loopback')
+
+def make_arg_parser():
+    parser = optparse.OptionParser(
+        usage="usage: %prog [options]",
+        description="Benchmark mc3p on synthetic traffic for each protocol " +
+                    "version, or on DVR captures given with -c.")
+    parser.add_option('-c', '--capture', dest='captures', metavar='CAPFILE',
+                      action='append', default=[],
+                      help='benchmark the DVR capture CAPFILE.dvr, or CAPFILE.cli and ' +
+                           'CAPFILE.srv from older versions (repeatable)')
+    parser.add_option('-v', '--version', dest='versions', metavar='VERSIONS', default='',
+                      help='comma-separated protocol versions for synthetic traffic ' +
+                           '(default: all, or none if -c is given)')
+    parser.add_option('-n', '--packets', dest='count', metavar='N', type='int', default=20000,
+                      help='synthetic packets per side (default %default)')
+    parser.add_option('-b', '--benchmarks', dest='benchmarks', metavar='NAMES',
+                      default=','.join(BENCHMARKS),
+                      help='comma-separated benchmarks to run (default %default)')
+    parser.add_option('-r', '--repeat', dest='repeat', metavar='N', type='int', default=3,
+                      help='keep the fastest of N runs (default %default)')
+    parser.add_option('--plugin', dest='plugin', metavar='PLUGIN', default='mc3p.plugin.stats',
+                      help='plugin to instantiate for filter and loopback (default %default)')
+    parser.add_option('--plugins', dest='plugin_counts', metavar='COUNTS', default='0,1,4,16',
+                      help='comma-separated numbers of plugin instances (default %default)')
+    parser.add_option('--event-loop', dest='event_loop', metavar='LOOP',
+                      choices=eventloop.LOOPS, default=eventloop.default_loop(),
+                      help='event loop for loopback (default %default)')
+    parser.add_option('-o', '--output', dest='output', metavar='FILE', default=None,
+                      help='save results to FILE as JSON')
+    parser.add_option('--compare', dest='baseline', metavar='FILE', default=None,
+                      help='show the change from results saved in FILE')
+    return parser
+
+def parse_args():
+    parser = make_arg_parser()
+    (opts, args) = parser.parse_args()
+    if args:
+        parser.error("Unexpected arguments %s" % repr(args))
+    opts.benchmarks = opts.benchmarks.split(',')
+    for name in opts.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark '%s'" % name)
+    try:
+        opts.plugin_counts = [int(n) for n in opts.plugin_counts.split(',')]
+        if opts.versions:
+            opts.versions = [int(v) for v in opts.versions.split(',')]
+        elif not opts.captures:
+            opts.versions = sorted(v for v in messages.protocol if v != 0)
+    except ValueError as e:
+        parser.error(str(e))
+    for v in opts.versions:
+        if v not in messages.protocol:
+            parser.error("Unknown protocol version %d" % v)
+    return opts
+
+def main():
+    opts = parse_args()
+    sources = []
+    for capfile in opts.captures:
+        packets = load_capture(capfile)
+        sources.append((os.path.basename(capfile), packets, capture_version(packets)))
+    for v in opts.versions:
+        sources.append(('synthetic-v%d' % v, synthetic_session(v, opts.count), v))
+
+    results = run_benchmarks(sources, opts)
+
+    baseline = None
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)['results']
+    print format_results(results, baseline)
+
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f,
+                      indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARN)
+    logger.setLevel(logging.INFO)
+    main()
@@ -0,0 +1,366 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Indexed capture files of Minecraft traffic, as recorded by the dvr plugin.
+
+A capture holds the messages of both sides of a session in one stream, in
+the order they were seen. Messages are grouped into blocks, each compressed
+on its own, and an index of the blocks at the end of the file lets readers
+skip to a point in time, or to the blocks containing some msgtypes, without
+decompressing the rest. All integers are little-endian.
+
+    <file>   := MAGIC <block>* <index>
+    <block>  := <codec:B> <stored size:I> <raw size:I> BYTE{stored size}
+    <raw>    := <record>*
+    <record> := <time:d> <flags:B> <msgtype:B> <size:I> BYTE{size}
+    <index>  := INDEX_MARK <entry>* <index offset:Q> <entries:I> INDEX_MAGIC
+    <entry>  := <block offset:Q> <stored size:I> <records:I>
+                <first time:d> <last time:d> <sources:B> <msgtypes:32s>
+
+Times are seconds since the start of the capture. Bit 0 of flags is set for
+messages from the server. In an index entry, sources has bit 0 set if the
+block holds client messages and bit 1 if it holds server messages, and
+msgtypes is a bitmap of the msgtypes it holds.
+
+A capture whose writer did not close it has no index; readers then find the
+blocks by scanning the file.
+
+Blocks are compressed with zlib, or with zstd if the zstandard package is
+installed and asked for. Older captures, in pairs of CAPFILE.cli and
+CAPFILE.srv files, can still be read with read_legacy().
+"""
+
+import os, struct, zlib, bisect, mmap, threading
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = 'MC3PCAP\x02'
+INDEX_MAGIC = 'MC3PIDX\x02'
+INDEX_MARK = 0xff
+
+# Extension of capture files, appended to the dvr plugin's CAPFILE.
+EXTENSION = '.dvr'
+
+CODEC_NONE, CODEC_ZLIB, CODEC_ZSTD = 0, 1, 2
+CODECS = {'none': CODEC_NONE, 'zlib': CODEC_ZLIB, 'zstd': CODEC_ZSTD}
+
+FROM_SERVER = 0x01
+SOURCES = {'client': 0x01, 'server': 0x02}
+
+BLOCK_HEADER = struct.Struct('<BII')
+RECORD_HEADER = struct.Struct('<dBBI')
+INDEX_ENTRY = struct.Struct('<QIIddB32s')
+INDEX_FOOTER = struct.Struct('<QI8s')
+
+
+class CaptureError(Exception):
+    def __init__(self, msg):
+        Exception.__init__(self)
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+
+def compress(codec, data):
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, 6)
+    elif codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+def decompress(codec, data, size):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    elif codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise CaptureError("Capture uses zstd, but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=size)
+    elif codec == CODEC_NONE:
+        return data
+    raise CaptureError("Unknown block codec %d" % codec)
+
+
+class BlockInfo(object):
+    """Index entry of one block of a capture."""
+
+    __slots__ = ('offset', 'size', 'count', 't_first', 't_last', 'sources', 'msgtypes')
+
+    def __init__(self, offset, size, count, t_first, t_last, sources, msgtypes):
+        self.offset = offset
+        self.size = size
+        self.count = count
+        self.t_first = t_first
+        self.t_last = t_last
+        self.sources = sources
+        self.msgtypes = msgtypes # 32-byte bitmap
+
+    def has_msgtype(self, msgtype):
+        return bool(ord(self.msgtypes[msgtype >> 3]) & (1 << (msgtype & 7)))
+
+    def pack(self):
+        return INDEX_ENTRY.pack(self.offset, self.size, self.count, self.t_first,
+                                self.t_last, self.sources, self.msgtypes)
+
+
+class CaptureWriter(object):
+    """Append messages to a new capture file.
+
+    Messages are buffered in memory, and written out as a compressed block
+    once block_size bytes are buffered. Unless flush_interval is None, a
+    background thread also writes out whatever is buffered every
+    flush_interval seconds, so that messages of a quiet session are not
+    left in memory. close() writes the index.
+    """
+
+    def __init__(self, path, codec='zlib', block_size=64*1024, flush_interval=1.0):
+        if codec not in CODECS:
+            raise CaptureError("Unknown codec '%s'" % codec)
+        if codec == 'zstd' and zstandard is None:
+            raise CaptureError("The zstd codec requires the zstandard package")
+        self.path = path
+        self.codec = CODECS[codec]
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.blocks = []
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+        self._reset()
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        self.flusher = None
+        if flush_interval:
+            self.flusher = threading.Thread(target=self._flush_periodically,
+                                            name='CaptureWriter flusher')
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    def _reset(self):
+        self.buf = []
+        self.buf_bytes = 0
+        self.t_first = self.t_last = 0.0
+        self.sources = 0
+        self.msgtypes = bytearray(32)
+
+    def write(self, t, source, data, msgtype=None):
+        """Add message data, seen at time t coming from source."""
+        if msgtype is None:
+            msgtype = ord(data[0])
+        flags = FROM_SERVER if source == 'server' else 0
+        with self.lock:
+            if not self.buf:
+                self.t_first = t
+            self.t_last = t
+            self.sources |= SOURCES[source]
+            self.msgtypes[msgtype >> 3] |= 1 << (msgtype & 7)
+            self.buf.append(RECORD_HEADER.pack(t, flags, msgtype, len(data)))
+            self.buf.append(data)
+            self.buf_bytes += RECORD_HEADER.size + len(data)
+            if self.buf_bytes >= self.block_size:
+                self._flush()
+
+    def flush(self):
+        """Write buffered messages out as a block."""
+        with self.lock:
+            self._flush()
+
+    def _flush_periodically(self):
+        while not self.closing.wait(self.flush_interval):
+            self.flush()
+
+    def _flush(self):
+        if not self.buf:
+            return
+        raw = ''.join(self.buf)
+        stored = compress(self.codec, raw)
+        self.file.write(BLOCK_HEADER.pack(self.codec, len(stored), len(raw)))
+        self.file.write(stored)
+        self.file.flush()
+        size = BLOCK_HEADER.size + len(stored)
+        self.blocks.append(BlockInfo(self.offset, size, len(self.buf) // 2,
+                                     self.t_first, self.t_last, self.sources,
+                                     str(self.msgtypes)))
+        self.offset += size
+        self._reset()
+
+    def close(self):
+        """Flush buffered messages, and write the index."""
+        if self.file is None:
+            return
+        self.closing.set()
+        if self.flusher:
+            self.flusher.join()
+        self._flush()
+        index_offset = self.offset
+        self.file.write(chr(INDEX_MARK))
+        for block in self.blocks:
+            self.file.write(block.pack())
+        self.file.write(INDEX_FOOTER.pack(index_offset, len(self.blocks), INDEX_MAGIC))
+        self.file.close()
+        self.file = None
+
+
+class CaptureReader(object):
+    """Read the messages of a capture file.
+
+    Messages are (time, source, msgtype, data) tuples, in capture order.
+    The file is memory-mapped, and only the blocks needed are decompressed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size < len(MAGIC) or \
+           self.file.read(len(MAGIC)) != MAGIC:
+            self.file.close()
+            raise CaptureError("%s is not an mc3p capture" % path)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.blocks = self._read_index() or self._scan_blocks()
+        self._t_last = [b.t_last for b in self.blocks]
+
+    def _read_index(self):
+        """Return the BlockInfo list from the file's index, or None if it has none."""
+        end = len(self.map)
+        if end < len(MAGIC) + 1 + INDEX_FOOTER.size:
+            return None
+        offset, n, magic = INDEX_FOOTER.unpack_from(self.map, end - INDEX_FOOTER.size)
+        if magic != INDEX_MAGIC or offset + 1 + n * INDEX_ENTRY.size + INDEX_FOOTER.size != end:
+            return None
+        return [BlockInfo(*INDEX_ENTRY.unpack_from(self.map, offset + 1 + i * INDEX_ENTRY.size))
+                for i in xrange(n)]
+
+    def _scan_blocks(self):
+        """Return the BlockInfo list of every complete block, by reading them all."""
+        blocks = []
+        offset = len(MAGIC)
+        while offset + BLOCK_HEADER.size <= len(self.map):
+            codec, stored, raw = BLOCK_HEADER.unpack_from(self.map, offset)
+            if codec == INDEX_MARK or offset + BLOCK_HEADER.size + stored > len(self.map):
+                break
+            block = BlockInfo(offset, BLOCK_HEADER.size + stored, 0, 0.0, 0.0, 0, '')
+            msgtypes = bytearray(32)
+            for (t, source, msgtype, _) in self._records(*self.read_block(block)):
+                if not block.count:
+                    block.t_first = t
+                block.t_last = t
+                block.count += 1
+                block.sources |= SOURCES[source]
+                msgtypes[msgtype >> 3] |= 1 << (msgtype & 7)
+            block.msgtypes = str(msgtypes)
+            blocks.append(block)
+            offset += block.size
+        return blocks
+
+    def __len__(self):
+        return sum(b.count for b in self.blocks)
+
+    @property
+    def duration(self):
+        return self.blocks[-1].t_last if self.blocks else 0.0
+
+    def read_block(self, block):
+        """Return (data, start, end), where data[start:end] are block's records.
+
+        Uncompressed blocks are read in place from the file's mapping.
+        """
+        codec, stored, raw = BLOCK_HEADER.unpack_from(self.map, block.offset)
+        start = block.offset + BLOCK_HEADER.size
+        if codec == CODEC_NONE:
+            return (self.map, start, start + stored)
+        data = decompress(codec, buffer(self.map, start, stored), raw)
+        return (data, 0, len(data))
+
+    def _records(self, data, i, end, views=False):
+        unpack, hdr_size = RECORD_HEADER.unpack_from, RECORD_HEADER.size
+        while i < end:
+            t, flags, msgtype, n = unpack(data, i)
+            i += hdr_size
+            yield (t, 'server' if flags & FROM_SERVER else 'client', msgtype,
+                   buffer(data, i, n) if views else data[i:i + n])
+            i += n
+
+    def messages(self, start=0.0, end=None, msgtypes=None, source=None, views=False):
+        """Yield the messages from time start up to end, optionally filtered.
+
+        Only blocks that may hold matching messages are decompressed:
+        blocks before start are found by bisecting the index, and blocks
+        without any of msgtypes, or without messages from source, are
+        skipped.
+
+        If views is True, message data are buffers into the decompressed
+        block, or into the file's mapping, rather than copies. They must
+        not be used once the reader is closed.
+        """
+        if msgtypes is not None:
+            msgtypes = frozenset(msgtypes)
+        first = bisect.bisect_left(self._t_last, start)
+        for block in self.blocks[first:]:
+            if end is not None and block.t_first > end:
+                break
+            if source is not None and not block.sources & SOURCES[source]:
+                continue
+            if msgtypes is not None and not any(block.has_msgtype(m) for m in msgtypes):
+                continue
+            for msg in self._records(*self.read_block(block), views=views):
+                t = msg[0]
+                if end is not None and t > end:
+                    return
+                if t < start or (source is not None and msg[1] != source) or \
+                   (msgtypes is not None and msg[2] not in msgtypes):
+                    continue
+                yield msg
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def read_legacy(capfile):
+    """Return the (time, source, msgtype, data) messages of a CAPFILE.cli/.srv pair.
+
+    Each side's file was written separately, so the two are merged by time.
+    """
+    msgs = []
+    for (source, ext) in (('client', '.cli'), ('server', '.srv')):
+        with open(capfile + ext, 'rb') as f:
+            while True:
+                hdr = f.read(8)
+                if len(hdr) < 8:
+                    break
+                n, t = struct.unpack("<If", hdr)
+                data = f.read(n)
+                msgs.append((t, source, ord(data[0]) if data else 0, data))
+    msgs.sort(key=lambda m: m[0])
+    return msgs
+
+def read_capture(capfile):
+    """Return every (time, source, msgtype, data) message of capture capfile.
+
+    capfile is the CAPFILE passed to the dvr plugin: CAPFILE.dvr is read if
+    it exists, and otherwise the older CAPFILE.cli and CAPFILE.srv.
+    """
+    if os.path.exists(capfile + EXTENSION):
+        reader = CaptureReader(capfile + EXTENSION)
+        try:
+            return list(reader.messages())
+        finally:
+            reader.close()
+    return read_legacy(capfile)
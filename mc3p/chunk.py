@@ -0,0 +1,164 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Block-level access to 0x33 Chunk messages, as NumPy arrays.
+
+The payload of a Chunk message is parsed as an opaque zlib blob. A plugin
+that wants to look at the blocks asks for a view of the message:
+
+    from mc3p import blocks
+    from mc3p.chunk import chunk_view
+
+    @msghdlr(0x33)
+    def handle_chunk(self, msg, source):
+        view = chunk_view(msg)
+        if view.count(blocks.DIAMOND_ORE_BLOCK):
+            ...
+
+Nothing is decompressed until an array or query is used, and views are
+cached on the message, so plugins handling the same message share one.
+Arrays may be modified in place; commit() then recompresses the payload,
+but only if the data actually changed.
+
+NumPy is an optional dependency of mc3p, needed only by the arrays and
+queries of this module.
+"""
+
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Order of the arrays following the block ids in a chunk's decompressed data.
+NIBBLE_ARRAYS = ('metadata', 'block_light', 'sky_light')
+
+def chunk_view(msg):
+    """Return the ChunkView of Chunk message msg, creating it on first use."""
+    view = msg.get('chunk_view')
+    if view is None:
+        view = msg['chunk_view'] = ChunkView(msg)
+    return view
+
+
+class ChunkView(object):
+    """Lazily decompressed contents of a Chunk message.
+
+    blocks, metadata, block_light and sky_light are uint8 arrays indexed
+    [x, z, y] relative to the message's x, y and z, with the shape given by
+    its size fields. Nibble arrays are unpacked to one value per block.
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+        self.shape = (msg['size_x'] + 1, msg['size_z'] + 1, msg['size_y'] + 1)
+        self.volume = self.shape[0] * self.shape[1] * self.shape[2]
+        self._data = None  # Decompressed payload, as last committed.
+        self._arrays = {}  # { name -> array }, for arrays used so far.
+
+    def _decompress(self):
+        if self._data is None:
+            self._data = zlib.decompress(self.msg['chunk']['data'])
+            n, half = self.volume, (self.volume + 1) // 2
+            if len(self._data) < n + 3 * half:
+                raise ValueError("Chunk data has %d bytes, %d expected" % \
+                                 (len(self._data), n + 3 * half))
+        return self._data
+
+    def _array(self, name):
+        a = self._arrays.get(name)
+        if a is not None:
+            return a
+        if numpy is None:
+            raise ImportError("ChunkView arrays require NumPy")
+        data = self._decompress()
+        n, half = self.volume, (self.volume + 1) // 2
+        if name == 'blocks':
+            a = numpy.frombuffer(data, numpy.uint8, n).copy()
+        else:
+            offset = n + NIBBLE_ARRAYS.index(name) * half
+            packed = numpy.frombuffer(data, numpy.uint8, half, offset)
+            a = numpy.empty(2 * half, numpy.uint8)
+            a[0::2] = packed & 0x0f
+            a[1::2] = packed >> 4
+            a = a[:n]
+        a = self._arrays[name] = a.reshape(self.shape)
+        return a
+
+    blocks = property(lambda self: self._array('blocks'), doc="Block ids.")
+    metadata = property(lambda self: self._array('metadata'), doc="Block metadata.")
+    block_light = property(lambda self: self._array('block_light'), doc="Block light.")
+    sky_light = property(lambda self: self._array('sky_light'), doc="Sky light.")
+
+    def mask(self, *ids):
+        """Return a boolean array, True where the block id is one of ids."""
+        lut = numpy.zeros(256, bool)
+        lut[list(ids)] = True
+        return lut[self.blocks]
+
+    def count(self, *ids):
+        """Return the number of blocks whose id is one of ids."""
+        if len(ids) == 1:
+            return int(numpy.count_nonzero(self.blocks == ids[0]))
+        return int(numpy.count_nonzero(self.mask(*ids)))
+
+    def coords(self, *ids):
+        """Return an (n,3) array of the world (x, y, z) of blocks with one of ids."""
+        xzy = numpy.argwhere(self.mask(*ids))
+        return xzy[:, [0, 2, 1]] + (self.msg['x'], self.msg['y'], self.msg['z'])
+
+    def _pack(self):
+        """Return the decompressed payload, including changes to the arrays."""
+        data = self._decompress()
+        n, half = self.volume, (self.volume + 1) // 2
+        blocks = self._arrays.get('blocks')
+        parts = [data[:n] if blocks is None else blocks.tobytes()]
+        for (i, name) in enumerate(NIBBLE_ARRAYS):
+            a = self._arrays.get(name)
+            if a is None:
+                parts.append(data[n + i * half:n + (i + 1) * half])
+                continue
+            flat = numpy.zeros(2 * half, numpy.uint8)
+            flat[:n] = a.ravel()
+            parts.append(((flat[0::2] & 0x0f) | (flat[1::2] << 4)).astype(numpy.uint8).tobytes())
+        parts.append(data[n + 3 * half:])
+        return ''.join(parts)
+
+    @property
+    def modified(self):
+        """True if the arrays differ from the message's payload."""
+        return bool(self._arrays) and self._pack() != self._data
+
+    def commit(self):
+        """Recompress modified arrays into the message's payload.
+
+        Returns True if the payload changed, in which case msg['chunk'] is
+        replaced, so that the proxy forwards the modified message.
+        """
+        if not self._arrays:
+            return False
+        return self._replace(self._pack())
+
+    def _replace(self, data):
+        """Make data the decompressed payload; return False if it already was."""
+        if data == self._decompress():
+            return False
+        self._data = data
+        compressed = zlib.compress(data)
+        self.msg['chunk'] = {'size': len(compressed), 'data': compressed}
+        return True
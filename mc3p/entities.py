@@ -0,0 +1,229 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""A table of the entities the server has told the client about.
+
+EntityTracker keeps the position and look of every entity, built from the
+messages forwarded to the client:
+
+    0x14-0x1a Spawn messages     add an entity
+    0x1d Destroy entity          removes it
+    0x1f Entity relative move    moves it
+    0x20 Entity look             turns it
+    0x21 Entity look/move        moves and turns it
+    0x22 Entity teleport         sets its position and look
+    0x09 Respawn                 clears the table, since the world changed
+
+Entities are stored in slots of parallel arrays (eid, x, y, z, yaw, pitch,
+kind), so that an update touches a few array items and no Python objects.
+Positions are kept in absolute integer units, as sent by the server: 1/32
+of a block. An entity whose values do not fit its slot, such as a position
+moved out of range, is dropped rather than tracked wrongly. A grid of CELL_SIZE by CELL_SIZE block cells, over x and z,
+indexes slots by position for within().
+"""
+
+import array
+
+# Absolute integer units per block.
+UNITS = 32
+
+# Width of a grid cell, in blocks.
+CELL_SIZE = 16
+CELL_SHIFT = 9 # log2(CELL_SIZE * UNITS)
+
+# Messages that change the table.
+SPAWN_MSGTYPES = frozenset([0x14, 0x15, 0x17, 0x18, 0x19, 0x1a])
+MSGTYPES = SPAWN_MSGTYPES | frozenset([0x09, 0x1d, 0x1f, 0x20, 0x21, 0x22])
+
+# Yaw and pitch fields of spawn messages that have them.
+SPAWN_LOOK = {0x14: ('rotation', 'pitch'),
+              0x15: ('rotation', 'pitch'),
+              0x18: ('yaw', 'pitch')}
+
+class EntityTracker(object):
+    """Positions and looks of the entities known to the client, by eid.
+
+    The arrays are public, for plugins that want to scan them: slot i holds
+    an entity if eid[i] is not FREE, and slot(eid) gives its slot. kind[i]
+    is the msgtype of the message that spawned the entity.
+    """
+
+    FREE = -1
+
+    def __init__(self):
+        self.clear()
+        self.__updaters = {0x09: self._respawn,
+                           0x1d: self._destroy,
+                           0x1f: self._move,
+                           0x20: self._look,
+                           0x21: self._move_look,
+                           0x22: self._teleport}
+        for msgtype in SPAWN_MSGTYPES:
+            self.__updaters[msgtype] = self._spawn
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, eid):
+        return eid in self.slots
+
+    def clear(self):
+        self.eid = array.array('i')
+        self.x = array.array('l')
+        self.y = array.array('l')
+        self.z = array.array('l')
+        self.yaw = array.array('b')
+        self.pitch = array.array('b')
+        self.kind = array.array('B')
+        self.slots = {} # { eid -> slot }
+        self.free = []  # Free slots.
+        self.cells = {} # { (cx, cz) -> set of slots }
+
+    def slot(self, eid):
+        """Return the slot of entity eid, or None if it is not known."""
+        return self.slots.get(eid)
+
+    def position(self, eid):
+        """Return the (x, y, z) of entity eid in blocks, or None if it is not known."""
+        i = self.slots.get(eid)
+        if i is None:
+            return None
+        return (self.x[i] / float(UNITS), self.y[i] / float(UNITS), self.z[i] / float(UNITS))
+
+    def look(self, eid):
+        """Return the (yaw, pitch) of entity eid, in 1/256ths of a turn, or None."""
+        i = self.slots.get(eid)
+        if i is None:
+            return None
+        return (self.yaw[i], self.pitch[i])
+
+    def within(self, x, y, z, radius):
+        """Return the eids of entities within radius blocks of (x, y, z)."""
+        ux, uy, uz = int(x * UNITS), int(y * UNITS), int(z * UNITS)
+        r = int(radius * UNITS)
+        r2 = r * r
+        xs, ys, zs, eids = self.x, self.y, self.z, self.eid
+        found = []
+        for cx in xrange((ux - r) >> CELL_SHIFT, ((ux + r) >> CELL_SHIFT) + 1):
+            for cz in xrange((uz - r) >> CELL_SHIFT, ((uz + r) >> CELL_SHIFT) + 1):
+                for i in self.cells.get((cx, cz), ()):
+                    dx, dy, dz = xs[i] - ux, ys[i] - uy, zs[i] - uz
+                    if dx * dx + dy * dy + dz * dz <= r2:
+                        found.append(eids[i])
+        return found
+
+    def update(self, msg):
+        """Apply a message sent by the server to the table."""
+        updater = self.__updaters.get(msg['msgtype'])
+        if updater:
+            updater(msg)
+
+    def _add(self, eid, kind, x, y, z, yaw, pitch):
+        if eid in self.slots:
+            self._remove(eid)
+        if self.free:
+            i = self.free.pop()
+            try:
+                self.kind[i] = kind
+                self.x[i], self.y[i], self.z[i] = x, y, z
+                self.yaw[i], self.pitch[i] = yaw, pitch
+                self.eid[i] = eid # Last, so that the slot stays free on error.
+            except OverflowError:
+                self.free.append(i)
+                return
+        else:
+            i = len(self.eid)
+            columns = (self.eid, self.kind, self.x, self.y, self.z, self.yaw, self.pitch)
+            try:
+                for (column, val) in zip(columns, (eid, kind, x, y, z, yaw, pitch)):
+                    column.append(val)
+            except OverflowError:
+                for column in columns:
+                    del column[i:]
+                return
+        self.slots[eid] = i
+        self.cells.setdefault((x >> CELL_SHIFT, z >> CELL_SHIFT), set()).add(i)
+
+    def _remove(self, eid):
+        i = self.slots.get(eid)
+        if i is not None:
+            self._free(i, (self.x[i] >> CELL_SHIFT, self.z[i] >> CELL_SHIFT))
+
+    def _free(self, i, key):
+        """Free slot i, indexed in the grid cell at key."""
+        del self.slots[self.eid[i]]
+        cell = self.cells[key]
+        cell.discard(i)
+        if not cell:
+            del self.cells[key]
+        self.eid[i] = self.FREE
+        self.free.append(i)
+
+    def _set_position(self, i, x, y, z):
+        old = (self.x[i] >> CELL_SHIFT, self.z[i] >> CELL_SHIFT)
+        try:
+            self.x[i], self.y[i], self.z[i] = x, y, z
+        except OverflowError:
+            self._free(i, old)
+            return
+        new = (x >> CELL_SHIFT, z >> CELL_SHIFT)
+        if old != new:
+            cell = self.cells[old]
+            cell.discard(i)
+            if not cell:
+                del self.cells[old]
+            self.cells.setdefault(new, set()).add(i)
+
+    def _respawn(self, msg):
+        self.clear()
+
+    def _spawn(self, msg):
+        msgtype = msg['msgtype']
+        x, y, z = msg['x'], msg['y'], msg['z']
+        if msgtype == 0x19:
+            # Paintings are placed at block coordinates.
+            x, y, z = x * UNITS, y * UNITS, z * UNITS
+        look = SPAWN_LOOK.get(msgtype)
+        yaw, pitch = (msg[look[0]], msg[look[1]]) if look else (0, 0)
+        self._add(msg['eid'], msgtype, x, y, z, yaw, pitch)
+
+    def _destroy(self, msg):
+        self._remove(msg['eid'])
+
+    def _move(self, msg):
+        i = self.slots.get(msg['eid'])
+        if i is not None:
+            self._set_position(i, self.x[i] + msg['dx'], self.y[i] + msg['dy'],
+                               self.z[i] + msg['dz'])
+
+    def _look(self, msg):
+        i = self.slots.get(msg['eid'])
+        if i is not None:
+            self.yaw[i], self.pitch[i] = msg['yaw'], msg['pitch']
+
+    def _move_look(self, msg):
+        i = self.slots.get(msg['eid'])
+        if i is not None:
+            self._set_position(i, self.x[i] + msg['dx'], self.y[i] + msg['dy'],
+                               self.z[i] + msg['dz'])
+            self.yaw[i], self.pitch[i] = msg['yaw'], msg['pitch']
+
+    def _teleport(self, msg):
+        i = self.slots.get(msg['eid'])
+        if i is not None:
+            self._set_position(i, msg['x'], msg['y'], msg['z'])
+            self.yaw[i], self.pitch[i] = msg['yaw'], msg['pitch']
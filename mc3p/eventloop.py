@@ -0,0 +1,184 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Event loops and buffered dispatchers for the proxy.
+
+asyncore.loop() hands the kernel a fresh select() or poll() set on every
+iteration. epoll_loop() keeps descriptors registered with an epoll object
+across iterations, and only tells the kernel about a descriptor when its
+readable()/writable() state changes.
+"""
+
+import asyncore, select, errno, collections, logging
+
+logger = logging.getLogger("mc3p")
+
+LOOPS = ('epoll', 'poll', 'select')
+
+def default_loop():
+    """Return the name of the most scalable loop this platform supports."""
+    for kind in LOOPS:
+        if hasattr(select, kind):
+            return kind
+
+def loop(kind=None, timeout=30.0, map=None, count=None):
+    """Run the named event loop ('epoll', 'poll' or 'select') over map."""
+    kind = kind or default_loop()
+    logger.debug("running %s event loop" % kind)
+    if kind == 'epoll':
+        epoll_loop(timeout, map, count)
+    else:
+        asyncore.loop(timeout, kind == 'poll', map, count)
+
+def epoll_loop(timeout=30.0, map=None, count=None):
+    """Like asyncore.loop(), but backed by a persistent epoll object."""
+    if map is None:
+        map = asyncore.socket_map
+    ep = select.epoll()
+    registered = {} # { fd -> (dispatcher, event mask) }
+    try:
+        while map and (count is None or count > 0):
+            _update_epoll(ep, registered, map)
+            try:
+                events = ep.poll(timeout)
+            except IOError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                events = []
+            for (fd, flags) in events:
+                obj = map.get(fd)
+                if obj is not None:
+                    asyncore.readwrite(obj, flags)
+            if count is not None:
+                count -= 1
+    finally:
+        ep.close()
+
+def _update_epoll(ep, registered, map):
+    """Bring ep's registrations in line with the dispatchers in map."""
+    for fd in registered.keys():
+        if fd not in map:
+            del registered[fd]
+            try:
+                ep.unregister(fd)
+            except (IOError, OSError, ValueError):
+                pass # Closing the descriptor already removed it.
+    for (fd, obj) in map.items():
+        flags = 0
+        if obj.readable():
+            flags |= select.EPOLLIN | select.EPOLLPRI
+        # Accepting sockets should not be writable.
+        if obj.writable() and not obj.accepting:
+            flags |= select.EPOLLOUT
+        old = registered.get(fd)
+        if old is not None and old[0] is obj and old[1] == flags:
+            continue
+        registered[fd] = (obj, flags)
+        # The descriptor may have been closed and reused by a new dispatcher,
+        # in which case the kernel has forgotten the old registration.
+        try:
+            ep.modify(fd, flags)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            ep.register(fd, flags)
+
+
+class BufferedDispatcher(asyncore.dispatcher):
+    """An asyncore dispatcher with a queue of outgoing buffers.
+
+    asyncore.dispatcher_with_send appends to a single string, and re-slices
+    it on every partial send of at most 512 bytes. Here, sent data is queued
+    as-is, partial sends only advance an offset, and pending chunks are joined
+    once when they reach the head of the queue.
+
+    out_bytes counts buffered bytes. When it rises above high_water,
+    pause_writing() is called; once it drains to low_water or below,
+    resume_writing() is called. Both do nothing by default.
+    """
+
+    RECV_SIZE = 64 * 1024
+    SEND_SIZE = 256 * 1024
+
+    def __init__(self, sock=None, map=None, high_water=1024*1024, low_water=None):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.out_chunks = collections.deque()
+        self.out_offset = 0  # Bytes of out_chunks[0] already sent.
+        self.out_bytes = 0
+        self.set_write_buffer_limits(high_water, low_water)
+        self.writing_paused = False
+
+    def set_write_buffer_limits(self, high_water, low_water=None):
+        if low_water is None:
+            low_water = high_water // 4
+        self.high_water = high_water
+        self.low_water = low_water
+
+    def pause_writing(self):
+        """Called when the send buffer rises above high_water."""
+
+    def resume_writing(self):
+        """Called when the send buffer drains to low_water."""
+
+    def send(self, data):
+        """Queue data for sending, and try to send it right away."""
+        if not data:
+            return
+        self.out_chunks.append(data)
+        self.out_bytes += len(data)
+        if len(self.out_chunks) == 1:
+            self.initiate_send()
+        if not self.writing_paused and self.out_bytes > self.high_water:
+            self.writing_paused = True
+            self.pause_writing()
+
+    def initiate_send(self):
+        while self.out_chunks:
+            if self.out_offset == 0 and len(self.out_chunks) > 1:
+                self._join_chunks()
+            chunk = self.out_chunks[0]
+            n = min(self.SEND_SIZE, len(chunk) - self.out_offset)
+            num_sent = asyncore.dispatcher.send(
+                self, memoryview(chunk)[self.out_offset:self.out_offset+n])
+            if num_sent == 0:
+                break
+            self.out_bytes -= num_sent
+            self.out_offset += num_sent
+            if self.out_offset == len(chunk):
+                self.out_chunks.popleft()
+                self.out_offset = 0
+            if num_sent < n:
+                break # Kernel buffer is full.
+        if self.writing_paused and self.out_bytes <= self.low_water:
+            self.writing_paused = False
+            self.resume_writing()
+
+    def _join_chunks(self):
+        """Merge queued chunks into one of at most about SEND_SIZE bytes."""
+        parts = []
+        n = 0
+        while self.out_chunks and n < self.SEND_SIZE:
+            chunk = self.out_chunks.popleft()
+            parts.append(chunk)
+            n += len(chunk)
+        self.out_chunks.appendleft(''.join(parts))
+
+    def handle_write(self):
+        self.initiate_send()
+
+    def writable(self):
+        return (not self.connected) or bool(self.out_chunks)
@@ -54,7 +54,6 @@ srv_msgs[0x01] = defmsg(0x01, "Login packet", [
     ('eid',MC_int),
     ('reserved',MC_string),
     ('map_seed',MC_long),
-    ('level_type', MC_string, 23),
     ('server_mode', MC_int),
     ('dimension', MC_byte),
     ('difficulty', MC_byte),
@@ -540,3 +539,24 @@ srv_msgs[0x09] = defmsg(0x09, "Respawn", [
 
 cli_msgs[0x1b] = \
 srv_msgs[0x1b] = None
+
+### Compiled tables, per protocol version ###
+
+_tables = {}
+
+def tables(version):
+    """Return the (client, server) message Parsems of protocol version.
+
+    The first call for a version freezes its tables into tuples, and
+    compiles all of its messages, so that no message is compiled mid-session.
+    Raises KeyError for unknown versions.
+    """
+    t = _tables.get(version)
+    if t is None:
+        t = tuple(tuple(msgs) for msgs in protocol[version])
+        for msgs in t:
+            for parsem in msgs:
+                if isinstance(parsem, MessageParsem):
+                    parsem.compile()
+        _tables[version] = t
+    return t
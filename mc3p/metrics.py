@@ -0,0 +1,251 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Proxy metrics, served over HTTP in the Prometheus text format.
+
+Collection is off until enable() is called, so that the proxy does not pay
+for per-packet timing when nobody is looking. Code on the packet path
+should test metrics.enabled before recording anything.
+"""
+
+import asyncore, socket, logging, bisect
+from time import time
+
+from eventloop import BufferedDispatcher
+
+logger = logging.getLogger("mc3p")
+
+enabled = False
+
+class Metric(object):
+    """Base class for metrics with a fixed list of label names."""
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.values = {} # { label value tuple -> value }
+
+    def format_labels(self, labels, extra=''):
+        pairs = ['%s="%s"' % (n, format_label(n, v)) for (n, v) in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return '{%s}' % ','.join(pairs) if pairs else ''
+
+    def samples(self):
+        """Yield (name, label string, value) for each sample."""
+        for (labels, value) in sorted(self.values.items()):
+            yield (self.name, self.format_labels(labels), value)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for (name, labels, value) in self.samples():
+            lines.append('%s%s %s' % (name, labels, format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, labels=(), n=1):
+        self.values[labels] = self.values.get(labels, 0) + n
+
+
+class Gauge(Metric):
+    """A gauge whose samples are computed when the metrics are rendered.
+
+    Each function added with add_function() returns an iterable of
+    (label value tuple, value) pairs, until it is removed with
+    remove_function().
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        Metric.__init__(self, name, help, labelnames)
+        self.functions = []
+
+    def add_function(self, fn):
+        self.functions.append(fn)
+
+    def remove_function(self, fn):
+        if fn in self.functions:
+            self.functions.remove(fn)
+
+    def samples(self):
+        for fn in self.functions:
+            for (labels, value) in fn():
+                yield (self.name, self.format_labels(labels), value)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=None):
+        Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets or TIME_BUCKETS)
+
+    def observe(self, value, labels=()):
+        h = self.values.get(labels)
+        if h is None:
+            h = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        h[0][bisect.bisect_left(self.buckets, value)] += 1
+        h[1] += value
+        h[2] += 1
+
+    def samples(self):
+        for (labels, (counts, total, n)) in sorted(self.values.items()):
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="%s"' % format_value(bound)
+                yield (self.name + '_bucket', self.format_labels(labels, le), cumulative)
+            yield (self.name + '_sum', self.format_labels(labels), total)
+            yield (self.name + '_count', self.format_labels(labels), n)
+
+
+def format_label(name, v):
+    if name == 'msgtype':
+        return '0x%02x' % v
+    return str(v).replace('\\', '\\\\').replace('"', '\\"')
+
+def format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(v)
+
+TIME_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+LIFETIME_BUCKETS = (1, 10, 60, 300, 900, 1800, 3600, 4*3600, 12*3600)
+
+### Metrics recorded by the proxy ###
+
+packets = Counter('mc3p_packets_total', 'Packets received, by direction and msgtype',
+                  ('direction', 'msgtype'))
+packet_bytes = Counter('mc3p_bytes_total', 'Bytes received, by direction and msgtype',
+                       ('direction', 'msgtype'))
+relayed_bytes = Counter('mc3p_relayed_bytes_total',
+                        'Bytes forwarded without parsing, by direction', ('direction',))
+parse_time = Histogram('mc3p_parse_seconds', 'Time spent parsing a packet',
+                       ('direction',))
+filter_time = Histogram('mc3p_plugin_filter_seconds',
+                        'Time spent in a plugin instance\'s handlers per packet',
+                        ('plugin',))
+injected = Counter('mc3p_injected_messages_total', 'Messages injected by plugins',
+                   ('direction',))
+injection_latency = Histogram('mc3p_injection_latency_seconds',
+                              'Time from plugin injection to send')
+sessions = Counter('mc3p_sessions_total', 'Client sessions accepted')
+session_lifetime = Histogram('mc3p_session_lifetime_seconds', 'Duration of closed sessions',
+                             buckets=LIFETIME_BUCKETS)
+sessions_active = Gauge('mc3p_sessions_active', 'Sessions currently open')
+session_bytes = Gauge('mc3p_session_bytes', 'Bytes received in an open session',
+                      ('session', 'direction'))
+session_buffered = Gauge('mc3p_session_buffered_bytes',
+                         'Bytes waiting to be sent to a peer of an open session',
+                         ('session', 'direction'))
+
+all_metrics = [packets, packet_bytes, relayed_bytes, parse_time, filter_time, injected,
+               injection_latency, sessions, session_lifetime, sessions_active,
+               session_bytes, session_buffered]
+
+def enable():
+    """Start collecting metrics."""
+    global enabled
+    enabled = True
+
+def render():
+    """Return all metrics in the Prometheus text exposition format."""
+    return '\n'.join(m.render() for m in all_metrics) + '\n'
+
+def record_packet(direction, packet, seconds):
+    """Record a packet parsed by parse_packet(), and the time it took.
+
+    packet is either a decoded message or a skipped packet's raw bytes.
+    """
+    if isinstance(packet, str):
+        msgtype, n = ord(packet[0]), len(packet)
+    else:
+        msgtype, n = packet['msgtype'], len(packet['raw_bytes'])
+    packets.inc((direction, msgtype))
+    packet_bytes.inc((direction, msgtype), n)
+    parse_time.observe(seconds, (direction,))
+
+def timed(hdlr, plugin_id):
+    """Wrap a plugin dispatch callable so that its run time is recorded."""
+    labels = (plugin_id,)
+    def timed_hdlr(msg, source):
+        t = time()
+        try:
+            return hdlr(msg, source)
+        finally:
+            filter_time.observe(time() - t, labels)
+    return timed_hdlr
+
+
+### HTTP endpoint ###
+
+class MetricsServer(asyncore.dispatcher):
+    """Serve render() to any HTTP request on host:port."""
+
+    def __init__(self, port, host='127.0.0.1'):
+        asyncore.dispatcher.__init__(self)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind( (host, port) )
+        self.listen(5)
+        logger.info("metrics available at http://%s:%d/metrics" % (host, port))
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            MetricsRequest(pair[0])
+
+
+class MetricsRequest(BufferedDispatcher):
+    """Read one HTTP request, answer it with the current metrics, and close."""
+
+    def __init__(self, sock):
+        BufferedDispatcher.__init__(self, sock)
+        self.request = ''
+        self.responded = False
+
+    def readable(self):
+        return not self.responded
+
+    def handle_read(self):
+        self.request += self.recv(4096)
+        if '\r\n\r\n' in self.request or '\n\n' in self.request:
+            body = render()
+            self.send('\r\n'.join(['HTTP/1.0 200 OK',
+                                   'Content-Type: text/plain; version=0.0.4',
+                                   'Content-Length: %d' % len(body),
+                                   '', body]))
+            self.responded = True
+            if not self.out_chunks:
+                self.close()
+        elif len(self.request) > 64 * 1024:
+            self.close()
+
+    def handle_write(self):
+        self.initiate_send()
+        if self.responded and not self.out_chunks:
+            self.close()
+
+    def handle_close(self):
+        self.close()
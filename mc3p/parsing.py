@@ -15,22 +15,55 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import sys, struct, logging, inspect
+import sys, struct, logging, inspect, array, re, keyword, operator
 
 logger = logging.getLogger('parsing')
 
 class Parsem(object):
-    """Parser/emitter."""
+    """Parser/emitter.
 
-    def __init__(self,parser,emitter):
+    Fixed-width Parsems also carry their struct format character in fmt,
+    which lets defmsg merge runs of them into a single struct.Struct.
+
+    skip(stream) advances past a value without decoding it. It defaults to
+    parsing and discarding the value; variable-width Parsems whose length is
+    cheap to compute supply their own skipper.
+    """
+
+    def __init__(self,parser,emitter,fmt=None,skipper=None):
         setattr(self,'parse',parser)
         setattr(self,'emit',emitter)
+        self.fmt = fmt
+        if skipper is None:
+            if fmt:
+                size = struct.calcsize('>' + fmt)
+                skipper = lambda stream: stream.skip(size)
+            else:
+                skipper = parser
+        setattr(self,'skip',skipper)
+
+    def patch(self, raw, msg, keys):
+        """Return raw with the fields named in keys re-encoded from msg.
+
+        Returns None if the fields cannot be patched in place, in which case
+        the caller should emit(msg) instead. Only message Parsems patch.
+        """
+        return None
+
+BYTE = struct.Struct(">b")
+UNSIGNED_BYTE = struct.Struct(">B")
+SHORT = struct.Struct(">h")
+INT = struct.Struct(">i")
+LONG = struct.Struct(">q")
+FLOAT = struct.Struct(">f")
+DOUBLE = struct.Struct(">d")
+BOOL = struct.Struct(">?")
 
 def parse_byte(stream):
-    return struct.unpack_from(">b",stream.read(1))[0]
+    return stream.unpack(BYTE)[0]
 
 def emit_byte(b):
-    return struct.pack(">b",b)
+    return BYTE.pack(b)
 
 
 def with_defaults(tuple):
@@ -43,17 +76,339 @@ def with_defaults(tuple):
     else:
         return tuple
 
+def compile_fields(pairs):
+    """Group (name,Parsem) pairs into parsing steps.
+
+    Returns a list of (names, st, parsem) triples. Each run of consecutive
+    fixed-width fields becomes one step with a tuple of names and a
+    struct.Struct st covering all of them (parsem is None). Every other
+    field becomes a step of its own, with st set to None.
+    """
+    steps = []
+    run_names, run_fmt = [], ''
+    for (name,parsem) in pairs:
+        if parsem.fmt:
+            run_names.append(name)
+            run_fmt += parsem.fmt
+            continue
+        if run_names:
+            steps.append((tuple(run_names), struct.Struct('>' + run_fmt), None))
+            run_names, run_fmt = [], ''
+        steps.append((name, None, parsem))
+    if run_names:
+        steps.append((tuple(run_names), struct.Struct('>' + run_fmt), None))
+    return steps
+
+def compile_offsets(pairs, steps):
+    """Locate the fixed-width fields of a message within its parsing steps.
+
+    Returns { name -> (k, offset, st) }, where the field is in steps[k], at
+    offset bytes from the start of that step, and st is its struct.Struct.
+    """
+    fmts = dict((name, parsem.fmt) for (name,parsem) in pairs if parsem.fmt)
+    fields = {}
+    for (k, (names,st,parsem)) in enumerate(steps):
+        if not st:
+            continue
+        offset = 0
+        for name in names:
+            field_st = struct.Struct('>' + fmts[name])
+            fields[name] = (k, offset, field_st)
+            offset += field_st.size
+    return fields
+
+# Value of Record.modified until a key is modified.
+NOT_MODIFIED = frozenset()
+
+class Record(object):
+    """Base class of the per-message record classes built by record_class().
+
+    A record keeps the fields of a parsed message in slots, and can be used
+    like the dict a message used to be: msg['x'], 'x' in msg, msg.get('x'),
+    msg.items() and so on. Fields may also be read as attributes, which is
+    faster: msg.x. The keys of a record are 'msgtype', its fields, and
+    'raw_bytes' once set. Other keys, such as ones added by plugins, are
+    kept in a dict of extras.
+
+    modified is the set of keys whose values have been changed by
+    assignment, as msg['x'] = 1.
+    """
+
+    __slots__ = ('modified', 'raw_bytes', 'extra')
+
+    msgtype = None
+    fields = ()            # Field names, in message order.
+    slotted = frozenset()  # Keys held in slots, plus 'msgtype'.
+
+    def __getitem__(self, key):
+        if key in self.slotted:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, val):
+        if key == 'msgtype':
+            if val != self.msgtype:
+                raise ValueError("Cannot change the msgtype of a %s" % type(self).__name__)
+            return
+        if key in self.slotted:
+            old = getattr(self, key, NOT_MODIFIED)
+            setattr(self, key, val)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            old = self.extra.get(key, NOT_MODIFIED)
+            self.extra[key] = val
+        if old is not NOT_MODIFIED and old != val:
+            if not self.modified:
+                self.modified = set()
+            self.modified.add(key)
+
+    def __delitem__(self, key):
+        if key == 'raw_bytes' and hasattr(self, key):
+            del self.raw_bytes
+        elif key in self.slotted:
+            raise TypeError("Cannot delete field %s of a %s" % (key, type(self).__name__))
+        elif self.extra is not None and key in self.extra:
+            del self.extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.slotted:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    has_key = __contains__
+
+    def keys(self):
+        keys = ['msgtype']
+        keys.extend(self.fields)
+        if hasattr(self, 'raw_bytes'):
+            keys.append('raw_bytes')
+        if self.extra:
+            keys.extend(self.extra)
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def get(self, key, default=None):
+        if key in self.slotted:
+            return getattr(self, key, default)
+        if self.extra is not None:
+            return self.extra.get(key, default)
+        return default
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def pop(self, key, *default):
+        try:
+            val = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return val
+
+    def update(self, *args, **kwargs):
+        for (key, val) in dict(*args, **kwargs).iteritems():
+            self[key] = val
+
+    def copy(self):
+        """Return the keys and values of the record as a dict."""
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, Record)):
+            return self.copy() == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, self.copy())
+
+def record_class(msgtype, name, names):
+    """Return a new Record subclass for message msgtype with fields names."""
+    for n in names:
+        if keyword.iskeyword(n) or n.startswith('_') or hasattr(Record, n) or \
+           names.count(n) > 1:
+            raise ValueError("Invalid field name %s in message 0x%02x" % (n, msgtype))
+    clsname = ''.join(w.capitalize() for w in re.split(r'\W+', name)) or 'Message%02x' % msgtype
+    return type(clsname, (Record,), {'__slots__': names,
+                                     'msgtype': msgtype,
+                                     'fields': names,
+                                     'slotted': frozenset(names + ('msgtype', 'raw_bytes'))})
+
+def compile_parser(cls, steps):
+    """Return a function parsing the fields of steps into a record of class cls.
+
+    The function is generated, so that each run of fixed-width fields is
+    unpacked straight into the record's slots.
+    """
+    env = {'cls': cls, 'new': object.__new__, 'NOT_MODIFIED': NOT_MODIFIED}
+    lines = ['def parse(stream):',
+             '    unpack = stream.unpack',
+             '    msg = new(cls)']
+    for (k, (names,st,parsem)) in enumerate(steps):
+        if st:
+            env['st%d' % k] = st
+            lines.append('    %s, = unpack(st%d)' % (', '.join('msg.' + n for n in names), k))
+        else:
+            env['parse%d' % k] = parsem.parse
+            lines.append('    msg.%s = parse%d(stream)' % (names, k))
+    lines += ['    msg.modified = NOT_MODIFIED',
+              '    msg.extra = None',
+              '    return msg']
+    exec '\n'.join(lines) in env
+    return env['parse']
+
+class MessageParsem(Parsem):
+    """Parsem of a message, whose fields are compiled on first use.
+
+    Until then, parse, emit, skip and patch are methods that compile the
+    message and call the real function. Compiling stores the real functions
+    on the instance, which then shadow the methods.
+
+    parse() returns an instance of record, the Record subclass built for
+    the message when it is compiled.
+
+    patch() rewrites fixed-width fields in a copy of the message's raw
+    bytes, at offsets computed when compiling. Fields that follow a
+    variable-width one have no fixed offset, and are not patched.
+    """
+
+    def __init__(self, msgtype, name, pairs):
+        self.msgtype = msgtype
+        self.name = name
+        self.pairs = pairs
+        self.fmt = None
+
+    @property
+    def compiled(self):
+        return 'parse' in self.__dict__
+
+    def compile(self):
+        """Build the parse, emit and skip functions of the message."""
+        if self.compiled:
+            return
+        steps = compile_fields(self.pairs)
+        msgtype = self.msgtype
+        prefix = emit_unsigned_byte(msgtype)
+        self.record = record_class(msgtype, self.name, tuple(n for (n,p) in self.pairs))
+        parse = compile_parser(self.record, steps)
+        # Each step's values are fetched with one call: by attribute from
+        # records, and by key from dicts.
+        getters = []
+        for (names,st,parsem) in steps:
+            keys = names if st else (names,)
+            getters.append((st, parsem, len(keys) > 1,
+                            operator.attrgetter(*keys), operator.itemgetter(*keys)))
+        record = self.record
+        def emit(msg):
+            parts = [prefix]
+            is_record = type(msg) is record
+            for (st,parsem,many,attrs,items) in getters:
+                vals = attrs(msg) if is_record else items(msg)
+                if not st:
+                    parts.append(parsem.emit(vals))
+                elif many:
+                    parts.append(st.pack(*vals))
+                else:
+                    parts.append(st.pack(vals))
+            return ''.join(parts)
+        def skip(stream):
+            for (names,st,parsem) in steps:
+                if st:
+                    stream.skip(st.size)
+                else:
+                    parsem.skip(stream)
+        # Fields before the first variable-width one are at the same offset
+        # in every packet; only those are patched.
+        bases = [1]
+        for (names,st,parsem) in steps:
+            if not st:
+                break
+            bases.append(bases[-1] + st.size)
+        fields = {}
+        for (name, (k, offset, st)) in compile_offsets(self.pairs, steps).iteritems():
+            if k < len(bases):
+                fields[name] = (bases[k] + offset, st)
+        def patch(raw, msg, keys):
+            buf = bytearray(raw)
+            for key in keys:
+                field = fields.get(key)
+                if field is None:
+                    return None
+                field[1].pack_into(buf, field[0], msg[key])
+            return str(buf)
+        if len(bases) > len(steps):
+            # Every field is fixed-width, and emitting is a single pack.
+            patch = lambda raw, msg, keys: emit(msg)
+        self.parse, self.emit, self.skip, self.patch = parse, emit, skip, patch
+
+    def parse(self, stream):
+        self.compile()
+        return self.parse(stream)
+
+    def emit(self, msg):
+        self.compile()
+        return self.emit(msg)
+
+    def skip(self, stream):
+        self.compile()
+        return self.skip(stream)
+
+    def patch(self, raw, msg, keys):
+        self.compile()
+        return self.patch(raw, msg, keys)
+
+# { (msgtype, name, pairs) -> MessageParsem }, so identical definitions share one.
+_messages = {}
+
 def defmsg(msgtype, name, pairs):
-    """Build a Parsem for a message out of (name,Parsem) pairs."""
-    def parse(stream):
-        msg = {'msgtype': msgtype}
-        for (name,parsem) in pairs:
-            msg[name] = parsem.parse(stream)
-        return msg
-    def emit(msg):
-        return ''.join([emit_unsigned_byte(msgtype),
-                        ''.join([parsem.emit(msg[name]) for (name,parsem) in pairs])])
-    return Parsem(parse,emit)
+    """Build a Parsem for a message out of (name,Parsem) pairs.
+
+    The Parsem is compiled lazily, and redefining a message identically,
+    as a later protocol version might, returns the existing Parsem.
+    """
+    key = (msgtype, name, tuple(pairs))
+    parsem = _messages.get(key)
+    if parsem is None:
+        parsem = _messages[key] = MessageParsem(msgtype, name, tuple(pairs))
+    return parsem
 
 def defloginmsg(tuples):
     """One-off used to define login message.
@@ -77,95 +432,95 @@ def defloginmsg(tuples):
         pairs = ((name,parsem) for (name,parsem,x,y) in map(with_defaults, tuples)
                                if x <= proto_version <= y)
         return ''.join([emit_unsigned_byte(0x01),
+                        emit_int(proto_version),
                         ''.join([parsem.emit(msg[name]) for (name,parsem) in pairs])])
     return Parsem(parse, emit)
 
-MC_byte = Parsem(parse_byte,emit_byte)
+MC_byte = Parsem(parse_byte,emit_byte,'b')
 
 def parse_unsigned_byte(stream):
-    return struct.unpack(">B",stream.read(1))[0]
+    return stream.unpack(UNSIGNED_BYTE)[0]
 
 def emit_unsigned_byte(b):
-    return struct.pack(">B",b)
+    return UNSIGNED_BYTE.pack(b)
 
-MC_unsigned_byte = Parsem(parse_unsigned_byte, emit_unsigned_byte)
+MC_unsigned_byte = Parsem(parse_unsigned_byte, emit_unsigned_byte, 'B')
 
 def parse_short(stream):
-    return struct.unpack_from(">h",stream.read(2))[0]
+    return stream.unpack(SHORT)[0]
 
 def emit_short(s):
-    return struct.pack(">h",s)
+    return SHORT.pack(s)
 
-MC_short = Parsem(parse_short, emit_short)
+MC_short = Parsem(parse_short, emit_short, 'h')
 
 def parse_int(stream):
-    return struct.unpack_from(">i",stream.read(4))[0]
+    return stream.unpack(INT)[0]
 
 def emit_int(i):
-    return struct.pack(">i",i)
+    return INT.pack(i)
 
-MC_int = Parsem(parse_int, emit_int)
+MC_int = Parsem(parse_int, emit_int, 'i')
 
 def parse_long(stream):
-    return struct.unpack_from(">q",stream.read(8))[0]
+    return stream.unpack(LONG)[0]
 
 def emit_long(l):
-    return struct.pack(">q",l)
+    return LONG.pack(l)
 
-MC_long = Parsem(parse_long, emit_long)
+MC_long = Parsem(parse_long, emit_long, 'q')
 
 def parse_float(stream):
-    return struct.unpack_from(">f",stream.read(4))[0]
+    return stream.unpack(FLOAT)[0]
 
 def emit_float(f):
-    return struct.pack(">f",f)
+    return FLOAT.pack(f)
 
-MC_float = Parsem(parse_float, emit_float)
+MC_float = Parsem(parse_float, emit_float, 'f')
 
 def parse_double(stream):
-    return struct.unpack_from(">d",stream.read(8))[0]
+    return stream.unpack(DOUBLE)[0]
 
 def emit_double(d):
-    return struct.pack(">d",d)
+    return DOUBLE.pack(d)
 
-MC_double = Parsem(parse_double, emit_double)
+MC_double = Parsem(parse_double, emit_double, 'd')
 
 def parse_string(stream):
     n = parse_short(stream)
     if n == 0:
         return unicode("", encoding="utf-16-be")
-    return unicode(stream.read(2*n), encoding="utf-16-be")
+    return unicode(stream.read(2*n).tobytes(), encoding="utf-16-be")
 
 def emit_string(s):
     return ''.join([emit_short(len(s)), s.encode("utf-16-be")])
 
-MC_string = Parsem(parse_string, emit_string)
+def skip_string(stream):
+    stream.skip(2*parse_short(stream))
+
+MC_string = Parsem(parse_string, emit_string, skipper=skip_string)
 
 def parse_string8(stream):
     n = parse_short(stream)
     if n == 0:
         return ''
-    return stream.read(n)
+    return stream.read(n).tobytes()
 
 def emit_string8(s):
     return ''.join([emit_short(len(s)),s])
 
-MC_string8 = Parsem(parse_string8, emit_string8)
+def skip_string8(stream):
+    stream.skip(parse_short(stream))
+
+MC_string8 = Parsem(parse_string8, emit_string8, skipper=skip_string8)
 
 def parse_bool(stream):
-    b = struct.unpack_from(">B",stream.read(1))[0]
-    if b==0:
-        return False
-    else:
-        return True
+    return stream.unpack(BOOL)[0]
 
 def emit_bool(b):
-    if b:
-        return emit_unsigned_byte(1)
-    else:
-        return emit_unsigned_byte(0)
+    return BOOL.pack(b)
 
-MC_bool = Parsem(parse_bool, emit_bool)
+MC_bool = Parsem(parse_bool, emit_bool, '?')
 
 def parse_metadata(stream):
     data=[]
@@ -187,7 +542,7 @@ def parse_metadata(stream):
             data.append(parse_byte(stream))
             data.append(parse_short(stream))
         else:
-            logger.error(repr(stream.buf[:parse.i]))
+            logger.error(repr(stream.buf[stream.start:stream.i]))
             raise Exception("Unknown metadata type %d" % type)
         type = parse_byte(stream)
     return data
@@ -249,7 +604,7 @@ def parse_slot_update2(stream):
         n = parse_short(stream)
         r['nbt_size'] = n
         if n > 0:
-            r['nbt_data'] = stream.read(n)
+            r['nbt_data'] = stream.read(n).tobytes()
         else:
             r['nbt_data'] = None
     return r
@@ -282,26 +637,75 @@ MC_inventory2 = Parsem(parse_inventory2,emit_inventory2)
 
 def parse_chunk(stream):
     n = parse_int(stream)
-    return { 'size': n, 'data': stream.read(n) }
+    return { 'size': n, 'data': stream.read(n).tobytes() }
 
 def emit_chunk(ch):
     return ''.join([emit_int(ch['size']), ch['data']])
 
-MC_chunk = Parsem(parse_chunk, emit_chunk)
+def skip_chunk(stream):
+    stream.skip(parse_int(stream))
+
+MC_chunk = Parsem(parse_chunk, emit_chunk, skipper=skip_chunk)
+
+# Arrays of numbers are decoded and encoded in bulk with the array module,
+# byte-swapping multi-byte values on little-endian machines.
+SWAP_BYTES = sys.byteorder == 'little'
+
+def parse_array(stream, typecode, n):
+    """Read an array of n big-endian values of array typecode."""
+    a = array.array(typecode)
+    a.fromstring(stream.read(n * a.itemsize).tobytes())
+    if SWAP_BYTES and a.itemsize > 1:
+        a.byteswap()
+    return a
+
+def emit_array(typecode, values):
+    """Return values (an array or any sequence) as big-endian typecode values."""
+    if isinstance(values, array.array) and values.typecode == typecode:
+        a = values[:] # A slice copies in bulk; array(typecode, a) does not.
+    else:
+        a = array.array(typecode, values)
+    if SWAP_BYTES and a.itemsize > 1:
+        a.byteswap()
+    return a.tostring()
 
 def parse_multi_block_change(stream):
+    """Parse the changes of a Multi-block change message into arrays.
+
+    Each coord packs the block's position within its chunk as
+    x << 12 | z << 8 | y; see unpack_block_coords().
+    """
     n = parse_short(stream)
-    return {'coord_array': [parse_short(stream) for j in xrange(0,n)],
-            'type_array': [parse_byte(stream) for j in xrange(0,n)],
-            'metadata_array': [parse_byte(stream) for j in xrange(0,n)]}
+    return {'coord_array': parse_array(stream, 'h', n),
+            'type_array': parse_array(stream, 'b', n),
+            'metadata_array': parse_array(stream, 'b', n)}
 
 def emit_multi_block_change(changes):
     return ''.join([emit_short(len(changes['coord_array'])),
-                    ''.join([emit_short(x) for x in changes['coord_array']]),
-                    ''.join([emit_byte(x)  for x in changes['type_array']]),
-                    ''.join([emit_byte(x)  for x in changes['metadata_array']])])
+                    emit_array('h', changes['coord_array']),
+                    emit_array('b', changes['type_array']),
+                    emit_array('b', changes['metadata_array'])])
+
+HIGH_NIBBLES = ''.join(chr(i >> 4) for i in xrange(256))
+LOW_NIBBLES = ''.join(chr(i & 0x0f) for i in xrange(256))
+
+def unpack_block_coords(coord_array):
+    """Split a Multi-block change coord_array into x, y and z arrays.
+
+    Returns three arrays of unsigned bytes. The work is done on the
+    encoded bytes by string slicing and translation, not per element.
+    """
+    packed = emit_array('h', coord_array)
+    xz = packed[0::2]
+    return (array.array('B', xz.translate(HIGH_NIBBLES)),
+            array.array('B', packed[1::2]),
+            array.array('B', xz.translate(LOW_NIBBLES)))
 
-MC_multi_block_change = Parsem(parse_multi_block_change, emit_multi_block_change)
+def skip_multi_block_change(stream):
+    stream.skip(4*parse_short(stream))
+
+MC_multi_block_change = Parsem(parse_multi_block_change, emit_multi_block_change,
+                               skipper=skip_multi_block_change)
 
 def parse_explosion_records(stream):
     n = parse_int(stream)
@@ -314,7 +718,11 @@ def emit_explosion_records(msg):
                     ''.join([(emit_byte(rec[0]), emit_byte(rec[1]), emit_byte(rec[2]))
                              for rec in msg['data']])])
 
-MC_explosion_records = Parsem(parse_explosion_records, emit_explosion_records)
+def skip_explosion_records(stream):
+    stream.skip(3*parse_int(stream))
+
+MC_explosion_records = Parsem(parse_explosion_records, emit_explosion_records,
+                              skipper=skip_explosion_records)
 
 def parse_vehicle_data(stream):
     x = parse_int(stream)
@@ -338,13 +746,16 @@ def parse_item_data(stream):
     n = parse_unsigned_byte(stream)
     if n == 0:
         return ''
-    return stream.read(n)
+    return stream.read(n).tobytes()
 
 def emit_item_data(s):
     assert len(s) < 265
     return ''.join([emit_unsigned_byte(len(s)),s])
 
-MC_item_data = Parsem(parse_item_data, emit_item_data)
+def skip_item_data(stream):
+    stream.skip(parse_unsigned_byte(stream))
+
+MC_item_data = Parsem(parse_item_data, emit_item_data, skipper=skip_item_data)
 
 def parse_fireball_data(stream):
     data = {}
@@ -20,15 +20,21 @@
 When run as an mc3p plugin, dvr saves messages from a client or server to a file.
 When run as a stand-alone plugin, dvr replays those saved messages.
 
-Format of a message file:
-    <file> := <msg>*
-    <msg> := <size> <delay> BYTE+
-    <delay> := FLOAT
-    <size> := INT
+Messages are saved to CAPFILE.dvr, in the indexed format of mc3p.capture.
+Captures made by older versions, as CAPFILE.cli and CAPFILE.srv, can still
+be played back.
 
 When dvr is run stand-alone, it acts as both the minecraft client and server.
 It listens on a port as the server, and then connects as a client to mc3p.
 It then replays all recorded messages, from both the client and server.
+With a timescale of 0, messages are replayed as fast as possible.
+
+With -n N, dvr runs a load test instead: N clients replay the client side of
+the capture as users mc3p0 to mc3pN-1, starting at random times within
+--jitter seconds, and the mock server replays the server side for each of
+them. It then reports the aggregate throughput, the latency from server
+sends to client receives, and how far behind schedule messages were sent.
+Give mc3p a --backlog of at least N, or connections may stall.
 
 Command-line arguments:
 [-X SPEED_FACTOR]
@@ -37,13 +43,18 @@ MC3P_PORT
 FILE
 """
 
-import socket, asyncore, logging, logging.config, os.path, sys, optparse, time, struct
+import socket, asyncore, logging, logging.config, os.path, sys, optparse, time
+import collections, random, itertools, operator
 
 if __name__ == "__main__":
     mc3p_dir = os.path.dirname(os.path.abspath(os.path.join(__file__,'..')))
     sys.path.append(mc3p_dir)
 
 from mc3p.plugins import PluginError, MC3Plugin, msghdlr
+from mc3p import capture, eventloop, messages
+from mc3p.util import Stream, PartialPacketException
+from mc3p.parsing import parse_unsigned_byte
+from mc3p.eventloop import BufferedDispatcher
 
 logger = logging.getLogger('plugin.dvr')
 
@@ -55,13 +66,15 @@ class DVROptParser(optparse.OptionParser):
 
 class DVRPlugin(MC3Plugin):
 
+    # Recording never changes a message, so it need not hold up forwarding.
+    observer = True
+
     def init(self, args):
         self.cli_msgs = set()
         self.all_cli_msgs = False
-        self.cli_msgfile = None
         self.srv_msgs = set()
         self.all_srv_msgs = False
-        self.srv_msgfile = None
+        self.writer = None
         self.parse_plugin_args(args)
         logger.info('initialized')
         logger.debug('cli_msgs=%s, srv_msgs=%s' % \
@@ -76,6 +89,12 @@ class DVRPlugin(MC3Plugin):
         parser.add_option('-s', '--from-server', dest='srv_msgs',
                           default='', metavar='MSGS',
                           help='comma-delimited list of server message IDs')
+        parser.add_option('--codec', dest='codec', default='zlib',
+                          choices=sorted(capture.CODECS.keys()),
+                          help='compression of capture blocks: zlib, zstd or none')
+        parser.add_option('--flush-interval', dest='flush_interval', type='float',
+                          default=1.0, metavar='SECONDS',
+                          help='write buffered messages at least this often')
         # TODO: Add append/overwrite options.
 
         (opts, args) = parser.parse_args(argstr.split(' '))
@@ -102,52 +121,60 @@ class DVRPlugin(MC3Plugin):
         self.cli_msgs.add(0xff)
         self.srv_msgs.add(0xff)
 
-        self.cli_msgfile = open(capfile+'.cli', 'w')
         try:
-            self.srv_msgfile = open(capfile+'.srv', 'w')
-        except:
-            self.cli_msgfile.close()
+            self.writer = capture.CaptureWriter(capfile + capture.EXTENSION, opts.codec,
+                                                flush_interval=opts.flush_interval)
+        except (IOError, capture.CaptureError) as e:
+            raise PluginError("Cannot record to %s: %s" % (capfile, str(e)))
 
     def msg_id(self, s):
         base = 16 if s.startswith('0x') else 10
         try: return int(s, base)
         except: raise PluginError("Invalid message ID '%s'" % s)
 
-    def default_handler(self, msg, dir):
-        pid = msg['msgtype']
-        if 'client' == dir and (self.all_cli_msgs or pid in self.cli_msgs):
-            self.record_msg(msg, self.cli_msgfile)
-        if 'server' == dir and (self.all_srv_msgs or pid in self.srv_msgs):
-            self.record_msg(msg, self.srv_msgfile)
-        return True
+    def observe(self, batch):
+        for (t, dir, pid, bytes) in batch:
+            if 'client' == dir and (self.all_cli_msgs or pid in self.cli_msgs):
+                self.record_msg(t, dir, pid, bytes)
+            if 'server' == dir and (self.all_srv_msgs or pid in self.srv_msgs):
+                self.record_msg(t, dir, pid, bytes)
 
-    def record_msg(self, msg, file):
-        t = time.time() - self.t0
-        bytes = msg['raw_bytes']
-        hdr = struct.pack("<If", len(bytes), t)
-        file.write(hdr)
-        file.write(bytes)
-        logger.debug('at t=%f, wrote msg of type %d (%d bytes)' % \
-                     (t, msg['msgtype'], len(bytes)))
+    def record_msg(self, t, source, msgtype, bytes):
+        t -= self.t0
+        self.writer.write(t, source, bytes, msgtype)
+        logger.debug('at t=%f, recorded msg of type %d (%d bytes)' % \
+                     (t, msgtype, len(bytes)))
+
+    def destroy(self):
+        if self.writer:
+            self.writer.close()
 
 ### Playback ###################
 
-cli_done = False
-srv_done = False
+# Longest wait for the next timed message, in seconds.
+PLAYBACK_TICK = 0.005
 
 class MockListener(asyncore.dispatcher_with_send):
-    """Listen for client connection, and spawn MockServer."""
-    def __init__(self,host,port,msgfile,timescale):
-        self.msgfile = msgfile
+    """Listen for client connections, and spawn a MockServer for each of n.
+
+    msgs is a function returning a new iterable of messages for each server.
+    """
+    def __init__(self,host,port,msgs,timescale,n=1):
+        self.msgs = msgs
         self.timescale = timescale
+        self.n = n
+        self.servers = []
         asyncore.dispatcher_with_send.__init__(self)
         # Listen, and wait for connection.
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.set_reuse_addr()
         self.bind( (host, port) )
-        self.listen(1)
+        self.listen(n)
         logger.debug("listening on %s:%d" % (host, port))
 
+    def mock_server(self, sock):
+        return MockServer(sock, self.msgs(), 'server', self.timescale)
+
     def handle_accept(self):
         pair = self.accept()
         if pair == None:
@@ -156,66 +183,144 @@ class MockListener(asyncore.dispatcher_with_send):
         else:
             (sock, addr) = pair
             logger.debug("received client connection from %s" % repr(addr))
-            MockServer(sock, self.msgfile, 'server', self.timescale)
-            self.close()
-
-class MockServer(asyncore.dispatcher_with_send):
-    def __init__(self, sock, msgfile, name, timescale, close_on_ff=True):
-        asyncore.dispatcher_with_send.__init__(self, sock)
-        self.msgfile = msgfile
+            self.servers.append(self.mock_server(sock))
+            if len(self.servers) >= self.n:
+                self.close()
+
+class MockServer(BufferedDispatcher):
+    """Send messages, an iterable of (time, bytes), on sock at their times.
+
+    All messages that are due are sent at once, with a single send() of up
+    to SEND_SIZE bytes, and the next ones are only read once it has gone
+    out. A timescale of 0 sends every message as soon as the socket takes
+    it, to replay a session as fast as possible.
+
+    Once all messages are sent, the connection is closed, unless linger is
+    True, in which case it is kept open and read from until the peer closes.
+    """
+    def __init__(self, sock, msgs, name, timescale, close_on_ff=True, linger=False):
+        BufferedDispatcher.__init__(self, sock)
+        self.msgs = iter(msgs)
         self.name = name
         self.timescale = timescale
         self.close_on_ff = close_on_ff
+        self.linger = linger
         self.t0 = time.time() # start time
         self.nextmsg = None
         self.tnext = None
         self.closing = False
+        self.sent_msgs = 0
+        self.sent_bytes = 0
+        self.t_done = None
+        # How late batches went out, compared to their first message's time.
+        self.batches = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
 
     def handle_read(self):
         """Read and throw away incomming bytes."""
-        data = self.recv(4096)
+        data = self.recv(self.RECV_SIZE)
         logger.debug("%s read %d bytes" % (self.name, len(data)))
 
     def readmsg(self):
         """Set self.nextmsg, self.tnext, or self.closing if no more messages."""
-        nstr = self.msgfile.read(8)
-        if len(nstr) == 0:
+        msg = next(self.msgs, None)
+        if msg is None:
             self.closing = True
-            logger.debug('%s reached end of file' % self.name)
+            logger.debug('%s reached end of capture' % self.name)
         else:
-            n, self.tnext = struct.unpack("<If", nstr)
-            self.nextmsg = self.msgfile.read(n)
-            logger.debug('%s read %d bytes from file with t=%f' % (self.name, n, self.tnext))
+            self.tnext, self.nextmsg = msg
+
+    def send_due(self):
+        """Send all messages that are due, as one chunk."""
+        t = time.time() - self.t0
+        batch = bytearray()
+        n = 0
+        while len(batch) < self.SEND_SIZE and not self.closing:
+            if self.nextmsg is None:
+                self.readmsg()
+                continue
+            if self.tnext * self.timescale > t:
+                break
+            if n == 0:
+                lag = t - self.tnext * self.timescale
+            msgtype = ord(self.nextmsg[0])
+            batch += self.nextmsg
+            n += 1
+            self.nextmsg = None
+            if msgtype == 255 and self.close_on_ff:
+                self.closing = True
+        if batch:
+            logger.debug('%s sending %d messages (%d bytes) at t=%f',
+                         self.name, n, len(batch), t)
+            self.sent_msgs += n
+            self.sent_bytes += len(batch)
+            self.batches += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            self.send(batch)
 
     def readable(self):
-        return not self.closing and asyncore.dispatcher_with_send.readable(self)
+        return (self.linger or not self.closing) and BufferedDispatcher.readable(self)
+
+    def due(self):
+        """Return True if the next message should be sent by now."""
+        if self.nextmsg is None and not self.closing:
+            self.readmsg()
+        return self.nextmsg is not None and \
+               self.tnext * self.timescale <= time.time() - self.t0
 
     def writable(self):
+        # Sending is left to handle_write(), since a failed send closes the
+        # socket, which must not happen while the event loop polls.
         if self.closing:
+            return not self.linger or bool(self.out_chunks)
+        return self.due() or BufferedDispatcher.writable(self)
+
+    def handle_write(self):
+        if self.out_chunks:
+            self.initiate_send()
+        elif not self.closing:
+            self.send_due()
+        if self.closing and not self.out_chunks and not self.linger:
             logger.debug('%s closing connection' % self.name)
             self.close()
-        elif not self.nextmsg:
-            self.readmsg()
-        if self.nextmsg:
-            t = time.time() - self.t0
-            if t >= self.tnext * self.timescale:
-                msgtype = struct.unpack('>B', self.nextmsg[0])[0]
-                logger.info('%s sending msgtype %x (%d bytes) at t=%f',
-                            self.name, msgtype, len(self.nextmsg), t)
-                self.send(self.nextmsg)
-                msgtype = struct.unpack('>B', self.nextmsg[0])[0]
-                self.nextmsg = None
-                if msgtype == 255 and self.close_on_ff:
-                    self.closing = True
-        return not self.closing and asyncore.dispatcher_with_send.writable(self)
+
+    def close(self):
+        if self.t_done is None:
+            self.t_done = time.time()
+        BufferedDispatcher.close(self)
+
+    def report(self):
+        secs = max((self.t_done or time.time()) - self.t0, 1e-6)
+        return '%s sent %d messages (%d bytes) in %.3fs: %.0f msgs/s, %.1f MB/s' % \
+               (self.name, self.sent_msgs, self.sent_bytes, secs,
+                self.sent_msgs / secs, self.sent_bytes / secs / 1e6)
 
 
 class MockClient(MockServer):
-    def __init__(self,host, port, msgfile, timescale):
+    def __init__(self,host, port, msgs, timescale, linger=False):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         logger.debug("connecting to %s:%d" % (host,port))
         sock.connect( (host, port) )
-        MockServer.__init__(self, sock, msgfile, "client", timescale, False)
+        MockServer.__init__(self, sock, msgs, "client", timescale, False, linger)
+
+_readers = {} # { path -> CaptureReader }, shared by all sessions
+
+def capture_msgs(capfile, source):
+    """Return an iterable of the (time, bytes) of source's messages in capfile.
+
+    Messages of CAPFILE.dvr captures are buffers into the memory-mapped file.
+    """
+    path = capfile + capture.EXTENSION
+    if os.path.exists(path):
+        reader = _readers.get(path)
+        if reader is None:
+            reader = _readers[path] = capture.CaptureReader(path)
+        msgs = reader.messages(source=source, views=True)
+    else:
+        msgs = [m for m in capture.read_legacy(capfile) if m[1] == source]
+    return itertools.imap(operator.itemgetter(0, 3), msgs)
 
 def playback():
     # Parse arguments.
@@ -225,32 +330,219 @@ def playback():
     if opts.loglvl:
         logger.setLevel(getattr(logging, opts.loglvl.upper()))
 
-    # Open server message file.
+    if opts.clients:
+        load_test(opts, capfile)
+        return
+
+    # Open the capture.
     try:
-        srv_msgfile = open(capfile+'.srv', 'r')
+        srv_msgs = capture_msgs(capfile, 'server')
+        cli_msgs = capture_msgs(capfile, 'client')
     except Exception as e:
-        print "Could not open %s: %s" % (capfile+'.srv', str(e))
+        print "Could not open capture %s: %s" % (capfile, str(e))
         sys.exit(1)
 
     # Start listener, which will associate MockServer with socket on client connect.
     (srv_host, srv_port) = parse_addr(opts.srv_addr)
-    MockListener(srv_host, srv_port, srv_msgfile, opts.timescale)
+    listener = MockListener(srv_host, srv_port, lambda: srv_msgs, opts.timescale)
     print "Started server."
 
-    # Open client message file.
-    try:
-        cli_msgfile = open(capfile+'.cli', 'r')
-    except Exception as e:
-        print "Could not open %s: %s" % (opts.cli_msgfile, str(e))
-        sys.exit(1)
     # Start client.
     (cli_host, cli_port) = parse_addr(opts.mc3p_addr)
-    client = MockClient(cli_host, cli_port, cli_msgfile, opts.timescale)
+    client = MockClient(cli_host, cli_port, cli_msgs, opts.timescale)
     print "Started client."
 
-    # Loop until we're done.
-    asyncore.loop(0.1)
+    # Loop until we're done. The short timeout keeps timed messages on time.
+    eventloop.loop(timeout=PLAYBACK_TICK)
+
+    print client.report()
+    for server in listener.servers:
+        print server.report()
+    print "Done."
+
+### Load generation ############
+
+# Client handshake and login messages, which are the same in all versions.
+LOGIN_MSGS = messages.protocol[0][0]
+
+class LoadSession(object):
+    """One of the sessions of a load test: a LoadClient and its LoadServer.
+
+    The server records, for each batch it sends, the offset of its end in
+    the server's stream and the time it was sent. When the client has
+    received up to that offset, the batch's latency is known. This assumes
+    that the proxy forwards server messages unchanged.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.client = None
+        self.server = None
+        self.marks = collections.deque() # (end offset, send time)
+        self.received_bytes = 0
+        self.latencies = []
+
+    def sent(self, offset):
+        self.marks.append((offset, time.time()))
+
+    def received(self, n):
+        self.received_bytes += n
+        t = time.time()
+        while self.marks and self.marks[0][0] <= self.received_bytes:
+            self.latencies.append(t - self.marks.popleft()[1])
+
+
+class LoadListener(MockListener):
+    """Accept connections for the sessions of a load test."""
+    def __init__(self, host, port, msgs, timescale, n, sessions):
+        MockListener.__init__(self, host, port, msgs, timescale, n)
+        self.sessions = sessions
+
+    def mock_server(self, sock):
+        return LoadServer(sock, self.msgs(), self.timescale, self.sessions)
+
+
+class LoadServer(MockServer):
+    """A MockServer that starts once the client's handshake names its session."""
+    def __init__(self, sock, msgs, timescale, sessions):
+        MockServer.__init__(self, sock, msgs, 'server', timescale)
+        self.sessions = sessions
+        self.session = None
+        self.stream = Stream()
+
+    def handle_read(self):
+        data = self.recv(self.RECV_SIZE)
+        if self.session is not None or not data:
+            return
+        self.stream.append(data)
+        try:
+            if parse_unsigned_byte(self.stream) != 0x02:
+                raise ValueError("expected a handshake")
+            username = LOGIN_MSGS[0x02].parse(self.stream)['username']
+        except PartialPacketException:
+            self.stream.reset()
+            return
+        except Exception as e:
+            logger.error("server could not identify its client: %s" % str(e))
+            self.close()
+            return
+        self.session = self.sessions.get(username.split(';')[0])
+        if self.session is None:
+            logger.error("server got a handshake from unknown user %s" % username)
+            self.close()
+            return
+        self.session.server = self
+        self.name = 'server ' + self.session.name
+        self.t0 = time.time()
+
+    def writable(self):
+        return self.session is not None and MockServer.writable(self)
+
+    def send(self, data):
+        self.session.sent(self.sent_bytes)
+        MockServer.send(self, data)
+
+
+class LoadClient(MockServer):
+    """A mock client that reports received bytes to its LoadSession.
+
+    It connects without blocking the other sessions, and lingers once its
+    messages are sent, so that it receives everything the server sends,
+    until mc3p closes the session.
+    """
+    def __init__(self, host, port, msgs, timescale, session):
+        MockServer.__init__(self, None, msgs, 'client ' + session.name, timescale,
+                            False, linger=True)
+        self.session = session
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect( (host, port) )
+
+    def handle_connect(self):
+        self.t0 = time.time()
+
+    def handle_read(self):
+        data = self.recv(self.RECV_SIZE)
+        self.session.received(len(data))
+
+
+def rename(msgs, username):
+    """Return msgs, with username in the client's 0x02 and 0x01 messages."""
+    msgs = iter(msgs)
+    head = []
+    for (t, data) in msgs:
+        if data[0] in '\x01\x02':
+            stream = Stream()
+            stream.append(str(data))
+            msgtype = parse_unsigned_byte(stream)
+            msg = LOGIN_MSGS[msgtype].parse(stream)
+            name = msg['username']
+            msg['username'] = unicode(username) + name[len(name.split(';')[0]):]
+            data = LOGIN_MSGS[msgtype].emit(msg)
+        head.append((t, data))
+        if data[0] == '\x01':
+            break
+    return itertools.chain(head, msgs)
+
+def percentile(values, p):
+    """Return the p-th percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def load_report(sessions, elapsed, timescale):
+    """Return the aggregate results of a load test, as a list of lines."""
+    elapsed = max(elapsed, 1e-6)
+    clients = [s.client for s in sessions if s.client]
+    servers = [s.server for s in sessions if s.server]
+    lines = ['%d sessions in %.3fs, %d served' % (len(sessions), elapsed, len(servers))]
+    for (name, peers) in (('clients', clients), ('servers', servers)):
+        msgs = sum(p.sent_msgs for p in peers)
+        nbytes = sum(p.sent_bytes for p in peers)
+        lines.append('%s sent %d messages (%d bytes): %.0f msgs/s, %.2f MB/s' % \
+                     (name, msgs, nbytes, msgs / elapsed, nbytes / elapsed / 1e6))
+    latencies = sorted(l for s in sessions for l in s.latencies)
+    lines.append('server to client latency over %d batches: ' % len(latencies) + \
+                 'p50 %.2fms, p90 %.2fms, p99 %.2fms, max %.2fms' % \
+                 tuple(1e3 * percentile(latencies, p) for p in (50, 90, 99, 100)))
+    if timescale:
+        peers = clients + servers
+        batches = sum(p.batches for p in peers) or 1
+        worst = max(peers, key=lambda p: p.max_lag) if peers else None
+        lines.append('behind schedule: mean %.2fms, max %.2fms (%s)' % \
+                     (1e3 * sum(p.total_lag for p in peers) / batches,
+                      1e3 * (worst.max_lag if worst else 0.0),
+                      worst.name if worst else '-'))
+    return lines
+
+def load_test(opts, capfile):
+    """Replay capfile as opts.clients concurrent sessions through mc3p."""
+    n = opts.clients
+    sessions = {}
+    (srv_host, srv_port) = parse_addr(opts.srv_addr)
+    listener = LoadListener(srv_host, srv_port, lambda: capture_msgs(capfile, 'server'),
+                            opts.timescale, n, sessions)
+    (cli_host, cli_port) = parse_addr(opts.mc3p_addr)
 
+    r = random.Random(opts.seed)
+    pending = collections.deque(sorted(r.uniform(0, opts.jitter) for i in xrange(n)))
+    print "Starting %d clients over %.1fs." % (n, opts.jitter)
+    t0 = time.time()
+    while pending or any(obj is not listener for obj in asyncore.socket_map.values()):
+        while pending and time.time() - t0 >= pending[0]:
+            pending.popleft()
+            name = 'mc3p%d' % len(sessions)
+            session = sessions[name] = LoadSession(name)
+            try:
+                session.client = LoadClient(cli_host, cli_port,
+                                            rename(capture_msgs(capfile, 'client'), name),
+                                            opts.timescale, session)
+            except socket.error as e:
+                logger.error("%s could not connect: %s" % (name, str(e)))
+        eventloop.loop(timeout=PLAYBACK_TICK, count=1)
+    elapsed = time.time() - t0
+    listener.close()
+
+    for line in load_report(sessions.values(), elapsed, opts.timescale):
+        print line
     print "Done."
 
 def parse_args():
@@ -264,8 +556,9 @@ def parse_args():
     else:
         capfile = args[0]
 
-    check_path(parser, capfile+'.srv')
-    check_path(parser, capfile+'.cli')
+    if not os.path.exists(capfile + capture.EXTENSION):
+        check_path(parser, capfile+'.srv')
+        check_path(parser, capfile+'.cli')
 
     return opts, capfile
 
@@ -293,7 +586,7 @@ def parse_addr(addr):
 def make_arg_parser():
     parser = optparse.OptionParser(
         usage="usage: %prog [--to [HOST:]PORT] [--via [HOST:]PORT] " +\
-              "[-x FACTOR] CAPFILE")
+              "[-x FACTOR] [-n CLIENTS [--jitter SECONDS]] CAPFILE")
     parser.add_option('--via', dest='mc3p_addr',
                       type='string', metavar='[HOST:]PORT',
                       help='mc3p address', default='localhost:34343')
@@ -302,7 +595,16 @@ def make_arg_parser():
                       default='localhost:25565')
     parser.add_option('-x', '--timescale', dest='timescale', type='float',
                       metavar='FACTOR', default=1.0,
-                      help='scale time between messages by FACTOR')
+                      help='scale time between messages by FACTOR, ' +\
+                           'or 0 to send them as fast as possible')
+    parser.add_option('-n', '--clients', dest='clients', type='int',
+                      metavar='N', default=None,
+                      help='load test: replay CAPFILE as N concurrent sessions')
+    parser.add_option('--jitter', dest='jitter', type='float',
+                      metavar='SECONDS', default=1.0,
+                      help='load test: spread client starts over SECONDS')
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help='load test: random seed of client start times')
     parser.add_option("-l", "--log-level", dest="loglvl", metavar="LEVEL",
                       choices=["debug","info","warn","error"], default=None,
                       help="Override logging.conf root log level")
@@ -0,0 +1,47 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Count the messages of every type passing through the proxy.
+
+Every message is forwarded unchanged. When the session ends, the number of
+messages and bytes seen for each msgtype is logged. Since it inspects every
+message, the plugin is also a convenient worst case for benchmarking.
+"""
+
+import logging
+
+from mc3p.plugins import MC3Plugin
+
+logger = logging.getLogger('plugin.stats')
+
+class StatsPlugin(MC3Plugin):
+
+    def init(self, args):
+        self.counts = {} # { (source, msgtype) -> [messages, bytes] }
+
+    def default_handler(self, msg, source):
+        key = (source, msg['msgtype'])
+        c = self.counts.get(key)
+        if c is None:
+            c = self.counts[key] = [0, 0]
+        c[0] += 1
+        c[1] += len(msg.get('raw_bytes', ''))
+        return True
+
+    def destroy(self):
+        for ((source, msgtype), (n, nbytes)) in sorted(self.counts.items()):
+            logger.info('%s 0x%02x: %d messages, %d bytes' % (source, msgtype, n, nbytes))
@@ -23,11 +23,16 @@ import logging
 import traceback
 import imp
 import inspect
-import multiprocessing
-import Queue
+import collections
 import messages
+import metrics
+import world
+import entities
+import workers
 import traceback
 
+from time import time
+
 from util import Stream, PartialPacketException
 from parsing import *
 
@@ -61,6 +66,9 @@ class PluginConfig(object):
         self.__plugin_names = {}  # { id -> plugin_name }
         self.__argstrs = {}       # { id -> argstr }
         self.__orderings = {}     # { msgtype -> [id1, id2, ...] }
+        self.__workers = set()    # ids of instances run in worker processes
+        # Seconds to wait for the verdict of a plugin run in a worker.
+        self.worker_timeout = workers.WORKER_TIMEOUT
 
     def __default_id(self, plugin_name):
         id = plugin_name
@@ -89,6 +97,18 @@ class PluginConfig(object):
         self.__orderings[msgtype] = id_list
         return self
 
+    def run_in_worker(self, id):
+        """Run instance id in a worker process; see mc3p.workers."""
+        if not id in self.__ids:
+            raise ConfigError("No such id: '%s'" % id)
+        self.__workers.add(id)
+        return self
+
+    @property
+    def workers(self):
+        """Set of ids of instances run in worker processes."""
+        return set(self.__workers)
+
     @property
     def ids(self):
         """List of instance ids."""
@@ -121,9 +141,88 @@ class PluginConfig(object):
             return o
 
 
+class InjectionChannel(asyncore.dispatcher):
+    """Queue of encoded messages injected by plugins into one direction.
+
+    put() may be called from any thread. The first message queued after a
+    delivery writes a byte to a socket pair whose other end is watched by the
+    asyncore loop, so the loop wakes up and calls on_ready() even when the
+    connection is otherwise quiet. Platforms without socket.socketpair()
+    only deliver messages when packets arrive from the injecting side.
+    """
+
+    def __init__(self, on_ready=None):
+        self.__queue = collections.deque()
+        self.__signalled = False
+        self.on_ready = on_ready
+
+        # Delivery statistics: message count, and enqueue-to-send latency.
+        self.delivered = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+        if hasattr(socket, 'socketpair'):
+            rsock, self.__wsock = socket.socketpair()
+            asyncore.dispatcher.__init__(self, rsock)
+        else:
+            asyncore.dispatcher.__init__(self)
+            self.__wsock = None
+
+    def put(self, msgbytes):
+        """Queue msgbytes for injection, and wake up the event loop."""
+        self.__queue.append((time(), msgbytes))
+        if self.__wsock and not self.__signalled:
+            self.__signalled = True
+            try:
+                self.__wsock.send('x')
+            except socket.error:
+                pass # Channel was closed.
+
+    def get_all(self):
+        """Dequeue all pending messages, and return them as one string.
+
+        Returns None if no messages are pending.
+        """
+        if not self.__queue:
+            return None
+        now = time()
+        parts = []
+        while self.__queue:
+            (t, msgbytes) = self.__queue.popleft()
+            latency = now - t
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+            if metrics.enabled:
+                metrics.injection_latency.observe(latency)
+            parts.append(msgbytes)
+        self.delivered += len(parts)
+        return ''.join(parts)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        self.__signalled = False
+        if self.__queue and self.on_ready:
+            self.on_ready()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        if self.__wsock:
+            self.__wsock.close()
+            self.__wsock = None
+        asyncore.dispatcher.close(self)
+
+
 class PluginManager(object):
     """Manage plugins for an mc3p session."""
-    def __init__(self, config, cli_proxy, srv_proxy):
+    def __init__(self, config, cli_proxy, srv_proxy, world_cache_size=None):
         # Map of plugin name to module.
         self.__plugins = {}
 
@@ -141,24 +240,114 @@ class PluginManager(object):
         self.__msgbuf = []
 
         # For asynchronously injecting messages from the client or server.
-        self.__from_client_q = multiprocessing.Queue()
-        self.__from_server_q = multiprocessing.Queue()
+        # Each channel wakes up the proxy for its source side.
+        self.__from_client_q = InjectionChannel(
+            lambda: cli_proxy.send_injected_msgs())
+        self.__from_server_q = InjectionChannel(
+            lambda: srv_proxy.send_injected_msgs())
 
         # Plugin configuration.
         self.__config = config
 
-    def next_injected_msg_from(self, source):
-        """Return the Queue containing source's messages to be injected."""
+        # Set of msgtypes inspected by some plugin instance, or None if
+        # every msgtype must be decoded.
+        self.__inspected = None
+
+        # For each msgtype, the ordered tuple of instance handlers to call.
+        self.__dispatch = [()] * 256
+
+        # SessionProfile that times plugin handlers, if profiling is on.
+        self.__profile = None
+
+        # WorldCache shared by all instances, if one of them uses it.
+        self.__world = None
+        self.__world_cache_size = world_cache_size
+
+        # EntityTracker shared by all instances, if one of them uses it.
+        self.__entities = None
+
+        # Observer instances, with the set of msgtypes each inspects (None
+        # for all of them), in configured order.
+        self.__observers = []
+
+        # Set of msgtypes some observer inspects.
+        self.__observed = frozenset()
+
+        # Forwarded messages queued for observers until the next flush(),
+        # as (t, source, msgtype, raw_bytes).
+        self.__batch = []
+
+    def injection_channel(self, source):
+        """Return the InjectionChannel holding source's messages to be injected."""
         if source == 'client':
-            q = self.__from_client_q
+            return self.__from_client_q
         elif source == 'server':
-            q = self.__from_server_q
+            return self.__from_server_q
         else:
             raise Exception('Unrecognized source ' + source)
-        try:
-            return q.get(block=False)
-        except Queue.Empty:
-            return None
+
+    @property
+    def inspected(self):
+        """Set of msgtypes that some plugin instance inspects.
+
+        None means that every message must be decoded, which is always the
+        case until the handshake has completed. Messages of other types
+        need not be passed to filter().
+        """
+        return self.__inspected
+
+    @property
+    def observed(self):
+        """Set of msgtypes that some observer instance inspects.
+
+        Forwarded messages of these types are to be passed to observe().
+        """
+        return self.__observed
+
+    def set_profile(self, profile):
+        """Time plugin handlers in profile, or stop timing them if None."""
+        self.__profile = profile
+        if self.__session_active and self.__instances:
+            self._build_dispatch()
+
+    def _build_dispatch(self):
+        """Recompute the dispatch table and self.inspected.
+
+        For every msgtype, collect (in configured order) only the handlers
+        of instances that actually look at that msgtype, so that filtering
+        costs nothing for plugins that ignore it. Observers are left out,
+        and only get forwarded messages through observe().
+        """
+        dispatch = []
+        for msgtype in xrange(256):
+            hdlrs = []
+            for id in self.__config.ordering(msgtype):
+                inst = self.__instances.get(id, None)
+                hdlr = inst and not inst.observer and inst._dispatcher(msgtype)
+                if hdlr and metrics.enabled:
+                    hdlr = metrics.timed(hdlr, id)
+                if hdlr and self.__profile:
+                    hdlr = self.__profile.timed(hdlr, 'plugin ' + id, msgtype)
+                if hdlr:
+                    hdlrs.append(hdlr)
+            dispatch.append(tuple(hdlrs))
+        self.__dispatch = dispatch
+        self.__inspected = frozenset(t for t in xrange(256) if dispatch[t])
+        if self.__world is not None:
+            self.__inspected |= world.MSGTYPES
+        if self.__entities is not None:
+            self.__inspected |= entities.MSGTYPES
+        self.__observers = []
+        observed = set()
+        for id in self.__config.ids:
+            inst = self.__instances.get(id, None)
+            if inst and inst.observer:
+                msgtypes = inst._inspected_msgtypes()
+                if msgtypes is not None:
+                    msgtypes = frozenset(msgtypes)
+                self.__observers.append((id, inst, msgtypes))
+                observed.update(xrange(256) if msgtypes is None else msgtypes)
+        self.__observed = frozenset(observed)
 
     def _load_plugins(self):
         """Load or reload all plugins."""
@@ -190,6 +379,14 @@ class PluginManager(object):
                 continue
             else:
                 self._instantiate_one(id, pname)
+        if any(inst.uses_world for inst in self.__instances.values()):
+            self.__world = world.WorldCache(self.__world_cache_size)
+            for inst in self.__instances.values():
+                inst.world = self.__world
+        if any(inst.uses_entities for inst in self.__instances.values()):
+            self.__entities = entities.EntityTracker()
+            for inst in self.__instances.values():
+                inst.entities = self.__entities
 
     def _find_plugin_class(self, pname):
         """Return the subclass of MC3Plugin in pmod."""
@@ -214,18 +411,63 @@ class PluginManager(object):
         if None == clazz:
             return
         try:
-            logger.debug("  Instantiating plugin '%s' as '%s'" % (pname, id))
-            inst = clazz(self.__proto_version,
-                         self.__from_client_q,
-                         self.__from_server_q)
+            if self._runs_in_worker(id, clazz):
+                logger.debug("  Starting plugin '%s' as '%s' in a worker" % (pname, id))
+                inst = workers.WorkerPlugin(clazz, pname, id, self.__proto_version,
+                                            self.__from_client_q, self.__from_server_q,
+                                            self.__config.worker_timeout)
+            else:
+                logger.debug("  Instantiating plugin '%s' as '%s'" % (pname, id))
+                inst = clazz(self.__proto_version,
+                             self.__from_client_q,
+                             self.__from_server_q)
             inst.init(self.__config.argstr[id])
             self.__instances[id] = inst
         except Exception as e:
             logger.error("Failed to instantiate '%s': %s" % (id, str(e)))
 
+    def _runs_in_worker(self, id, clazz):
+        """Return True if instance id of plugin class clazz is to run in a worker."""
+        if not id in self.__config.workers:
+            return False
+        if not workers.supported():
+            logger.error("Worker processes are not supported here, running '%s' in-process" % id)
+            return False
+        if clazz.uses_world or clazz.uses_entities:
+            logger.error("'%s' uses the session's world or entities, running it in-process" % id)
+            return False
+        return True
+
+    def observe(self, msgtype, msgbytes, source):
+        """Queue a forwarded message of an observed msgtype, until flush()."""
+        self.__batch.append((time(), source, msgtype, msgbytes))
+
+    def flush(self):
+        """Hand the messages queued for observers over to them.
+
+        The proxy calls this once the messages of each read are forwarded.
+        """
+        if not self.__batch:
+            return
+        batch, self.__batch = self.__batch, []
+        for (id, inst, msgtypes) in self.__observers:
+            if msgtypes is None:
+                msgs = batch
+            else:
+                msgs = [m for m in batch if m[2] in msgtypes]
+            if not msgs:
+                continue
+            try:
+                inst.observe(msgs)
+            except:
+                logger.error("Error in observer '%s':\n%s" % (id, traceback.format_exc()))
+
     def destroy(self):
-        """Destroy plugin instances."""
+        """Destroy plugin instances and injection channels."""
+        self.__from_client_q.close()
+        self.__from_server_q.close()
         if self.__session_active:
+            self.flush()
             self.__plugins = {}
             logger.info("%s destroying plugin instances" % repr(self))
             for iname in self.__instances:
@@ -238,6 +480,11 @@ class PluginManager(object):
                                  (iname, self.__config.plugin[iname]))
                     logger.error(traceback.format_exc())
             self.__instances = {}
+            self.__observers = []
+            self.__observed = frozenset()
+            self.__dispatch = [()] * 256
+            self.__world = None
+            self.__entities = None
 
     def filter(self, msg, source):
         """Filter msg through the configured plugins.
@@ -245,14 +492,13 @@ class PluginManager(object):
         Returns True if msg should be forwarded, False otherwise.
         """
         if self.__session_active:
-            if self.__msgbuf:
-                # Re-play handshake messages to the plugins,
-                # ignoring return values since the messages have
-                # already been sent and so cannot be filtered.
-                for (_msg, _source) in self.__msgbuf:
-                    self._call_plugins(_msg, _source)
-                self.__msgbuf = None
-            return self._call_plugins(msg, source)
+            forward = self._call_plugins(msg, source)
+            if forward and source == 'server':
+                if self.__world is not None:
+                    self.__world.update(msg)
+                if self.__entities is not None:
+                    self.__entities.update(msg)
+            return forward
         else:
             if 0x01 == msg['msgtype']:
                 if 'client' == source:
@@ -264,14 +510,29 @@ class PluginManager(object):
                     self.__session_active = True
                     self._load_plugins()
                     self._instantiate_all()
+                    self._build_dispatch()
             self.__msgbuf.append((msg, source))
+            if self.__session_active:
+                self._replay_handshake()
             return True
 
+    def _replay_handshake(self):
+        """Re-play handshake messages to the plugins.
+
+        Return values are ignored, since the messages have already
+        been sent and so cannot be filtered. Observers get the messages
+        whose raw bytes are known.
+        """
+        for (_msg, _source) in self.__msgbuf:
+            self._call_plugins(_msg, _source)
+            msgtype, msgbytes = _msg['msgtype'], _msg.get('raw_bytes')
+            if msgbytes is not None and msgtype in self.__observed:
+                self.observe(msgtype, msgbytes, _source)
+        self.__msgbuf = None
+
     def _call_plugins(self, msg, source):
-        msgtype = msg['msgtype']
-        for id in self.__config.ordering(msgtype):
-            inst = self.__instances.get(id, None)
-            if inst and not inst.filter(msg, source):
+        for hdlr in self.__dispatch[msg['msgtype']]:
+            if not hdlr(msg, source):
                 return False
         return True
 
@@ -299,10 +560,36 @@ def msghdlr(*msgtypes):
 
 
 class MC3Plugin(object):
-    """Base class for mc3p plugins."""
+    """Base class for mc3p plugins.
+
+    A plugin class that sets uses_world to True gets a world.WorldCache of
+    the blocks forwarded to the client in self.world, shared with all other
+    plugin instances of the session. It is available from the first message
+    handled (not yet in init()), and is updated once every plugin has
+    forwarded a message. Otherwise, self.world is None unless another
+    plugin of the session uses it.
+
+    Likewise, a plugin class that sets uses_entities to True gets the
+    session's entities.EntityTracker in self.entities, which knows the
+    position of every entity the client was told about.
+
+    A plugin class that sets observer to True only watches messages: it
+    never drops or changes them, so it is not called while they are being
+    forwarded. Instead, the messages it inspects are queued once forwarded,
+    and passed to its observe() method in batches, when the proxy is done
+    with a read. Run in a worker process, it gets them through shared
+    memory (see mc3p.workers).
+    """
+
+    uses_world = False
+    uses_entities = False
+    observer = False
 
     def __init__(self, proto_version, from_client, from_server):
+        self.world = None
+        self.entities = None
         self.__proto_version = proto_version
+        self.__msg_specs = None # { source -> message Parsems }, on first use.
         self.__to_client = from_server
         self.__to_server = from_client
         self.__hdlrs = {}
@@ -327,6 +614,57 @@ class MC3Plugin(object):
                 logger.debug('  registered handler %s for %x' \
                              % (name, msgtype))
 
+    def _inspected_msgtypes(self):
+        """Return the set of msgtypes this instance handles.
+
+        Returns None if default_handler is overridden, or observe for an
+        observer, since it then inspects every msgtype.
+        """
+        return self._class_inspected_msgtypes()
+
+    @classmethod
+    def _class_inspected_msgtypes(cls):
+        """Return what _inspected_msgtypes() returns for instances of cls."""
+        if cls.default_handler.im_func is not MC3Plugin.default_handler.im_func:
+            return None
+        if cls.observer and cls.observe.im_func is not MC3Plugin.observe.im_func:
+            return None
+        return set(msgtype for wrapper in cls.__dict__.values()
+                   if isinstance(wrapper, MsgHandlerWrapper)
+                   for msgtype in wrapper.msgtypes)
+
+    def _dispatcher(self, msgtype):
+        """Return a callable that filters messages of msgtype.
+
+        Returns None if this instance ignores msgtype entirely.
+        """
+        if self._inspected_msgtypes() is None:
+            # Only the default handler applies to msgtypes without their own.
+            return self.filter if msgtype in self.__hdlrs else self._call_default
+        hdlr = self.__hdlrs.get(msgtype, None)
+        if hdlr is None:
+            return None
+        return lambda msg, source: self._call_hdlr(hdlr, msg, source)
+
+    def _call_default(self, msg, source):
+        """Call default_handler, logging any exception it raises."""
+        try:
+            return self.default_handler(msg, source)
+        except:
+            logger.error('Error in default handler of plugin %s:\n%s' % \
+                         (self.__class__.__name__, traceback.format_exc()))
+            return True
+
+    def _call_hdlr(self, hdlr, msg, source):
+        """Call message handler hdlr, logging any exception it raises."""
+        try:
+            return hdlr(self, msg, source)
+        except:
+            logger.error('Error in handler %s of plugin %s: %s' % \
+                         (hdlr.__name__, self.__class__.__name__,
+                          traceback.format_exc()))
+            return True
+
     def init(self, args):
         """Initialize plugin instance.
         Override to provide subclass-specific initialization."""
@@ -337,13 +675,24 @@ class MC3Plugin(object):
 
     def _destroy(self):
         """Internal cleanup, do not override."""
-        self.__to_client.close()
-        self.__to_server.close()
         self.destroy()
 
+    def __specs(self, source):
+        """Return the message Parsems of source, by msgtype."""
+        if self.__msg_specs is None:
+            cli_msgs, srv_msgs = messages.tables(self.__proto_version)
+            self.__msg_specs = {'client': cli_msgs, 'server': srv_msgs}
+        return self.__msg_specs[source]
+
+    def __decode_msg(self, source, msgbytes):
+        stream = Stream()
+        stream.append(msgbytes)
+        msg = self.__specs(source)[parse_unsigned_byte(stream)].parse(stream)
+        msg['raw_bytes'] = msgbytes
+        return msg
+
     def __encode_msg(self, source, msg):
-        cli_msgs, srv_msgs = messages.protocol[self.__proto_version]
-        msg_spec = cli_msgs if source == 'client' else srv_msgs
+        msg_spec = self.__specs(source)
 
         if 'msgtype' not in msg:
             logger.error("Plugin %s tried to send message without msgtype." %\
@@ -385,6 +734,23 @@ class MC3Plugin(object):
         Override in subclass to filter all message types."""
         return True
 
+    def observe(self, batch):
+        """Watch a batch of forwarded messages, if this is an observer.
+
+        batch is a list of (t, source, msgtype, raw_bytes), in the order
+        the messages were forwarded at time t. By default, each message is
+        decoded and passed to filter(), whose verdict is ignored. Override
+        in subclass to work on raw bytes, which saves decoding messages.
+        """
+        for (t, source, msgtype, msgbytes) in batch:
+            try:
+                msg = self.__decode_msg(source, msgbytes)
+            except Exception:
+                logger.error('Plugin %s could not decode message %x:\n%s' % \
+                             (self.__class__.__name__, msgtype, traceback.format_exc()))
+                continue
+            self.filter(msg, source)
+
     def filter(self, msg, source):
         """Filter msg via the appropriate message handler(s).
 
@@ -400,14 +766,7 @@ class MC3Plugin(object):
                          (self.__class__.__name__, traceback.format_exc()))
             return True
 
-        try:
-            if msgtype in self.__hdlrs:
-                return self.__hdlrs[msgtype](self, msg, source)
-            else:
-                return True
-        except:
-            hdlr = self.__hdlrs[msgtype]
-            logger.error('Error in handler %s of plugin %s: %s' % \
-                         (hdlr.__name__, self.__class__.__name__,
-                          traceback.format_exc()))
+        if msgtype in self.__hdlrs:
+            return self._call_hdlr(self.__hdlrs[msgtype], msg, source)
+        else:
             return True
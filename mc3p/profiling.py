@@ -0,0 +1,85 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Scoped profiling of packet processing, one profile per session.
+
+A SessionProfile records how often, and for how long, a session parsed and
+emitted each msgtype, and how long each plugin instance spent handling it.
+Unlike cProfile, only these scopes are timed, and only while a profile is
+attached, so profiling can be switched on and off in a running proxy.
+"""
+
+import os, logging
+from time import time, strftime
+
+logger = logging.getLogger("mc3p")
+
+class SessionProfile(object):
+    """Time spent per (scope, msgtype) in one session."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time()
+        self.stats = {} # { (scope, msgtype) -> [calls, seconds] }
+
+    def add(self, scope, msgtype, seconds):
+        s = self.stats.get((scope, msgtype))
+        if s is None:
+            s = self.stats[(scope, msgtype)] = [0, 0.0]
+        s[0] += 1
+        s[1] += seconds
+
+    def timed(self, hdlr, scope, msgtype):
+        """Wrap a plugin dispatch callable so that its run time is recorded."""
+        stat = self.stats.setdefault((scope, msgtype), [0, 0.0])
+        def timed_hdlr(msg, source):
+            t = time()
+            try:
+                return hdlr(msg, source)
+            finally:
+                stat[0] += 1
+                stat[1] += time() - t
+        return timed_hdlr
+
+    def report(self):
+        """Return the profile as a table, most expensive scope first."""
+        elapsed = time() - self.start_time
+        rows = [(secs, scope, msgtype, calls)
+                for ((scope, msgtype), (calls, secs)) in self.stats.items() if calls]
+        rows.sort(reverse=True)
+        total = sum(r[0] for r in rows) or 1.0
+        lines = ['Profile of session %s over %.1fs (%.3fs profiled)' % \
+                     (self.name, elapsed, sum(r[0] for r in rows)),
+                 '%-24s %7s %10s %12s %10s %6s' % \
+                     ('scope', 'msgtype', 'calls', 'total ms', 'avg us', '%')]
+        for (secs, scope, msgtype, calls) in rows:
+            lines.append('%-24s %7s %10d %12.3f %10.2f %6.2f' % \
+                         (scope, '0x%02x' % msgtype, calls, 1e3 * secs,
+                          1e6 * secs / calls, 100 * secs / total))
+        return '\n'.join(lines) + '\n'
+
+    def write_report(self, dir):
+        """Write report() to a new file in dir, and return its path."""
+        path = os.path.join(dir, 'mc3p-profile-%s-%s.txt' % \
+                            (self.name, strftime('%Y%m%d-%H%M%S')))
+        f = open(path, 'w')
+        try:
+            f.write(self.report())
+        finally:
+            f.close()
+        logger.warn("Wrote profile of session %s to %s" % (self.name, path))
+        return path
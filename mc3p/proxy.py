@@ -17,18 +17,27 @@
 
 import logging, logging.config, os
 import asyncore, socket, sys, signal, struct, logging.config, re, os.path, inspect, imp
-import traceback, tempfile
+import traceback, tempfile, operator
 from time import time, sleep
 from optparse import OptionParser
 
 import messages
-from plugins import PluginConfig, PluginManager
-from parsing import parse_unsigned_byte, parse_int
+import eventloop
+import metrics
+import workers
+from profiling import SessionProfile
+from eventloop import BufferedDispatcher
+from plugins import PluginConfig, PluginManager, ConfigError
+from world import WorldCache
+from parsing import parse_unsigned_byte, parse_int, Record
 from util import Stream, PartialPacketException
 import util
 
 logger = logging.getLogger("mc3p")
 
+# The msgtypes observed when there is no PluginManager.
+NOTHING = frozenset()
+
 def sigint_handler(signum, stack):
     print "Received signal %d, shutting down" % signum
     sys.exit(0)
@@ -38,8 +47,8 @@ def parse_args():
     """Return host and port, or print usage and exit."""
     usage = "usage: %prog [options] host [port]"
     desc = """
-Create a Minecraft proxy listening for a client connection,
-and forward that connection to <host>:<port>."""
+Create a Minecraft proxy listening for client connections,
+and forward each connection to <host>:<port>."""
     parser = OptionParser(usage=usage,
                           description=desc)
     parser.add_option("-l", "--log-level", dest="loglvl", metavar="LEVEL",
@@ -49,10 +58,39 @@ and forward that connection to <host>:<port>."""
                       help="logging configuration file (optional)")
     parser.add_option("-p", "--local-port", dest="locport", metavar="PORT", default="34343",
                       type="int", help="Listen on this port")
+    parser.add_option("--backlog", dest="backlog", metavar="N", default="5",
+                      type="int", help="Queue up to N pending client connections")
+    parser.add_option("--max-sessions", dest="max_sessions", metavar="N", default="0",
+                      type="int", help="Refuse clients while N sessions are active (0 = no limit)")
+    parser.add_option("--max-buffer", dest="max_buffer", metavar="BYTES",
+                      default=str(1024*1024), type="int",
+                      help="Stop reading from a peer while more than BYTES are " +
+                           "waiting to be sent to the other peer")
+    parser.add_option("--event-loop", dest="event_loop", metavar="LOOP",
+                      choices=eventloop.LOOPS, default=eventloop.default_loop(),
+                      help="I/O event loop: epoll, poll or select (default %default)")
+    parser.add_option("--metrics-port", dest="metrics_port", metavar="PORT",
+                      default=None, type="int",
+                      help="Collect metrics, and serve them on localhost:PORT")
+    parser.add_option("--world-cache-size", dest="world_cache_size", metavar="MB",
+                      default=None, type="int",
+                      help="Memory for the blocks cached for plugins, per session " +
+                           "(default %d)" % (WorldCache.DEFAULT_MAX_BYTES // (1024*1024)))
+    parser.add_option("--no-relay", dest="relay", action="store_false", default=True,
+                      help="Parse every packet, even when no plugins are configured")
     parser.add_option("--plugin", dest="plugins", metavar="ID:PLUGIN(ARGS)", type="string",
                       action="append", help="Configure a plugin", default=[])
+    parser.add_option("--worker", dest="workers", metavar="ID", type="string",
+                      action="append", default=[],
+                      help="Run plugin ID in a worker process")
+    parser.add_option("--worker-timeout", dest="worker_timeout", metavar="SECONDS",
+                      default=str(workers.WORKER_TIMEOUT), type="float",
+                      help="Forward a message unfiltered when a worker takes longer " +
+                           "than SECONDS to decide on it (default %default)")
     parser.add_option("--profile", dest="perf_data", metavar="FILE", default=None,
                       help="Enable profiling, save profiling data to FILE")
+    parser.add_option("--profile-dir", dest="profile_dir", metavar="DIR", default=".",
+                      help="Write per-session profiles, toggled by SIGUSR1, to DIR")
     (opts,args) = parser.parse_args()
 
     if not 1 <= len(args) <= 2:
@@ -77,6 +115,12 @@ and forward that connection to <host>:<port>."""
             parts = {'argstr': ''}
             parts.update(m.groupdict())
             pcfg.add(**parts)
+    for id in opts.workers:
+        try:
+            pcfg.run_in_worker(id)
+        except ConfigError as e:
+            parser.error(str(e))
+    pcfg.worker_timeout = opts.worker_timeout
 
     if len(args) == 2:
         try:
@@ -87,47 +131,241 @@ and forward that connection to <host>:<port>."""
     return (host, port, opts, pcfg)
 
 
-def wait_for_client(port):
-    """Listen on port for client connection, return resulting socket."""
-    srvsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    srvsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    srvsock.bind( ("", port) )
-    srvsock.listen(1)
-    logger.info("mitm_listener bound to %d" % port)
-    (sock, addr) = srvsock.accept()
-    srvsock.close()
-    logger.info("mitm_listener accepted connection from %s" % repr(addr))
-    return sock
+class MinecraftListener(asyncore.dispatcher):
+    """Accept client connections, and create a MinecraftSession for each.
+
+    The listener stays open for the lifetime of the proxy, so all sessions
+    share a single asyncore event loop. Connections accepted while
+    max_sessions sessions are active are closed immediately. The listener
+    reports its sessions to the session gauges in metrics until it is closed.
+    """
+
+    def __init__(self, pcfg, port, dsthost, dstport, backlog=5, max_sessions=None,
+                 max_buffer=None, profile_dir='.', relay=True, world_cache_size=None):
+        asyncore.dispatcher.__init__(self)
+        self.pcfg = pcfg
+        self.dsthost = dsthost
+        self.dstport = dstport
+        self.max_sessions = max_sessions
+        self.max_buffer = max_buffer
+        self.relay = relay
+        self.world_cache_size = world_cache_size
+        self.sessions = set()
+        self.next_session_id = 1
+        self.profile_dir = profile_dir
+        self.profiling = False
+        self.gauges = [(metrics.sessions_active, self._sessions_active),
+                       (metrics.session_bytes, self._session_bytes),
+                       (metrics.session_buffered, self._session_buffered)]
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind( ("", port) )
+        self.listen(backlog)
+        for (gauge, fn) in self.gauges:
+            gauge.add_function(fn)
+        logger.info("mitm_listener bound to %d" % port)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        (sock, addr) = pair
+        if self.max_sessions and len(self.sessions) >= self.max_sessions:
+            logger.warn("mitm_listener refusing connection from %s, %d sessions active" % \
+                        (repr(addr), len(self.sessions)))
+            sock.close()
+            return
+        logger.info("mitm_listener accepted connection from %s" % repr(addr))
+        session = MinecraftSession(self.pcfg, sock, self.dsthost, self.dstport, self,
+                                   self.max_buffer, self.relay, self.world_cache_size)
+        if session.active:
+            session.id = self.next_session_id
+            self.next_session_id += 1
+            self.sessions.add(session)
+            metrics.sessions.inc()
+            if self.profiling:
+                session.start_profiling()
+
+    def close(self):
+        for (gauge, fn) in self.gauges:
+            gauge.remove_function(fn)
+        asyncore.dispatcher.close(self)
+
+    def session_closed(self, session):
+        """Called by session when both of its proxies have been closed."""
+        self.sessions.discard(session)
+        metrics.session_lifetime.observe(time() - session.start_time)
+        logger.info("mitm_listener has %d active sessions" % len(self.sessions))
+
+    def toggle_profiling(self):
+        """Start profiling all sessions, or stop and write their profiles."""
+        self.profiling = not self.profiling
+        logger.warn("Profiling %s for %d sessions" % \
+                    ('started' if self.profiling else 'stopped', len(self.sessions)))
+        for session in self.sessions:
+            if self.profiling:
+                session.start_profiling()
+            else:
+                session.stop_profiling(self.profile_dir)
+
+    def _sessions_active(self):
+        return [((), len(self.sessions))]
+
+    def _session_bytes(self):
+        for session in self.sessions:
+            yield ((session.id, 'client'), session.cli_proxy.stream.tot_bytes)
+            yield ((session.id, 'server'), session.srv_proxy.stream.tot_bytes)
+
+    def _session_buffered(self):
+        for session in self.sessions:
+            for (direction, n) in session.buffered().items():
+                yield ((session.id, direction), n)
+
+
+class ProfilingSwitch(asyncore.dispatcher):
+    """Toggles a listener's profiling from the event loop, when requested.
+
+    request() only counts the request and writes a byte to a socket pair, so
+    it may be called from a signal handler. The signal can arrive while a
+    session is parsing or filtering a packet; the listener is only toggled
+    once the event loop reads the other end of the pair, between handlers.
+    """
+
+    def __init__(self, listener):
+        (rsock, self.wsock) = socket.socketpair()
+        self.wsock.setblocking(0)
+        asyncore.dispatcher.__init__(self, rsock)
+        self.listener = listener
+        self.requested = 0 # Written only by request().
+        self.handled = 0   # Written only by handle_read().
+
+    def request(self):
+        self.requested += 1
+        try:
+            self.wsock.send('x')
+        except socket.error:
+            pass # A wakeup is already pending.
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        while self.handled < self.requested:
+            self.handled += 1
+            self.listener.toggle_profiling()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self.wsock.close()
+        asyncore.dispatcher.close(self)
 
 
 class MinecraftSession(object):
     """A client-server Minecraft session."""
 
-    def __init__(self, pcfg, clientsock, dsthost, dstport):
-        """Open connection to dsthost:dstport, and return client and server proxies."""
+    def __init__(self, pcfg, clientsock, dsthost, dstport, listener=None, max_buffer=None,
+                 relay=True, world_cache_size=None):
+        """Start connecting to dsthost:dstport, and create client and server proxies.
+
+        The connection is made without blocking the event loop. Until it is
+        up, the client proxy does not read from the client. If it fails,
+        both proxies are closed.
+
+        If max_buffer is given, reading from one peer pauses while more
+        than max_buffer bytes are waiting to be sent to the other.
+
+        If relay is True and pcfg has no plugins, each proxy stops parsing
+        once its side's login packet has been forwarded, and relays bytes.
+        """
         logger.info("creating proxy from client to %s:%d" % (dsthost,dstport))
+        self.cli_proxy = None
         self.srv_proxy = None
+        self.listener = listener
+        self.active = False
+        self.id = None
+        self.start_time = time()
+        self.profile = None
         try:
-            serversock = socket.create_connection( (dsthost,dstport) )
+            (family, socktype, proto, _, addr) = \
+                socket.getaddrinfo(dsthost, dstport, 0, socket.SOCK_STREAM)[0]
             self.cli_proxy = MinecraftProxy(clientsock)
+            self.cli_proxy.reading_paused = True # Until the server is connected.
+            self.srv_proxy = MinecraftProxy(None, self.cli_proxy)
+            self.srv_proxy.create_socket(family, socktype)
+            self.srv_proxy.connect(addr)
         except Exception as e:
-            clientsock.close()
+            if self.srv_proxy:
+                self.srv_proxy.close()
+            if self.cli_proxy:
+                self.cli_proxy.close()
+            else:
+                clientsock.close()
             logger.error("Couldn't connect to %s:%d - %s", dsthost, dstport, str(e))
             logger.info(traceback.format_exc())
             return
-        self.srv_proxy = MinecraftProxy(serversock, self.cli_proxy)
-        self.plugin_mgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        if max_buffer:
+            self.cli_proxy.set_write_buffer_limits(max_buffer)
+            self.srv_proxy.set_write_buffer_limits(max_buffer)
+        self.plugin_mgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy,
+                                        world_cache_size)
         self.cli_proxy.plugin_mgr = self.plugin_mgr
         self.srv_proxy.plugin_mgr = self.plugin_mgr
+        self.cli_proxy.session = self
+        self.srv_proxy.session = self
+        if relay and not pcfg.ids:
+            self.cli_proxy.relay_after_login = True
+            self.srv_proxy.relay_after_login = True
+        self.active = True
+
+    def buffered(self):
+        """Return the number of bytes waiting to be sent to each peer."""
+        return {'client': self.cli_proxy.out_bytes if self.cli_proxy.connected else 0,
+                'server': self.srv_proxy.out_bytes if self.srv_proxy.connected else 0}
+
+    def start_profiling(self):
+        """Attach a new SessionProfile to the session."""
+        self.profile = SessionProfile(str(self.id))
+        self.plugin_mgr.set_profile(self.profile)
+
+    def stop_profiling(self, dir):
+        """Detach the session's profile, and write its report to dir."""
+        if self.profile:
+            profile, self.profile = self.profile, None
+            self.plugin_mgr.set_profile(None)
+            try:
+                profile.write_report(dir)
+            except IOError as e:
+                logger.error("Could not write profile: %s" % str(e))
+
+    def close(self):
+        """Mark the session as finished, and notify the listener."""
+        if self.active:
+            self.active = False
+            if self.listener:
+                self.stop_profiling(self.listener.profile_dir)
+                self.listener.session_closed(self)
 
 class UnsupportedPacketException(Exception):
     def __init__(self,pid):
         Exception.__init__(self,"Unsupported packet id 0x%x" % pid)
 
-class MinecraftProxy(asyncore.dispatcher_with_send):
+class MinecraftProxy(BufferedDispatcher):
     """Proxies a packet stream from a Minecraft client or server.
+
+    Once relaying, the proxy no longer parses anything: received bytes are
+    forwarded to the other side as they are, in reads of up to RELAY_SIZE.
+    This happens after a parse error, and after login when no plugins need
+    to see the stream.
     """
 
+    RELAY_SIZE = 256 * 1024
+
     def __init__(self, src_sock, other_side=None):
         """Proxies one side of a client-server connection.
 
@@ -138,20 +376,58 @@ class MinecraftProxy(asyncore.dispatcher_with_send):
         and creating a server proxy with other_side=client. Finally, the
         proxy creator should do client_proxy.other_side = server_proxy.
         """
-        asyncore.dispatcher_with_send.__init__(self, src_sock)
+        BufferedDispatcher.__init__(self, src_sock)
         self.plugin_mgr = None
+        self.session = None
         self.other_side = other_side
         if other_side == None:
             self.side = 'client'
-            self.msg_spec = messages.protocol[0][0]
+            self.msg_spec = messages.tables(0)[0]
         else:
             self.side = 'server'
-            self.msg_spec = messages.protocol[0][1]
+            self.msg_spec = messages.tables(0)[1]
             self.other_side.other_side = self
         self.stream = Stream()
         self.last_report = 0
         self.msg_queue = []
         self.out_of_sync = False
+        self.relay_after_login = False # Start relaying after the 0x01 login packet.
+        self.relaying = False
+        self.reading_paused = False
+        self.pauses = 0 # Times reading stopped because the peer was backed up.
+
+    def readable(self):
+        return not self.reading_paused
+
+    def handle_connect(self):
+        """The server proxy is connected; start reading from the client."""
+        logger.info("connected to server %s" % repr(self.addr))
+        if self.other_side:
+            self.other_side.reading_paused = False
+
+    def handle_error(self):
+        """Log the exception being handled, and close both sides."""
+        if self.side == 'server' and not self.connected:
+            logger.error("Couldn't connect to %s - %s" % (repr(self.addr), str(sys.exc_info()[1])))
+        else:
+            logger.error("MinecraftProxy for %s caught exception:\n%s" % \
+                         (self.side, traceback.format_exc()))
+        self.handle_close()
+
+    def pause_writing(self):
+        """Our peer is not keeping up; stop reading from the other side."""
+        if self.other_side:
+            logger.debug("%s send buffer full (%d bytes), pausing %s" % (
+                self.side, self.out_bytes, self.other_side.side))
+            self.other_side.reading_paused = True
+            self.other_side.pauses += 1
+
+    def resume_writing(self):
+        """Our send buffer has drained; resume reading from the other side."""
+        if self.other_side:
+            logger.debug("%s send buffer drained, resuming %s" % (
+                self.side, self.other_side.side))
+            self.other_side.reading_paused = False
 
     def handle_read(self):
         """Read all available bytes, and process as many packets as possible.
@@ -159,54 +435,126 @@ class MinecraftProxy(asyncore.dispatcher_with_send):
         t = time()
         if self.last_report + 5 < t and self.stream.tot_bytes > 0:
             self.last_report = t
-            logger.debug("%s: total/wasted bytes is %d/%d (%f wasted)" % (
-                 self.side, self.stream.tot_bytes, self.stream.wasted_bytes,
-                 100 * float(self.stream.wasted_bytes) / self.stream.tot_bytes))
-        self.stream.append(self.recv(4092))
-
-        if self.out_of_sync:
-            data = self.stream.read(len(self.stream))
-            self.stream.packet_finished()
-            if self.other_side:
-                self.other_side.send(data)
+            logger.debug("%s: total/reparsed bytes is %d/%d (%f reparsed), %d partial parses" % (
+                 self.side, self.stream.tot_bytes, self.stream.reparsed_bytes,
+                 100 * float(self.stream.reparsed_bytes) / self.stream.tot_bytes,
+                 self.stream.partial_parses))
+            logger.debug("%s: %d bytes buffered for sending, reads paused %d times" % (
+                 self.side, self.out_bytes, self.pauses))
+            if self.plugin_mgr:
+                chan = self.plugin_mgr.injection_channel(self.side)
+                if chan.delivered:
+                    logger.debug("%s: injected %d msgs, latency avg/max %f/%f" % (
+                         self.side, chan.delivered,
+                         chan.latency_total / chan.delivered, chan.latency_max))
+        if self.relaying:
+            data = self.recv(self.RELAY_SIZE)
+            self.stream.tot_bytes += len(data)
+            self.relay(data)
             return
 
+        self.stream.append(self.recv(self.RECV_SIZE))
+
+        if not self.stream.ready():
+            return # Still waiting for the rest of the current packet.
+
         try:
-            packet = parse_packet(self.stream, self.msg_spec, self.side)
-            while packet != None:
-                if packet['msgtype'] == 0x01 and self.side == 'client':
+            profile = self.session.profile if self.session else None
+            while True:
+                if self.plugin_mgr:
+                    inspected, observed = self.plugin_mgr.inspected, self.plugin_mgr.observed
+                else:
+                    inspected, observed = None, NOTHING
+                if metrics.enabled or profile:
+                    t0 = time()
+                    packet = parse_packet(self.stream, self.msg_spec, self.side, inspected)
+                    dt = time() - t0
+                    if metrics.enabled:
+                        metrics.record_packet(self.side, packet, dt)
+                    if profile:
+                        msgtype = ord(packet[0]) if isinstance(packet, str) else packet.msgtype
+                        profile.add('parse ' + self.side, msgtype, dt)
+                else:
+                    packet = parse_packet(self.stream, self.msg_spec, self.side, inspected)
+                if isinstance(packet, str):
+                    # No plugin inspects this msgtype, so forward it undecoded.
+                    if self.other_side:
+                        self.other_side.send(packet)
+                        if observed and ord(packet[0]) in observed:
+                            self.plugin_mgr.observe(ord(packet[0]), packet, self.side)
+                    self.send_injected_msgs()
+                    continue
+                if packet.msgtype == 0x01 and self.side == 'client':
                     # Determine which protocol message definitions to use.
                     proto_version = packet['proto_version']
                     logger.info('Client requests protocol version %d' % proto_version)
                     if not proto_version in messages.protocol:
                         logger.error("Unsupported protocol version %d" % proto_version)
                         self.handle_close()
-                        return
-                    self.msg_spec, self.other_side.msg_spec = messages.protocol[proto_version]
-                forward = True
+                        break
+                    self.msg_spec, self.other_side.msg_spec = messages.tables(proto_version)
+                forwarding = True
                 if self.plugin_mgr:
                     forwarding = self.plugin_mgr.filter(packet, self.side)
                     if forwarding and packet.modified:
-                        packet['raw_bytes'] = self.msg_spec[packet['msgtype']].parse(packet)
+                        t0 = time()
+                        packet['raw_bytes'] = emit_packet(packet, self.msg_spec)
+                        if profile:
+                            profile.add('emit ' + self.side, packet.msgtype, time() - t0)
                 if forwarding and self.other_side:
-                    self.other_side.send(packet['raw_bytes'])
-                # Since we know we're at a message boundary, we can inject
-                # any messages in the queue.
-                msgbytes = self.plugin_mgr.next_injected_msg_from(self.side)
-                while self.other_side and msgbytes is not None:
-                    self.other_side.send(msgbytes)
-                    msgbytes = self.plugin_mgr.next_injected_msg_from(self.side)
-
-                # Attempt to parse the next packet.
-                packet = parse_packet(self.stream,self.msg_spec, self.side)
+                    self.other_side.send(packet.raw_bytes)
+                    if packet.msgtype in observed:
+                        self.plugin_mgr.observe(packet.msgtype, packet.raw_bytes, self.side)
+                self.send_injected_msgs()
+                if self.relay_after_login and packet.msgtype == 0x01:
+                    logger.info("%s logged in, relaying without plugins" % self.side)
+                    self.start_relay()
+                    break
         except PartialPacketException:
             pass # Not all data for the current packet is available.
         except Exception:
             logger.error("MinecraftProxy for %s caught exception, out of sync" % self.side)
             logger.error(traceback.format_exc())
-            logger.debug("Current stream buffer: %s" % repr(self.stream.buf))
+            logger.debug("Current stream buffer: %s" % repr(self.stream.buf[self.stream.start:]))
             self.out_of_sync = True
-            self.stream.reset()
+            self.start_relay()
+        if self.plugin_mgr:
+            self.plugin_mgr.flush()
+
+    def start_relay(self):
+        """Stop parsing, and relay the unparsed rest of the stream as-is."""
+        self.relaying = True
+        self.stream.reset()
+        self.stream.read(len(self.stream))
+        data = self.stream.packet_finished()
+        self.stream.append('') # Free the buffer; only tot_bytes is used from now on.
+        self.relay(data)
+
+    def relay(self, data):
+        """Forward data to the other side without parsing it."""
+        if not data:
+            return
+        if metrics.enabled:
+            metrics.relayed_bytes.inc((self.side,), len(data))
+        if self.other_side:
+            self.other_side.send(data)
+
+    def send_injected_msgs(self):
+        """Send all messages injected by plugins on behalf of this side.
+
+        Only whole packets are ever forwarded to the other side, so this
+        may be called between packets or from the injection channel's
+        wake-up handler.
+        """
+        if self.out_of_sync or not self.other_side or not self.plugin_mgr:
+            return
+        chan = self.plugin_mgr.injection_channel(self.side)
+        n = chan.delivered
+        msgbytes = chan.get_all()
+        if msgbytes is not None:
+            self.other_side.send(msgbytes)
+            if metrics.enabled:
+                metrics.injected.inc((self.side,), chan.delivered - n)
 
     def handle_close(self):
         """Call shutdown handler."""
@@ -219,27 +567,59 @@ class MinecraftProxy(asyncore.dispatcher_with_send):
             self.other_side = None
             logger.info("shutting down plugin manager")
             self.plugin_mgr.destroy()
+        if self.session is not None:
+            self.session.close()
 
 
 class Message(dict):
+    """A message whose Parsem returns a dict rather than a Record (0x01)."""
+
     def __init__(self, d):
         super(Message, self).__init__(d)
-        self.modified = False
+        self.modified = set() # Keys whose values have changed.
 
     def __setitem__(self, key, val):
         if key in self and self[key] != val:
-            self.modified = True
+            self.modified.add(key)
         return super(Message, self).__setitem__(key, val)
 
-def parse_packet(stream, msg_spec, side):
-    """Parse a single packet out of stream, and return it."""
+    msgtype = property(operator.itemgetter('msgtype'))
+    raw_bytes = property(operator.itemgetter('raw_bytes'))
+
+def emit_packet(packet, msg_spec):
+    """Return the raw bytes of a modified packet.
+
+    Modified fixed-width fields are patched into a copy of the packet's
+    original bytes; the whole packet is emitted again only if a
+    variable-width field changed.
+    """
+    parsem = msg_spec[packet['msgtype']]
+    raw = parsem.patch(packet['raw_bytes'], packet, packet.modified)
+    if raw is None:
+        raw = parsem.emit(packet)
+    return raw
+
+def parse_packet(stream, msg_spec, side, inspected=None):
+    """Parse a single packet out of stream, and return it.
+
+    Decoded packets are returned as a Record, or a Message for the few
+    messages that are parsed into a dict. If inspected is a set of msgtypes
+    that does not contain the packet's type, the packet is skipped rather
+    than decoded, and its raw bytes are returned as a string instead.
+    """
     # read Packet ID
     msgtype = parse_unsigned_byte(stream)
     if not msg_spec[msgtype]:
         raise UnsupportedPacketException(msgtype)
-    logger.debug("%s trying to parse message type %x" % (side, msgtype))
     msg_parser = msg_spec[msgtype]
+    if inspected is not None and msgtype not in inspected:
+        msg_parser.skip(stream)
+        return stream.packet_finished()
+    logger.debug("%s trying to parse message type %x" % (side, msgtype))
     msg = msg_parser.parse(stream)
+    if isinstance(msg, Record):
+        msg.raw_bytes = stream.packet_finished()
+        return msg
     msg['raw_bytes'] = stream.packet_finished()
     return Message(msg)
 
@@ -257,18 +637,23 @@ if __name__ == "__main__":
     # Install signal handler.
     signal.signal(signal.SIGINT, sigint_handler)
 
-    while True:
-        cli_sock = wait_for_client(opts.locport)
-
-        # Set up client/server main-in-the-middle.
-        sleep(0.05)
-        MinecraftSession(pcfg, cli_sock, host, port)
-
-        # I/O event loop.
-        if opts.perf_data:
-            logger.warn("Profiling enabled, saving data to %s" % opts.perf_data)
-            import cProfile
-            cProfile.run('asyncore.loop()', opts.perf_data)
-        else:
-            asyncore.loop()
-
+    if opts.metrics_port:
+        metrics.enable()
+        metrics.MetricsServer(opts.metrics_port)
+
+    # Accept clients until interrupted; each one gets its own session.
+    listener = MinecraftListener(pcfg, opts.locport, host, port,
+                                 opts.backlog, opts.max_sessions, opts.max_buffer,
+                                 opts.profile_dir, opts.relay,
+                                 opts.world_cache_size and opts.world_cache_size * 1024 * 1024)
+    if hasattr(signal, 'SIGUSR1'):
+        switch = ProfilingSwitch(listener)
+        signal.signal(signal.SIGUSR1, lambda signum, stack: switch.request())
+
+    # I/O event loop.
+    if opts.perf_data:
+        logger.warn("Profiling enabled, saving data to %s" % opts.perf_data)
+        import cProfile
+        cProfile.run('eventloop.loop(opts.event_loop)', opts.perf_data)
+    else:
+        eventloop.loop(opts.event_loop)
@@ -23,42 +23,103 @@ class PartialPacketException(Exception):
 
 
 class Stream(object):
-    """Represent a stream of bytes."""
+    """Represent a stream of bytes.
+
+    Bytes are appended to a bytearray and consumed through a read cursor.
+    Consumed bytes stay in the buffer until they make up at least half of it,
+    so compaction costs amortized O(1) per byte instead of O(buffer) per packet.
+
+    When a read runs past the end of the buffer, the stream remembers how
+    many bytes the current packet needs at minimum. Callers should check
+    ready() before re-parsing, so that a large packet (e.g. a length-prefixed
+    chunk) is parsed once when complete rather than once per recv().
+    """
+
+    # Never compact for fewer than this many consumed bytes.
+    COMPACT_MIN = 64 * 1024
 
     def __init__(self):
         """Initialize the stream."""
-        self.buf = ""
-        self.i = 0
+        self.buf = bytearray()
+        self.start = 0 # Offset of the first byte of the current packet.
+        self.i = 0     # Offset of the next byte to read.
+        self.need = 0  # Minimum size of the current packet, once known.
         self.tot_bytes = 0
-        self.wasted_bytes = 0
+        self.reparsed_bytes = 0 # Bytes read again after a partial parse.
+        self.partial_parses = 0 # Number of parse attempts abandoned.
 
     def append(self,str):
         """Append a string to the stream."""
+        self._compact()
         self.buf += str
 
+    def _compact(self):
+        """Discard bytes belonging to finished packets, if enough have piled up."""
+        n = self.start
+        if n == len(self.buf):
+            del self.buf[:]
+        elif n < self.COMPACT_MIN or 2 * n < len(self.buf):
+            return
+        else:
+            del self.buf[:n]
+        self.start = 0
+        self.i -= n
+
     def read(self,n):
-        """Read n bytes, returned as a string."""
-        if self.i + n > len(self.buf):
-            self.wasted_bytes += self.i
-            self.i = 0
-            raise PartialPacketException()
-        str = self.buf[self.i:self.i+n]
-        self.i += n
-        return str
+        """Read n bytes, returned as a memoryview into the stream's buffer.
+
+        The view is only valid until the next call to append(), and must
+        not be kept alive past that point; use tobytes() to keep a copy.
+        """
+        j = self.i + n
+        if j > len(self.buf):
+            self._partial(j)
+        view = memoryview(self.buf)[self.i:j]
+        self.i = j
+        return view
+
+    def skip(self,n):
+        """Advance the read cursor past n bytes without reading them."""
+        j = self.i + n
+        if j > len(self.buf):
+            self._partial(j)
+        self.i = j
+
+    def unpack(self,st):
+        """Unpack the struct.Struct st at the read cursor, and return the tuple."""
+        j = self.i + st.size
+        if j > len(self.buf):
+            self._partial(j)
+        vals = st.unpack_from(self.buf, self.i)
+        self.i = j
+        return vals
+
+    def _partial(self,j):
+        """Rewind to the start of the packet, noting that j bytes are needed."""
+        self.reparsed_bytes += self.i - self.start
+        self.partial_parses += 1
+        self.need = j - self.start
+        self.i = self.start
+        raise PartialPacketException()
+
+    def ready(self):
+        """Return True if enough bytes are buffered to retry the current packet."""
+        return len(self.buf) - self.start >= self.need
 
     def reset(self):
-        self.i = 0
+        self.i = self.start
+        self.need = 0
 
     def packet_finished(self):
         """Mark the completion of a packet, and return its bytes as a string."""
-        # Discard all data that was read for the previous packet,
-        # and reset i.
+        # Copy out only the bytes of this packet; the buffer itself is
+        # compacted lazily by append().
         data = ""
-        if self.i > 0:
-            data = self.buf[:self.i]
-            self.buf = self.buf[self.i:]
-            self.tot_bytes += self.i
-            self.i = 0
+        if self.i > self.start:
+            data = memoryview(self.buf)[self.start:self.i].tobytes()
+            self.tot_bytes += self.i - self.start
+            self.start = self.i
+        self.need = 0
         return data
 
     def __len__(self):
@@ -0,0 +1,613 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Run plugin instances in worker processes.
+
+A plugin instance configured to run in a worker (PluginConfig.run_in_worker)
+is replaced in the PluginManager by a WorkerPlugin, which starts a Python
+process running the real instance, and passes it the messages it inspects:
+
+    Observers (plugin classes with observer set to True) never hold up a
+    message. The batches of forwarded messages the PluginManager passes to
+    observe() are put in a RingBuffer shared with the worker, and handed to
+    the plugin's own observe(). If the ring is full, messages are not
+    observed.
+
+    Other plugins may drop or modify messages, so each message is sent to
+    the worker, and the proxy waits for its verdict. The whole event loop
+    waits with it, so a worker that does not answer within the configured
+    timeout fails open: the message is forwarded as it is. Until the late
+    answer arrives, the worker is not sent messages, which are forwarded
+    unfiltered, so that a slow worker stalls the loop once rather than on
+    every message.
+
+Workers are started in the background: the proxy does not wait for them,
+and messages are forwarded unfiltered until a worker is ready.
+
+Messages are sent as raw bytes and parsed again in the worker, and changes
+the worker's plugin makes to a message's fields are sent back and applied.
+Messages the plugin injects with to_client() and to_server() are passed
+back to the session's injection channels. Worker plugins cannot use the
+session's WorldCache or EntityTracker, which live in the proxy process.
+
+Workers are started afresh with subprocess rather than forked, so that they
+do not inherit the sockets of other sessions. A worker and its WorkerPlugin
+talk over a socket pair, in pickled frames.
+"""
+
+import os, sys, socket, select, struct, mmap, tempfile, subprocess, cPickle
+import errno, logging, traceback, threading
+from time import time
+
+import messages
+from eventloop import BufferedDispatcher
+from util import Stream
+from parsing import parse_unsigned_byte
+
+logger = logging.getLogger(__name__)
+
+# Seconds to wait for a worker's verdict on a message, by default.
+WORKER_TIMEOUT = 0.05
+
+# Seconds wait_until_ready() waits for a worker to start, and seconds to
+# wait for a worker to stop.
+START_TIMEOUT = 10.0
+STOP_TIMEOUT = 1.0
+
+# Bytes of shared memory for the messages queued to an observer.
+RING_SIZE = 4 * 1024 * 1024
+
+# Seconds an idle observer worker waits for a wakeup before it checks its
+# ring buffer anyway.
+RING_POLL = 0.5
+
+# Where ring buffers are mapped from; tmpfs keeps them off the disk.
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Flag of ring buffer records sent by the server.
+FROM_SERVER = 1
+
+def supported():
+    """Return True if this platform can run plugins in worker processes."""
+    return hasattr(socket, 'socketpair') and hasattr(socket, 'fromfd')
+
+
+### Framing ###
+
+FRAME = struct.Struct('<I')
+
+def encode_frame(obj):
+    """Return obj pickled, and prefixed with its length."""
+    data = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    return FRAME.pack(len(data)) + data
+
+def send_frame(sock, obj):
+    """Send obj on blocking socket sock."""
+    sock.sendall(encode_frame(obj))
+
+class FrameReader(object):
+    """Split the bytes received from a socket into unpickled frames."""
+
+    def __init__(self):
+        self.buf = ''
+
+    def feed(self, data):
+        """Add data, and return the list of frames it completed."""
+        self.buf += data
+        frames = []
+        while len(self.buf) >= FRAME.size:
+            (n,) = FRAME.unpack_from(self.buf)
+            if len(self.buf) < FRAME.size + n:
+                break
+            frames.append(cPickle.loads(self.buf[FRAME.size:FRAME.size + n]))
+            self.buf = self.buf[FRAME.size + n:]
+        return frames
+
+
+### Ring buffer ###
+
+class RingBuffer(object):
+    """Queue of packets in shared memory, from one producer to one consumer.
+
+    The mapping starts with a header holding the number of bytes committed
+    by the producer, the number of bytes read by the consumer (both ever
+    increasing), and a flag the consumer sets while it waits to be woken.
+    Each packet follows as a record: its length, arrival time and flags,
+    then its raw bytes. Records do not wrap around the end of the mapping;
+    a length of SKIP, or too little room for a record header, sends the
+    reader back to the start.
+
+    Records put() by the producer are only seen by the consumer once the
+    producer commits them, so that they are handed over in batches.
+
+    The header is read and written without memory barriers, so the consumer
+    may not see the producer's latest commit when it starts waiting, nor
+    the producer its waiting flag. commit() therefore asks for a wakeup
+    whenever the consumer had read everything committed before, not only
+    when the flag is set, and a waiting consumer should still check the
+    ring every so often.
+    """
+
+    WRITTEN = struct.Struct('<Q')
+    READ = struct.Struct('<Q')
+    WAITING = 16 # Offset of the waiting flag.
+    HEADER_SIZE = 24
+    RECORD = struct.Struct('<IdB')
+    SKIP = 0xffffffff
+
+    def __init__(self, mm):
+        self.mm = mm
+        self.capacity = len(mm) - self.HEADER_SIZE
+        self.pending = self.WRITTEN.unpack_from(mm, 0)[0] # Bytes put so far.
+        self.committed = self.pending
+
+    def put(self, t, flags, raw):
+        """Queue raw, returning False if there is no room for it."""
+        n = self.RECORD.size + len(raw)
+        pos = self.pending % self.capacity
+        tail = self.capacity - pos
+        need = n if n <= tail else tail + n
+        read = self.READ.unpack_from(self.mm, 8)[0]
+        if n > self.capacity or self.pending + need - read > self.capacity:
+            return False
+        if n > tail:
+            if tail >= self.RECORD.size:
+                self.RECORD.pack_into(self.mm, self.HEADER_SIZE + pos, self.SKIP, 0.0, 0)
+            self.pending += tail
+            pos = 0
+        start = self.HEADER_SIZE + pos
+        self.RECORD.pack_into(self.mm, start, len(raw), t, flags)
+        self.mm[start + self.RECORD.size:start + n] = raw
+        self.pending += n
+        return True
+
+    def commit(self):
+        """Publish the records put so far.
+
+        Returns True if the consumer was waiting, or had read all the
+        records committed before, in which case the caller should wake it up.
+        """
+        if self.pending == self.committed:
+            return False
+        caught_up = self.READ.unpack_from(self.mm, 8)[0] >= self.committed
+        self.WRITTEN.pack_into(self.mm, 0, self.pending)
+        self.committed = self.pending
+        if self.mm[self.WAITING] != '\x00':
+            self.mm[self.WAITING] = '\x00'
+            return True
+        return caught_up
+
+    def get(self):
+        """Return the committed records as a list of (t, flags, raw), and free them."""
+        written = self.WRITTEN.unpack_from(self.mm, 0)[0]
+        read = self.READ.unpack_from(self.mm, 8)[0]
+        records = []
+        while read < written:
+            pos = read % self.capacity
+            tail = self.capacity - pos
+            if tail < self.RECORD.size:
+                read += tail
+                continue
+            start = self.HEADER_SIZE + pos
+            (n, t, flags) = self.RECORD.unpack_from(self.mm, start)
+            if n == self.SKIP:
+                read += tail
+                continue
+            start += self.RECORD.size
+            records.append((t, flags, self.mm[start:start + n]))
+            read += self.RECORD.size + n
+        self.READ.pack_into(self.mm, 8, read)
+        return records
+
+    def wait(self):
+        """Mark the consumer as waiting; return False if records arrived meanwhile."""
+        self.mm[self.WAITING] = '\x01'
+        if self.WRITTEN.unpack_from(self.mm, 0)[0] != self.READ.unpack_from(self.mm, 8)[0]:
+            self.mm[self.WAITING] = '\x00'
+            return False
+        return True
+
+
+def map_ring(path, size):
+    """Map the ring buffer file at path, of size bytes."""
+    with open(path, 'r+b') as f:
+        return mmap.mmap(f.fileno(), size)
+
+def create_ring(size=RING_SIZE):
+    """Create and map a ring buffer file; return its path and mapping."""
+    (fd, path) = tempfile.mkstemp(prefix='mc3p-ring-', dir=SHM_DIR)
+    try:
+        os.ftruncate(fd, size)
+        mm = mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+    return (path, mm)
+
+
+### Proxy side ###
+
+class WorkerConnection(BufferedDispatcher):
+    """The proxy's end of the socket pair to a worker.
+
+    Frames are queued, and written out as the socket takes them, so that a
+    worker that is slow to read never blocks the proxy. Frames arriving
+    while the proxy is not waiting for one, such as late verdicts and
+    injected messages, are read by the event loop and passed to on_frame.
+    """
+
+    def __init__(self, sock, on_frame):
+        BufferedDispatcher.__init__(self, sock)
+        self.reader = FrameReader()
+        self.on_frame = on_frame
+
+    def readable(self):
+        return True
+
+    def send_frame(self, obj):
+        self.send(encode_frame(obj))
+
+    def handle_read(self):
+        data = self.recv(self.RECV_SIZE)
+        for frame in self.reader.feed(data):
+            self.on_frame(frame)
+
+    def handle_close(self):
+        self.close()
+
+    def wait_for(self, pred, timeout):
+        """Read frames until pred(frame) is true, for up to timeout seconds.
+
+        Queued frames are written out meanwhile, and other frames are
+        passed to on_frame. Returns the matching frame, or None on timeout
+        or if the worker is gone.
+        """
+        deadline = time() + timeout
+        while self.connected:
+            remaining = deadline - time()
+            if remaining <= 0:
+                return None
+            try:
+                wlist = [self.socket] if self.out_chunks else []
+                (r, w, x) = select.select([self.socket], wlist, [], remaining)
+                if w:
+                    self.initiate_send()
+                if not r:
+                    continue
+                data = self.socket.recv(self.RECV_SIZE)
+            except (select.error, socket.error) as e:
+                if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                    continue
+                self.close()
+                return None
+            if not data:
+                self.close()
+                return None
+            match = None
+            for frame in self.reader.feed(data):
+                if match is None and pred(frame):
+                    match = frame
+                else:
+                    self.on_frame(frame)
+            if match is not None:
+                return match
+        return None
+
+
+class WorkerPlugin(object):
+    """Stand-in, in the PluginManager, for a plugin instance run in a worker.
+
+    It takes the place of the instance in the PluginManager: observers get
+    messages through a RingBuffer, and other plugins synchronously, failing
+    open after timeout seconds. ready is set once the worker has started.
+    """
+
+    uses_world = False
+    uses_entities = False
+
+    def __init__(self, clazz, pname, id, proto_version, from_client, from_server,
+                 timeout=WORKER_TIMEOUT):
+        self.world = None
+        self.entities = None
+        self.clazz = clazz
+        self.pname = pname
+        self.id = id
+        self.observer = clazz.observer
+        self.timeout = timeout
+        self.__proto_version = proto_version
+        self.__channels = {'client': from_client, 'server': from_server}
+        self.__msg_specs = None
+        self.__inspected = clazz._class_inspected_msgtypes()
+        self.__proc = None
+        self.__conn = None
+        self.__ring = None
+        self.__ring_path = None
+        self.__seq = 0
+        self.__late = None # Sequence number of the verdict that came too late.
+        self.ready = False
+
+        # Messages that failed open because the worker did not decide in
+        # time, or was not sent them, and messages that were not observed.
+        self.timeouts = 0
+        self.skipped = 0
+        self.dropped = 0
+
+    def init(self, argstr):
+        """Start the worker, which instantiates the plugin with argstr.
+
+        Does not wait for the worker to be ready. If the plugin fails to
+        start, the error is logged once the worker reports it.
+        """
+        (sock, child_sock) = socket.socketpair()
+        try:
+            if self.observer:
+                (self.__ring_path, mm) = create_ring()
+                self.__ring = RingBuffer(mm)
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(p or os.curdir for p in sys.path)
+            self.__proc = subprocess.Popen([sys.executable, '-m', 'mc3p.workers'],
+                                           stdin=child_sock.fileno(), close_fds=True,
+                                           env=env)
+        finally:
+            child_sock.close()
+        self.__conn = WorkerConnection(sock, self._handle_frame)
+        self.__conn.send_frame(('init', self.pname, self.clazz.__name__, argstr,
+                                self.__proto_version, self.id, self.__ring_path,
+                                logging.getLogger().getEffectiveLevel()))
+        logger.info("Starting plugin '%s' in worker process %d" % (self.id, self.__proc.pid))
+
+    def wait_until_ready(self, timeout=START_TIMEOUT):
+        """Wait for up to timeout seconds for the worker to start.
+
+        Returns True if it is ready. The proxy never waits for a worker;
+        this is for tests and benchmarks.
+        """
+        if not self.ready and self.__conn:
+            frame = self.__conn.wait_for(lambda f: f[0] in ('ready', 'error'), timeout)
+            if frame:
+                self._handle_frame(frame)
+        return self.ready
+
+    def _inspected_msgtypes(self):
+        return self.__inspected
+
+    def _dispatcher(self, msgtype):
+        if self.__inspected is not None and msgtype not in self.__inspected:
+            return None
+        return self._filter
+
+    def _encode(self, msg, source):
+        """Return the bytes of msg, as modified by plugins called before this one."""
+        raw = msg.get('raw_bytes')
+        if raw is None or getattr(msg, 'modified', None):
+            if self.__msg_specs is None:
+                self.__msg_specs = dict(zip(('client', 'server'),
+                                            messages.tables(self.__proto_version)))
+            raw = self.__msg_specs[source][msg['msgtype']].emit(msg)
+        return raw
+
+    def observe(self, batch):
+        """Publish a batch of forwarded messages, waking the worker up if needed."""
+        if not self.__ring:
+            return
+        put = self.__ring.put
+        for (t, source, msgtype, raw) in batch:
+            if not put(t, FROM_SERVER if source == 'server' else 0, raw):
+                if not self.dropped:
+                    logger.warning("Ring buffer of worker '%s' is full, dropping messages" % \
+                                   self.id)
+                self.dropped += 1
+        if self.__ring.commit():
+            self._send(('wake',))
+
+    def _filter(self, msg, source):
+        if not self.ready or self.__late is not None or \
+                self.__conn.out_bytes > self.__conn.high_water:
+            self.skipped += 1
+            return True
+        self.__seq += 1
+        seq = self.__seq
+        if not self._send(('filter', seq, source, self._encode(msg, source))):
+            return True
+        reply = self.__conn.wait_for(lambda f: f[0] == 'filtered' and f[1] == seq,
+                                     self.timeout)
+        if reply is None:
+            if not self.timeouts:
+                logger.warning("Worker '%s' did not answer within %gs, " % \
+                               (self.id, self.timeout) + \
+                               "forwarding messages until it catches up")
+            self.timeouts += 1
+            self.__late = seq
+            return True
+        (_, _, forward, changes) = reply
+        for (key, val) in changes.iteritems():
+            msg[key] = val
+        return forward
+
+    def _send(self, frame):
+        if not self.__conn or not self.__conn.connected:
+            return False
+        try:
+            self.__conn.send_frame(frame)
+        except socket.error as e:
+            logger.error("Lost worker '%s': %s" % (self.id, str(e)))
+            self.__conn.close()
+        return self.__conn.connected
+
+    def _handle_frame(self, frame):
+        if frame[0] == 'inject':
+            self.__channels[frame[1]].put(frame[2])
+        elif frame[0] == 'filtered':
+            if frame[1] == self.__late:
+                self.__late = None # Caught up.
+        elif frame[0] == 'ready':
+            self.ready = True
+            self._unlink_ring()
+            logger.info("Plugin '%s' running in worker process %d" % \
+                        (self.id, self.__proc.pid))
+        elif frame[0] == 'error':
+            self._unlink_ring()
+            logger.error("Worker for '%s' failed to start:\n%s" % (self.id, frame[1]))
+
+    def _unlink_ring(self):
+        """Remove the ring buffer's file, which the worker has mapped by now."""
+        if self.__ring_path:
+            os.unlink(self.__ring_path)
+            self.__ring_path = None
+
+    def _destroy(self):
+        """Stop the worker, giving it STOP_TIMEOUT seconds to destroy the plugin."""
+        if self._send(('stop',)):
+            self.__conn.wait_for(lambda f: f[0] == 'stopped', STOP_TIMEOUT)
+        if self.__conn:
+            self.__conn.close()
+        if self.__proc and self.__proc.poll() is None:
+            self.__proc.kill()
+            self.__proc.wait()
+        self._unlink_ring()
+        if self.__ring:
+            self.__ring.mm.close()
+            self.__ring = None
+        if self.timeouts or self.skipped or self.dropped:
+            logger.info("Worker '%s': %d messages timed out, %d not sent, %d not observed" % \
+                        (self.id, self.timeouts, self.skipped, self.dropped))
+
+
+### Worker side ###
+
+class WorkerChannel(object):
+    """Stands in for an InjectionChannel, in the worker."""
+
+    def __init__(self, worker, source):
+        self.worker = worker
+        self.source = source
+
+    def put(self, msgbytes):
+        self.worker.send(('inject', self.source, msgbytes))
+
+
+class Worker(object):
+    """Run a plugin instance for the WorkerPlugin at the other end of sock."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.reader = FrameReader()
+        self.frames = []
+        self.lock = threading.Lock() # Plugins may inject from other threads.
+        self.ring = None
+        self.inst = None
+
+    def send(self, frame):
+        with self.lock:
+            send_frame(self.sock, frame)
+
+    def recv(self, timeout=None):
+        """Return the next frame, blocking until one arrives, or None on EOF.
+
+        If no frame arrives within timeout seconds, returns a wake frame.
+        """
+        while not self.frames:
+            if timeout is not None and \
+                    not select.select([self.sock], [], [], timeout)[0]:
+                return ('wake',)
+            data = self.sock.recv(64 * 1024)
+            if not data:
+                return None
+            self.frames.extend(self.reader.feed(data))
+        return self.frames.pop(0)
+
+    def parse(self, source, raw):
+        stream = Stream()
+        stream.append(raw)
+        msg = self.specs[source][parse_unsigned_byte(stream)].parse(stream)
+        msg['raw_bytes'] = raw
+        return msg
+
+    def start(self, pname, clsname, argstr, proto_version, id, ring_path, loglevel):
+        logging.basicConfig(level=loglevel,
+                            format='%%(asctime)s worker[%s] %%(levelname)s %%(message)s' % id)
+        if ring_path:
+            self.ring = RingBuffer(map_ring(ring_path, os.path.getsize(ring_path)))
+        self.specs = dict(zip(('client', 'server'), messages.tables(proto_version)))
+        mod = __import__(pname)
+        for p in pname.split('.')[1:]:
+            mod = getattr(mod, p)
+        clazz = getattr(mod, clsname)
+        self.inst = clazz(proto_version, WorkerChannel(self, 'client'),
+                          WorkerChannel(self, 'server'))
+        self.inst.init(argstr)
+        return self.inst._inspected_msgtypes()
+
+    def observe(self):
+        """Pass the records in the ring buffer to the plugin, as one batch."""
+        batch = [(t, 'server' if flags & FROM_SERVER else 'client', ord(raw[0]), raw)
+                 for (t, flags, raw) in self.ring.get()]
+        if batch:
+            try:
+                self.inst.observe(batch)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+    def filter(self, seq, source, raw):
+        """Return the plugin's verdict on a message, and its changes to it."""
+        forward, changes = True, {}
+        try:
+            msg = self.parse(source, raw)
+            forward = bool(self.inst.filter(msg, source))
+            fields = getattr(msg, 'fields', ())
+            for key in getattr(msg, 'modified', ()):
+                if key in fields:
+                    changes[key] = msg[key]
+        except Exception:
+            logger.error(traceback.format_exc())
+        return ('filtered', seq, forward, changes)
+
+    def run(self):
+        frame = self.recv()
+        if frame is None or frame[0] != 'init':
+            return
+        try:
+            inspected = self.start(*frame[1:])
+        except Exception:
+            self.send(('error', traceback.format_exc()))
+            return
+        self.send(('ready', inspected))
+        try:
+            while True:
+                if self.ring:
+                    self.observe()
+                    if not self.frames and not self.ring.wait():
+                        continue
+                frame = self.recv(RING_POLL if self.ring else None)
+                if frame is None or frame[0] == 'stop':
+                    break
+                elif frame[0] == 'filter':
+                    self.send(self.filter(*frame[1:]))
+        finally:
+            if self.ring:
+                self.observe()
+            self.inst._destroy()
+            if frame is not None:
+                self.send(('stopped',))
+
+
+def main():
+    # The WorkerPlugin passes its socket as our stdin.
+    sock = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    Worker(sock).run()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""A cache of the blocks the server has sent to the client.
+
+WorldCache keeps the block ids and metadata of every loaded chunk column,
+built from the messages forwarded to the client:
+
+    0x32 Pre-chunk          unloads a column (when mode is False)
+    0x33 Chunk              replaces a region of blocks
+    0x34 Multi-block change changes blocks within a column
+    0x35 Block change       changes one block
+    0x09 Respawn            clears the cache, since the world changed
+
+Columns are evicted least recently used first when the cache grows past
+max_bytes. Light levels are not kept.
+"""
+
+import zlib, logging, collections
+
+logger = logging.getLogger("mc3p")
+
+CHUNK_WIDTH = 16
+CHUNK_HEIGHT = 128
+COLUMN_BLOCKS = CHUNK_WIDTH * CHUNK_WIDTH * CHUNK_HEIGHT
+
+# Messages that change the cache.
+MSGTYPES = frozenset([0x09, 0x32, 0x33, 0x34, 0x35])
+
+class ChunkColumn(object):
+    """Blocks of one 16x128x16 column, laid out as in Chunk messages.
+
+    The block at local coordinates (x, y, z) is blocks[index], where
+    index = y + z*128 + x*128*16; its metadata is the low nibble of
+    metadata[index/2] if index is even, and the high nibble otherwise.
+    """
+
+    __slots__ = ('blocks', 'metadata')
+
+    def __init__(self, blocks=None, metadata=None):
+        self.blocks = bytearray(COLUMN_BLOCKS) if blocks is None else blocks
+        self.metadata = bytearray(COLUMN_BLOCKS // 2) if metadata is None else metadata
+
+    def nbytes(self):
+        return len(self.blocks) + len(self.metadata)
+
+    def set(self, index, block_type, metadata):
+        self.blocks[index] = block_type & 0xff
+        i = index >> 1
+        if index & 1:
+            self.metadata[i] = (self.metadata[i] & 0x0f) | ((metadata & 0x0f) << 4)
+        else:
+            self.metadata[i] = (self.metadata[i] & 0xf0) | (metadata & 0x0f)
+
+
+def block_index(x, y, z):
+    """Return the index of world block (x, y, z) within its ChunkColumn."""
+    return ((x & 15) << 11) | ((z & 15) << 7) | y
+
+
+class WorldCache(object):
+    """Block ids and metadata of loaded chunk columns, keyed by (cx, cz).
+
+    Chunk coordinates are block coordinates divided by 16, so the block
+    at (x, y, z) is in column (x >> 4, z >> 4). columns is kept in order
+    of use, least recently used first.
+    """
+
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or self.DEFAULT_MAX_BYTES
+        self.columns = collections.OrderedDict() # { (cx, cz) -> ChunkColumn }
+        self.nbytes = 0
+        self.evictions = 0
+        self.__recent = None # Key of the most recently used column.
+        self.__updaters = {0x09: self._respawn,
+                           0x32: self._prechunk,
+                           0x33: self._chunk,
+                           0x34: self._multi_block_change,
+                           0x35: self._block_change}
+
+    def __len__(self):
+        return len(self.columns)
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def block_at(self, x, y, z):
+        """Return the block id at (x, y, z), or None if it is not loaded."""
+        if not 0 <= y < CHUNK_HEIGHT:
+            return None
+        column = self.column(x >> 4, z >> 4)
+        if column is None:
+            return None
+        return column.blocks[block_index(x, y, z)]
+
+    def metadata_at(self, x, y, z):
+        """Return the metadata of the block at (x, y, z), or None if it is not loaded."""
+        if not 0 <= y < CHUNK_HEIGHT:
+            return None
+        column = self.column(x >> 4, z >> 4)
+        if column is None:
+            return None
+        index = block_index(x, y, z)
+        return (column.metadata[index >> 1] >> (4 * (index & 1))) & 0x0f
+
+    def column(self, cx, cz):
+        """Return the ChunkColumn at chunk coordinates (cx, cz), or None."""
+        key = (cx, cz)
+        if key == self.__recent:
+            return self.columns[key]
+        column = self.columns.pop(key, None)
+        if column is not None:
+            self.columns[key] = column
+            self.__recent = key
+        return column
+
+    def update(self, msg):
+        """Apply a message sent by the server to the cache."""
+        updater = self.__updaters.get(msg['msgtype'])
+        if updater:
+            updater(msg)
+
+    def unload(self, cx, cz):
+        column = self.columns.pop((cx, cz), None)
+        if column is not None:
+            self.nbytes -= column.nbytes()
+        if (cx, cz) == self.__recent:
+            self.__recent = None
+
+    def clear(self):
+        self.columns = collections.OrderedDict()
+        self.__recent = None
+        self.nbytes = 0
+
+    def _load(self, key, column=None):
+        """Return the column at key, adding column or an empty one if missing."""
+        old = self.columns.pop(key, None)
+        if old is not None and column is not None:
+            self.nbytes -= old.nbytes()
+            old = None
+        if old is None:
+            old = column or ChunkColumn()
+            self.nbytes += old.nbytes()
+        self.columns[key] = old
+        self.__recent = key
+        return old
+
+    def _evict(self):
+        """Drop least recently used columns until the cache fits in max_bytes."""
+        while self.nbytes > self.max_bytes and len(self.columns) > 1:
+            (key, column) = self.columns.popitem(last=False)
+            self.nbytes -= column.nbytes()
+            self.evictions += 1
+
+    def _respawn(self, msg):
+        self.clear()
+
+    def _prechunk(self, msg):
+        if not msg['mode']:
+            self.unload(msg['x'], msg['z'])
+
+    def _chunk(self, msg):
+        x0, y0, z0 = msg['x'], msg['y'], msg['z']
+        sx, sy, sz = msg['size_x'] + 1, msg['size_y'] + 1, msg['size_z'] + 1
+        n = sx * sy * sz
+        try:
+            data = zlib.decompress(msg['chunk']['data'])
+        except zlib.error as e:
+            logger.error("WorldCache could not decompress chunk at %d,%d,%d: %s" % \
+                         (x0, y0, z0, str(e)))
+            return
+        if len(data) < n + (n + 1) // 2:
+            logger.error("WorldCache ignoring short chunk at %d,%d,%d" % (x0, y0, z0))
+            return
+        if (sx, sy, sz) == (CHUNK_WIDTH, CHUNK_HEIGHT, CHUNK_WIDTH) and \
+           x0 & 15 == 0 and z0 & 15 == 0 and y0 == 0:
+            # A whole column, already in our layout.
+            column = ChunkColumn(bytearray(data[:n]), bytearray(data[n:n + n // 2]))
+            self._load((x0 >> 4, z0 >> 4), column)
+        else:
+            self._chunk_region(x0, y0, z0, sx, sy, sz, data)
+        self._evict()
+
+    def _chunk_region(self, x0, y0, z0, sx, sy, sz, data):
+        """Copy a region of blocks that is not a whole column."""
+        n = sx * sy * sz
+        y1 = min(y0 + sy, CHUNK_HEIGHT)
+        for dx in xrange(sx):
+            for dz in xrange(sz):
+                x, z = x0 + dx, z0 + dz
+                column = self._load((x >> 4, z >> 4))
+                src = (dx * sz + dz) * sy
+                dst = block_index(x, y0, z)
+                column.blocks[dst:dst + y1 - y0] = data[src:src + y1 - y0]
+                for dy in xrange(y1 - y0):
+                    i = src + dy
+                    meta = ord(data[n + (i >> 1)]) >> (4 * (i & 1))
+                    column.set(dst + dy, column.blocks[dst + dy], meta)
+
+    def _multi_block_change(self, msg):
+        key = (msg['chunk_x'], msg['chunk_z'])
+        column = self.columns.get(key)
+        if column is None:
+            return
+        changes = msg['changes']
+        for (coord, block_type, meta) in zip(changes['coord_array'],
+                                             changes['type_array'],
+                                             changes['metadata_array']):
+            coord &= 0xffff
+            y = coord & 0xff
+            if y < CHUNK_HEIGHT:
+                column.set(((coord >> 12) << 11) | (((coord >> 8) & 15) << 7) | y,
+                           block_type, meta)
+
+    def _block_change(self, msg):
+        x, y, z = msg['x'], msg['y'] & 0xff, msg['z']
+        column = self.columns.get((x >> 4, z >> 4))
+        if column is not None and y < CHUNK_HEIGHT:
+            column.set(block_index(x, y, z), msg['block_type'], msg['block_metadata'])
@@ -28,6 +28,7 @@ setup(
     version = version,
     packages = find_packages(),
     zip_safe = False,
+    extras_require = {'chunks': ['numpy']},
     test_suite = 'test_plugins',
     author = "Matt McGill",
     author_email = "matt.mcgill@gmail.com",
@@ -0,0 +1,60 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, os, shutil, struct, tempfile
+
+from mc3p import benchmark, messages
+
+class TestBenchmark(unittest.TestCase):
+
+    def testSyntheticTrafficRoundTrips(self):
+        for v in messages.protocol:
+            if v == 0: continue
+            packets = benchmark.synthetic_session(v, 200)
+            self.assertEqual(v, benchmark.capture_version(packets))
+            for r in benchmark.bench_parse('v%d' % v, packets, v, 1):
+                side = r['variant'].split('/')[0]
+                self.assertEqual(len(packets[side]), r['packets'])
+            for r in benchmark.bench_emit('v%d' % v, packets, v, 1):
+                self.assertEqual(len(packets[r['variant']]), r['packets'])
+            for r in benchmark.bench_patch('v%d' % v, packets, v, 1):
+                self.assertTrue(r['packets'] > 0)
+
+    def testLoadCapture(self):
+        packets = benchmark.synthetic_session(23, 50)
+        dir = tempfile.mkdtemp()
+        try:
+            capfile = os.path.join(dir, 'cap')
+            for (side, ext) in (('client', '.cli'), ('server', '.srv')):
+                with open(capfile + ext, 'wb') as f:
+                    for p in packets[side]:
+                        f.write(struct.pack('<If', len(p), 0.0) + p)
+            self.assertEqual(packets, benchmark.load_capture(capfile))
+        finally:
+            shutil.rmtree(dir)
+
+    def testFilterAndLoopback(self):
+        packets = benchmark.synthetic_session(23, 500)
+        results = benchmark.bench_filter('v23', packets, 23, 1, 'mc3p.plugin.stats', [0, 2])
+        self.assertEqual(['0 plugins', '2 plugins'], [r['variant'] for r in results])
+        results = benchmark.bench_loopback('v23', packets, 1, 'mc3p.plugin.stats', [0, 2])
+        self.assertEqual(['0 plugins', '2 plugins'], [r['variant'] for r in results])
+        self.assertEqual(sum(len(p) for p in packets['client'] + packets['server']),
+                         results[0]['bytes'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, os, shutil, struct, tempfile, time
+
+from mc3p import capture
+from mc3p.capture import CaptureWriter, CaptureReader
+
+# One message every 0.1s, alternating sides, with a chat message every tenth.
+MESSAGES = [(i * 0.1, 'server' if i % 2 else 'client',
+             0x03 if i % 10 == 0 else 0x0b, chr(0x03 if i % 10 == 0 else 0x0b) + 'x' * i)
+            for i in xrange(200)]
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cap.dvr')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, close=True, **kargs):
+        writer = CaptureWriter(self.path, block_size=1024, **kargs)
+        for (t, source, msgtype, data) in MESSAGES:
+            writer.write(t, source, data)
+        if close:
+            writer.close()
+        return writer
+
+    def testRoundTrip(self):
+        self.write()
+        reader = CaptureReader(self.path)
+        self.assertTrue(len(reader.blocks) > 5)
+        self.assertEqual(len(MESSAGES), len(reader))
+        self.assertEqual(MESSAGES, list(reader.messages()))
+        self.assertAlmostEqual(19.9, reader.duration)
+        reader.close()
+
+    def testUncompressed(self):
+        self.write(codec='none')
+        reader = CaptureReader(self.path)
+        self.assertEqual(MESSAGES, list(reader.messages()))
+        reader.close()
+
+    def testViews(self):
+        for codec in ('zlib', 'none'):
+            self.write(codec=codec)
+            reader = CaptureReader(self.path)
+            msgs = list(reader.messages(views=True))
+            self.assertTrue(isinstance(msgs[0][3], buffer))
+            self.assertEqual(MESSAGES, [m[:3] + (str(m[3]),) for m in msgs])
+            reader.close()
+
+    def testSeekAndFilter(self):
+        self.write()
+        reader = CaptureReader(self.path)
+        decompressed = []
+        read_block = reader.read_block
+        reader.read_block = lambda block: decompressed.append(block) or read_block(block)
+
+        msgs = list(reader.messages(start=15.0, end=16.0))
+        self.assertEqual(MESSAGES[150:161], msgs)
+        self.assertTrue(len(decompressed) <= 3)
+
+        # Only blocks holding chat messages are read.
+        del decompressed[:]
+        msgs = list(reader.messages(msgtypes=[0x03]))
+        self.assertEqual([m for m in MESSAGES if m[2] == 0x03], msgs)
+        self.assertEqual(sum(1 for b in reader.blocks if b.has_msgtype(0x03)),
+                         len(decompressed))
+        self.assertTrue(len(decompressed) < len(reader.blocks))
+
+        # Chat messages are all from the client.
+        self.assertEqual([], list(reader.messages(msgtypes=[0x03], source='server')))
+        reader.close()
+
+    def testUnclosedCapture(self):
+        writer = self.write(close=False)
+        writer.file.flush()
+        reader = CaptureReader(self.path)
+        self.assertEqual(len(writer.blocks), len(reader.blocks))
+        self.assertEqual(MESSAGES[:len(reader)], list(reader.messages()))
+        self.assertEqual([b.pack() for b in writer.blocks],
+                         [b.pack() for b in reader.blocks])
+        reader.close()
+        writer.close()
+
+    def testQuietCaptureIsFlushed(self):
+        writer = CaptureWriter(self.path, flush_interval=0.05)
+        writer.write(0.0, 'client', '\x03hi')
+        # Nothing else arrives, but the message is written out anyway.
+        for i in xrange(100):
+            if writer.blocks:
+                break
+            time.sleep(0.01)
+        reader = CaptureReader(self.path)
+        self.assertEqual([(0.0, 'client', 0x03, '\x03hi')], list(reader.messages()))
+        reader.close()
+        writer.close()
+        self.assertFalse(writer.flusher.is_alive())
+
+    def testReadCapture(self):
+        capfile = os.path.join(self.dir, 'cap')
+        self.write()
+        self.assertEqual(MESSAGES, capture.read_capture(capfile))
+        # Older captures, with one file per side.
+        os.remove(self.path)
+        for (source, ext) in (('client', '.cli'), ('server', '.srv')):
+            with open(capfile + ext, 'wb') as f:
+                for (t, s, msgtype, data) in MESSAGES:
+                    if s == source:
+                        f.write(struct.pack('<If', len(data), t) + data)
+        msgs = capture.read_capture(capfile)
+        self.assertEqual([m[1:] for m in MESSAGES], [m[1:] for m in msgs])
+
+    def testNotACapture(self):
+        with open(self.path, 'wb') as f:
+            f.write('\x00' * 64)
+        self.assertRaises(capture.CaptureError, CaptureReader, self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, zlib
+
+from mc3p import blocks
+from mc3p.chunk import chunk_view, numpy
+from mc3p.proxy import Message
+
+def chunk_msg(size_x, size_y, size_z, block_ids, nibbles):
+    """Return a Chunk message at (16,0,32), with all nibble arrays set to nibbles."""
+    n = (size_x + 1) * (size_y + 1) * (size_z + 1)
+    half = (n + 1) // 2
+    data = zlib.compress(''.join(chr(b) for b in block_ids) + chr(nibbles) * 3 * half)
+    return payload_msg(size_x, size_y, size_z, data)
+
+def payload_msg(size_x, size_y, size_z, data):
+    """Return a Chunk message at (16,0,32), with compressed payload data."""
+    return Message({'msgtype': 0x33, 'x': 16, 'y': 0, 'z': 32,
+                    'size_x': size_x, 'size_y': size_y, 'size_z': size_z,
+                    'chunk': {'size': len(data), 'data': data}})
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestChunkView(unittest.TestCase):
+
+    def testArraysAndQueries(self):
+        # 2x4x2 blocks; index = y + z*4 + x*8.
+        ids = [blocks.STONE_BLOCK] * 16
+        ids[3 + 1*4 + 1*8] = blocks.DIAMOND_ORE_BLOCK
+        ids[0] = blocks.BEDROCK_BLOCK
+        msg = chunk_msg(1, 3, 1, ids, 0x21)
+        view = chunk_view(msg)
+        self.assertTrue(view is chunk_view(msg))
+        self.assertEqual((2, 2, 4), view.blocks.shape)
+        self.assertEqual(blocks.DIAMOND_ORE_BLOCK, view.blocks[1, 1, 3])
+        self.assertEqual(1, view.count(blocks.DIAMOND_ORE_BLOCK))
+        self.assertEqual(2, view.count(blocks.DIAMOND_ORE_BLOCK, blocks.BEDROCK_BLOCK))
+        self.assertEqual([[17, 3, 33]], view.coords(blocks.DIAMOND_ORE_BLOCK).tolist())
+        self.assertEqual(14, view.mask(blocks.STONE_BLOCK).sum())
+        # Low nibble first.
+        self.assertEqual([1, 2, 1, 2], view.sky_light[0, 0].tolist())
+        self.assertFalse(msg.modified)
+
+    def testCommitOnlyRecompressesChanges(self):
+        msg = chunk_msg(0, 2, 0, [1, 2, 3], 0x00)
+        data = msg['chunk']['data']
+        view = chunk_view(msg)
+        self.assertFalse(view.commit())
+        # Writing values that were already there changes nothing.
+        view.blocks[0, 0, 1] = 2
+        view.metadata[0, 0, 2] = 0
+        self.assertFalse(view.commit())
+        self.assertTrue(data is msg['chunk']['data'])
+        self.assertFalse(msg.modified)
+
+        view.blocks[0, 0, 1] = blocks.GOLD_ORE_BLOCK
+        view.metadata[0, 0, 2] = 5
+        self.assertTrue(view.modified)
+        self.assertTrue(view.commit())
+        self.assertTrue(msg.modified)
+        self.assertFalse(view.modified)
+        raw = zlib.decompress(msg['chunk']['data'])
+        self.assertEqual(len(msg['chunk']['data']), msg['chunk']['size'])
+        self.assertEqual('\x01\x0e\x03' + '\x00\x05' + '\x00\x00' * 2, raw)
+
+class TestChunkPayload(unittest.TestCase):
+    """ChunkView logic that does not need NumPy."""
+
+    def testNothingDecompressedUntilUsed(self):
+        msg = payload_msg(0, 2, 0, 'not zlib')
+        view = chunk_view(msg)
+        self.assertTrue(view is chunk_view(msg))
+        self.assertFalse(view.modified)
+        self.assertFalse(view.commit())
+        self.assertFalse(msg.modified)
+        self.assertRaises(zlib.error, view._decompress)
+
+    def testShortPayload(self):
+        msg = payload_msg(0, 2, 0, zlib.compress('\x01\x02\x03' + '\x00' * 5))
+        self.assertRaises(ValueError, chunk_view(msg)._decompress)
+
+    def testPayloadReplacedOnlyIfChanged(self):
+        msg = chunk_msg(0, 2, 0, [1, 2, 3], 0x00)
+        data = msg['chunk']['data']
+        view = chunk_view(msg)
+        self.assertFalse(view._replace(zlib.decompress(data)))
+        self.assertTrue(data is msg['chunk']['data'])
+        self.assertFalse(msg.modified)
+
+        raw = '\x01\x0e\x03' + '\x00\x05' + '\x00\x00' * 2
+        self.assertTrue(view._replace(raw))
+        self.assertTrue(msg.modified)
+        self.assertEqual(raw, zlib.decompress(msg['chunk']['data']))
+        self.assertEqual(len(msg['chunk']['data']), msg['chunk']['size'])
+        self.assertFalse(view._replace(raw))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, socket
+
+from mc3p import messages
+from mc3p.util import Stream
+from mc3p.parsing import parse_unsigned_byte
+from mc3p.plugin.dvr import MockServer, LoadSession, rename, load_report
+
+class TestMockServer(unittest.TestCase):
+
+    def setUp(self):
+        self.sock, self.peer = socket.socketpair()
+        self.sent = []
+
+    def tearDown(self):
+        self.server.close()
+        self.peer.close()
+
+    def mock_server(self, msgs, timescale):
+        self.server = MockServer(self.sock, msgs, 'server', timescale)
+        send = self.server.send
+        self.server.send = lambda data: self.sent.append(str(data)) or send(data)
+        return self.server
+
+    def testCoalescesDueMessages(self):
+        msgs = [(0.0, buffer('\x00abc')), (0.0, '\x03xy'), (3600.0, '\x00late')]
+        server = self.mock_server(msgs, 1.0)
+        self.assertTrue(server.writable())
+        server.handle_write()
+        self.assertFalse(server.writable())
+        self.assertEqual(['\x00abc\x03xy'], self.sent)
+        self.assertEqual(2, server.sent_msgs)
+        self.assertEqual('\x00abc\x03xy', self.peer.recv(100))
+
+    def testAsFastAsPossible(self):
+        msgs = [(i, '\x00' * 10) for i in xrange(100)] + [(100.0, '\xffbye')]
+        server = self.mock_server(msgs, 0)
+        self.assertTrue(server.writable())
+        server.handle_write()
+        self.assertEqual([''.join(data for (t, data) in msgs)], self.sent)
+        self.assertTrue(server.closing)
+        self.assertFalse(server.connected)
+
+class TestLoadTest(unittest.TestCase):
+
+    def testRename(self):
+        cli_msgs = messages.protocol[23][0]
+        login = {'msgtype': 0x01, 'proto_version': 23, 'username': u'steve',
+                 'nu1': 0, 'nu7': u'', 'nu2': 0, 'nu3': 0, 'nu4': 0, 'nu5': 0, 'nu6': 0}
+        msgs = [(0.0, cli_msgs[0x02].emit({'msgtype': 0x02, 'username': u'steve;host:25565'})),
+                (0.1, cli_msgs[0x01].emit(login)),
+                (0.2, cli_msgs[0x03].emit({'msgtype': 0x03, 'chat_msg': u'\x01'}))]
+        renamed = list(rename(msgs, 'mc3p7'))
+        self.assertEqual([0.0, 0.1, 0.2], [t for (t, data) in renamed])
+        self.assertEqual(msgs[2], renamed[2])
+        parsed = []
+        for (t, data) in renamed[:2]:
+            stream = Stream()
+            stream.append(data)
+            parsed.append(cli_msgs[parse_unsigned_byte(stream)].parse(stream))
+        self.assertEqual(u'mc3p7;host:25565', parsed[0]['username'])
+        self.assertEqual(u'mc3p7', parsed[1]['username'])
+        self.assertEqual(23, parsed[1]['proto_version'])
+
+    def testLatencies(self):
+        session = LoadSession('mc3p0')
+        session.sent(10)
+        session.sent(25)
+        session.received(9)
+        self.assertEqual([], session.latencies)
+        session.received(5)
+        self.assertEqual(1, len(session.latencies))
+        session.received(1000)
+        self.assertEqual(2, len(session.latencies))
+        self.assertTrue(all(0 <= l < 1 for l in session.latencies))
+        lines = load_report([session], 1.0, 1.0)
+        self.assertTrue(lines[3].startswith('server to client latency over 2 batches'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, array
+
+from mc3p.entities import EntityTracker
+
+def mob_msg(eid, x, y, z, yaw=0, pitch=0):
+    """Return a Mob spawn message at block coordinates (x, y, z)."""
+    return {'msgtype': 0x18, 'eid': eid, 'mob_type': 90,
+            'x': x * 32, 'y': y * 32, 'z': z * 32,
+            'yaw': yaw, 'pitch': pitch, 'metadata': {}}
+
+class TestEntityTracker(unittest.TestCase):
+
+    def testSpawnAndMoves(self):
+        entities = EntityTracker()
+        entities.update(mob_msg(5, 10, 64, -3, yaw=12, pitch=-4))
+        self.assertTrue(5 in entities)
+        self.assertEqual((10.0, 64.0, -3.0), entities.position(5))
+        self.assertEqual((12, -4), entities.look(5))
+        entities.update({'msgtype': 0x1f, 'eid': 5, 'dx': 16, 'dy': -32, 'dz': 8})
+        self.assertEqual((10.5, 63.0, -2.75), entities.position(5))
+        entities.update({'msgtype': 0x21, 'eid': 5, 'dx': -16, 'dy': 0, 'dz': 0,
+                         'yaw': 100, 'pitch': 1})
+        self.assertEqual((10.0, 63.0, -2.75), entities.position(5))
+        self.assertEqual((100, 1), entities.look(5))
+        entities.update({'msgtype': 0x20, 'eid': 5, 'yaw': -7, 'pitch': 2})
+        self.assertEqual((-7, 2), entities.look(5))
+        entities.update({'msgtype': 0x22, 'eid': 5, 'x': -320, 'y': 2048, 'z': 64,
+                         'yaw': 0, 'pitch': 0})
+        self.assertEqual((-10.0, 64.0, 2.0), entities.position(5))
+        # Paintings are placed at block coordinates.
+        entities.update({'msgtype': 0x19, 'eid': 6, 'title': 'Kebab',
+                         'x': 1, 'y': 2, 'z': 3, 'type': 0})
+        self.assertEqual((1.0, 2.0, 3.0), entities.position(6))
+        # Moves of unknown entities are ignored.
+        entities.update({'msgtype': 0x1f, 'eid': 99, 'dx': 1, 'dy': 1, 'dz': 1})
+        self.assertEqual(2, len(entities))
+
+    def testDestroyReusesSlots(self):
+        entities = EntityTracker()
+        entities.update(mob_msg(1, 0, 0, 0))
+        entities.update(mob_msg(2, 0, 0, 0))
+        slot = entities.slot(1)
+        entities.update({'msgtype': 0x1d, 'eid': 1})
+        self.assertFalse(1 in entities)
+        self.assertEqual(None, entities.position(1))
+        self.assertEqual(EntityTracker.FREE, entities.eid[slot])
+        entities.update(mob_msg(3, 0, 0, 0))
+        self.assertEqual(slot, entities.slot(3))
+        self.assertEqual(2, len(entities.eid))
+        entities.update({'msgtype': 0x09, 'world': 0, 'difficulty': 1, 'mode': 0,
+                         'world_height': 128, 'map_seed': 0})
+        self.assertEqual(0, len(entities))
+
+    def testWithin(self):
+        entities = EntityTracker()
+        entities.update(mob_msg(1, 0, 64, 0))
+        entities.update(mob_msg(2, 15, 64, 0))
+        entities.update(mob_msg(3, -17, 64, 0))
+        entities.update(mob_msg(4, 0, 64, 40))
+        entities.update(mob_msg(5, 0, 84, 0))
+        self.assertEqual([1], entities.within(1, 64, 0, 2))
+        self.assertEqual(set([1, 2, 3]), set(entities.within(0, 64, 0, 17)))
+        self.assertEqual(set([1, 2, 3, 5]), set(entities.within(0, 64, 0, 20)))
+        # Moving entity 4 across cells keeps the index up to date.
+        entities.update({'msgtype': 0x22, 'eid': 4, 'x': 0, 'y': 2048, 'z': 32,
+                         'yaw': 0, 'pitch': 0})
+        self.assertEqual(set([1, 4]), set(entities.within(0, 64, 0, 2)))
+        self.assertEqual([], entities.within(0, 64, 40, 2))
+        self.assertFalse((0, 2) in entities.cells)
+
+    def testOutOfRangeValuesDropTheEntity(self):
+        entities = EntityTracker()
+        far = 2 ** 64
+        # A spawn that does not fit is not tracked, and leaves no slot behind.
+        entities.update(mob_msg(1, 0, 64, 0))
+        entities.update(mob_msg(2, far, 64, 0))
+        self.assertFalse(2 in entities)
+        self.assertEqual(1, len(entities.eid))
+        entities.update({'msgtype': 0x1d, 'eid': 1})
+        entities.update(mob_msg(3, 0, 64, far))
+        self.assertEqual(0, len(entities))
+        self.assertEqual([EntityTracker.FREE], list(entities.eid))
+        entities.update(mob_msg(4, 1, 64, 1))
+        self.assertEqual((1.0, 64.0, 1.0), entities.position(4))
+        # An entity teleported or moved out of range is dropped.
+        entities.update({'msgtype': 0x22, 'eid': 4, 'x': 32, 'y': far, 'z': 32,
+                         'yaw': 0, 'pitch': 0})
+        self.assertFalse(4 in entities)
+        self.assertEqual({}, entities.cells)
+        entities.update(mob_msg(5, 0, 64, 0))
+        entities.update({'msgtype': 0x1f, 'eid': 5, 'dx': far, 'dy': 0, 'dz': 0})
+        self.assertFalse(5 in entities)
+        self.assertEqual([], entities.within(0, 64, 0, 100))
+        # Paintings far away overflow 32 bits once scaled to absolute units.
+        entities.update({'msgtype': 0x19, 'eid': 6, 'title': 'Kebab',
+                         'x': 2 ** 30, 'y': 2, 'z': 3, 'type': 0})
+        if array.array('l').itemsize >= 8:
+            self.assertEqual((2.0 ** 30, 2.0, 3.0), entities.position(6))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, logging, socket, asyncore
+
+from mc3p import eventloop, messages
+from mc3p.eventloop import BufferedDispatcher
+from mc3p.proxy import MinecraftProxy, MinecraftSession
+from mc3p.plugins import PluginConfig
+
+class Sink(BufferedDispatcher):
+    def __init__(self, sock, map):
+        BufferedDispatcher.__init__(self, sock, map, high_water=1000)
+        self.received = []
+        self.events = []
+
+    def handle_read(self):
+        self.received.append(self.recv(self.RECV_SIZE))
+
+    def pause_writing(self):
+        self.events.append('pause')
+
+    def resume_writing(self):
+        self.events.append('resume')
+
+class TestBufferedDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+        a, b = socket.socketpair()
+        self.a = Sink(a, self.map)
+        self.b = Sink(b, self.map)
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def _run(self, kind):
+        data = ''.join(chr(i % 256) * 100 for i in xrange(20000))
+        for i in xrange(0, len(data), 1000):
+            self.a.send(data[i:i+1000])
+        n = 0
+        while sum(map(len, self.b.received)) < len(data) and n < 1000:
+            eventloop.loop(kind, timeout=1, map=self.map, count=1)
+            n += 1
+        self.assertEqual(data, ''.join(self.b.received))
+        self.assertEqual(0, self.a.out_bytes)
+        self.assertEqual(['pause', 'resume'], self.a.events)
+
+    def testEpollLoop(self):
+        if hasattr(eventloop.select, 'epoll'):
+            self._run('epoll')
+
+    def testPollLoop(self):
+        self._run('poll')
+
+class TestBackpressure(unittest.TestCase):
+
+    def testSlowPeerPausesOtherSide(self):
+        cli_sock, cli_peer = socket.socketpair()
+        srv_sock, srv_peer = socket.socketpair()
+        cli = MinecraftProxy(cli_sock)
+        srv = MinecraftProxy(srv_sock, cli)
+        try:
+            cli.set_write_buffer_limits(64 * 1024)
+            # Nobody reads cli_peer, so data for the client piles up.
+            for i in xrange(100):
+                cli.send('x' * 16 * 1024)
+                if srv.reading_paused:
+                    break
+            self.assertTrue(srv.reading_paused)
+            self.assertFalse(srv.readable())
+            self.assertEqual(1, srv.pauses)
+            cli_peer.setblocking(0)
+            while cli.out_bytes > cli.low_water:
+                try:
+                    cli_peer.recv(1024 * 1024)
+                except socket.error:
+                    pass
+                cli.handle_write()
+            self.assertFalse(srv.reading_paused)
+        finally:
+            cli.close()
+            srv.close()
+            cli_peer.close()
+            srv_peer.close()
+
+class StubChannel(object):
+    delivered = 0
+    def get_all(self):
+        return None
+
+class StubPluginManager(object):
+    """Forwards everything, and observes every msgtype."""
+    inspected = None
+    observed = frozenset(xrange(256))
+
+    def __init__(self):
+        self.queued = []
+        self.flushed = []
+
+    def injection_channel(self, source):
+        return StubChannel()
+
+    def filter(self, msg, source):
+        return True
+
+    def observe(self, msgtype, msgbytes, source):
+        self.queued.append(msgtype)
+
+    def flush(self):
+        self.flushed.extend(self.queued)
+        self.queued = []
+
+class TestRelay(unittest.TestCase):
+
+    def _login(self):
+        spec = messages.protocol[23][0]
+        return spec[0x02].emit({'username': u'bob'}) + \
+               spec[0x01].emit({'proto_version': 23, 'username': u'bob', 'nu1': 0,
+                                'nu7': u'', 'nu2': 0, 'nu3': 0, 'nu4': 0,
+                                'nu5': 0, 'nu6': 0})
+
+    def testRelayAfterLogin(self):
+        cli_sock, cli_peer = socket.socketpair()
+        srv_sock, srv_peer = socket.socketpair()
+        cli = MinecraftProxy(cli_sock)
+        srv = MinecraftProxy(srv_sock, cli)
+        try:
+            cli.relay_after_login = True
+            login = self._login()
+            # Not a valid packet, but it is relayed rather than parsed.
+            rest = '\x99garbage' * 1000
+            cli_peer.sendall(login + rest[:100])
+            cli.handle_read()
+            self.assertTrue(cli.relaying)
+            self.assertTrue(srv.msg_spec is messages.tables(23)[1])
+            self.assertFalse(cli.out_of_sync)
+            cli_peer.sendall(rest[100:])
+            cli.handle_read()
+            srv_peer.setblocking(0)
+            got = ''
+            while len(got) < len(login + rest):
+                got += srv_peer.recv(1024 * 1024)
+            self.assertEqual(login + rest, got)
+            self.assertEqual(len(login + rest), cli.stream.tot_bytes)
+            self.assertEqual(0, len(cli.stream.buf))
+        finally:
+            cli.close()
+            srv.close()
+            cli_peer.close()
+            srv_peer.close()
+
+    def testObserversFlushedWhenRelayStarts(self):
+        cli_sock, cli_peer = socket.socketpair()
+        srv_sock, srv_peer = socket.socketpair()
+        cli = MinecraftProxy(cli_sock)
+        srv = MinecraftProxy(srv_sock, cli)
+        try:
+            cli.relay_after_login = True
+            cli.plugin_mgr = StubPluginManager()
+            cli_peer.sendall(self._login())
+            cli.handle_read()
+            self.assertTrue(cli.relaying)
+            self.assertEqual([0x02, 0x01], cli.plugin_mgr.flushed)
+        finally:
+            cli.close()
+            srv.close()
+            cli_peer.close()
+            srv_peer.close()
+
+class TestSession(unittest.TestCase):
+
+    def _loop(self, session, done):
+        """Run the event loop over session's proxies until done() is true."""
+        for i in xrange(100):
+            if done():
+                return
+            proxies = (session.cli_proxy, session.srv_proxy)
+            map = dict((fd, p) for (fd, p) in asyncore.socket_map.items() if p in proxies)
+            asyncore.loop(timeout=0.05, use_poll=True, map=map, count=1)
+        self.fail("Event loop did not get there")
+
+    def testConnectsWithoutBlocking(self):
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        cli_sock, cli_peer = socket.socketpair()
+        session = MinecraftSession(PluginConfig(), cli_sock, '127.0.0.1',
+                                   server.getsockname()[1])
+        try:
+            self.assertTrue(session.active)
+            # The client is not read from until the server is connected.
+            self.assertFalse(session.cli_proxy.readable())
+            self._loop(session, lambda: session.srv_proxy.connected)
+            self.assertTrue(session.cli_proxy.readable())
+        finally:
+            session.cli_proxy.close()
+            session.srv_proxy.close()
+            cli_peer.close()
+            server.close()
+
+    def testFailedConnectClosesClient(self):
+        unused = socket.socket()
+        unused.bind(('127.0.0.1', 0))
+        port = unused.getsockname()[1]
+        unused.close()
+        cli_sock, cli_peer = socket.socketpair()
+        session = MinecraftSession(PluginConfig(), cli_sock, '127.0.0.1', port)
+        try:
+            if session.active:
+                self._loop(session, lambda: not session.active)
+            self.assertFalse(session.active)
+            self.assertFalse(session.cli_proxy in asyncore.socket_map.values())
+            self.assertEqual('', cli_peer.recv(1)) # Client connection closed.
+        finally:
+            cli_peer.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
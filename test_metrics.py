@@ -0,0 +1,67 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, logging
+
+from mc3p import metrics
+from mc3p.plugins import PluginConfig
+from mc3p.proxy import MinecraftListener
+
+class TestMetrics(unittest.TestCase):
+
+    def testCounterAndHistogramRendering(self):
+        c = metrics.Counter('t_total', 'test counter', ('direction', 'msgtype'))
+        c.inc(('client', 0x0b))
+        c.inc(('client', 0x0b), 2)
+        self.assertEqual('# HELP t_total test counter\n# TYPE t_total counter\n' +
+                         't_total{direction="client",msgtype="0x0b"} 3', c.render())
+
+        h = metrics.Histogram('t_seconds', 'test histogram', ('plugin',), buckets=(0.1, 1))
+        h.observe(0.05, ('p',))
+        h.observe(0.5, ('p',))
+        lines = h.render().split('\n')[2:]
+        self.assertEqual(['t_seconds_bucket{plugin="p",le="0.1"} 1',
+                          't_seconds_bucket{plugin="p",le="1"} 2',
+                          't_seconds_bucket{plugin="p",le="+Inf"} 2',
+                          't_seconds_sum{plugin="p"} 0.55',
+                          't_seconds_count{plugin="p"} 2'], lines)
+
+    def testTimedHandler(self):
+        before = metrics.filter_time.values.get(('t',), [None, 0.0, 0])[2]
+        hdlr = metrics.timed(lambda msg, source: False, 't')
+        self.assertFalse(hdlr({'msgtype': 0x03}, 'client'))
+        self.assertEqual(before + 1, metrics.filter_time.values[('t',)][2])
+
+    def testGaugeFunctions(self):
+        g = metrics.Gauge('t_gauge', 'test gauge', ('session',))
+        g.add_function(lambda: [((1,), 10), ((2,), 20)])
+        self.assertEqual(['t_gauge{session="1"} 10', 't_gauge{session="2"} 20'],
+                         g.render().split('\n')[2:])
+        g.remove_function(g.functions[0])
+        self.assertEqual([], g.render().split('\n')[2:])
+
+    def testClosedListenerStopsReporting(self):
+        gauges = [metrics.sessions_active, metrics.session_bytes, metrics.session_buffered]
+        before = [len(g.functions) for g in gauges]
+        listener = MinecraftListener(PluginConfig(), 0, '127.0.0.1', 25565)
+        self.assertEqual([n + 1 for n in before], [len(g.functions) for g in gauges])
+        listener.close()
+        self.assertEqual(before, [len(g.functions) for g in gauges])
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
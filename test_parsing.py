@@ -0,0 +1,276 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, logging
+
+from mc3p import messages
+from mc3p.util import Stream, PartialPacketException
+from mc3p.parsing import parse_unsigned_byte, compile_fields, MC_int, MC_byte, MC_string, MC_double
+from mc3p.parsing import unpack_block_coords, defmsg, record_class
+from mc3p.proxy import parse_packet, emit_packet
+
+cli_msgs, srv_msgs = messages.protocol[23]
+
+def parse_one(stream, msg_spec):
+    msgtype = parse_unsigned_byte(stream)
+    msg = msg_spec[msgtype].parse(stream)
+    msg['raw_bytes'] = stream.packet_finished()
+    return msg
+
+class TestStream(unittest.TestCase):
+
+    def testPartialRead(self):
+        s = Stream()
+        s.append('abc')
+        self.assertEqual('ab', s.read(2).tobytes())
+        self.assertRaises(PartialPacketException, s.read, 2)
+        # A failed read rewinds to the start of the packet.
+        self.assertEqual(3, len(s))
+        s.append('d')
+        self.assertEqual('abcd', s.read(4).tobytes())
+        self.assertEqual('abcd', s.packet_finished())
+        self.assertEqual(4, s.tot_bytes)
+        self.assertEqual(2, s.reparsed_bytes)
+        self.assertEqual(1, s.partial_parses)
+
+    def testChunkNeedsWholePacket(self):
+        chunk = {'msgtype': 0x33, 'x': 0, 'y': 0, 'z': 0, 'size_x': 15,
+                 'size_y': 127, 'size_z': 15,
+                 'chunk': {'size': 5000, 'data': 'z' * 5000}}
+        data = srv_msgs[0x33].emit(chunk)
+        s = Stream()
+        s.append(data[:100])
+        self.assertRaises(PartialPacketException, parse_one, s, srv_msgs)
+        # The chunk's size field tells the stream how long the packet is.
+        self.assertEqual(len(data), s.need)
+        rest = data[100:-1]
+        for i in xrange(0, len(rest), 1000):
+            s.append(rest[i:i+1000])
+            self.assertFalse(s.ready())
+        s.append(data[-1:])
+        self.assertTrue(s.ready())
+        self.assertEqual(chunk['chunk'], parse_one(s, srv_msgs)['chunk'])
+        self.assertEqual(1, s.partial_parses)
+
+    def testCompaction(self):
+        s = Stream()
+        pkt = 'x' * 1000
+        for i in xrange(300):
+            s.append(pkt)
+            self.assertEqual(pkt, s.read(1000).tobytes())
+            self.assertEqual(pkt, s.packet_finished())
+        self.assertTrue(len(s.buf) <= 2 * Stream.COMPACT_MIN)
+        self.assertEqual(300000, s.tot_bytes)
+
+    def testMessageRoundTrip(self):
+        msg = {'msgtype': 0x0b, 'x': 1.5, 'y': 64.0, 'stance': 65.62,
+               'z': -3.25, 'on_ground': True}
+        data = cli_msgs[0x0b].emit(msg)
+        s = Stream()
+        s.append(data[:10])
+        self.assertRaises(PartialPacketException, parse_one, s, cli_msgs)
+        s.append(data[10:] + cli_msgs[0x03].emit({'msgtype': 0x03, 'chat_msg': u'hi'}))
+        parsed = parse_one(s, cli_msgs)
+        self.assertEqual(data, parsed.pop('raw_bytes'))
+        self.assertEqual(msg, parsed)
+        self.assertEqual(u'hi', parse_one(s, cli_msgs)['chat_msg'])
+        self.assertEqual(0, len(s))
+
+    def testLoginRoundTrip(self):
+        for version in (17, 23):
+            msg = {'msgtype': 0x01, 'proto_version': version, 'username': u'foo',
+                   'nu1': 0, 'nu2': 0, 'nu3': 0, 'nu4': 0, 'nu5': 0, 'nu6': 0}
+            if version >= 23:
+                msg['nu7'] = u''
+            data = cli_msgs[0x01].emit(msg)
+            s = Stream()
+            s.append(data)
+            parsed = parse_one(s, cli_msgs)
+            self.assertEqual(data, parsed.pop('raw_bytes'))
+            self.assertEqual(msg, parsed)
+
+class TestCompiledMessages(unittest.TestCase):
+
+    def testFixedWidthRunsAreMerged(self):
+        steps = compile_fields([('a', MC_int), ('b', MC_byte), ('s', MC_string),
+                                ('c', MC_double)])
+        self.assertEqual(3, len(steps))
+        self.assertEqual(('a', 'b'), steps[0][0])
+        self.assertEqual('>ib', steps[0][1].format)
+        self.assertEqual(('s', None, MC_string), steps[1])
+        self.assertEqual(('c',), steps[2][0])
+
+    def testMixedMessageRoundTrip(self):
+        msg = {'msgtype': 0x0f, 'x': 10, 'y': 64, 'z': -20, 'dir': 3,
+               'details': {'item_id': 0x04, 'count': 12, 'uses': 0}}
+        data = cli_msgs[0x0f].emit(msg)
+        s = Stream()
+        s.append(data)
+        parsed = parse_one(s, cli_msgs)
+        self.assertEqual(data, parsed.pop('raw_bytes'))
+        self.assertEqual(msg, parsed)
+
+    def testSkipMatchesParse(self):
+        msgs = [(cli_msgs, {'msgtype': 0x03, 'chat_msg': u'hello'}),
+                (cli_msgs, {'msgtype': 0x0c, 'yaw': 1.0, 'pitch': 2.0, 'on_ground': True}),
+                (srv_msgs, {'msgtype': 0x34, 'chunk_x': 1, 'chunk_z': 2,
+                            'changes': {'coord_array': [1, 2], 'type_array': [3, 4],
+                                        'metadata_array': [0, 0]}}),
+                (srv_msgs, {'msgtype': 0xfa, 'channel': u'MC|x', 'data': 'abc'})]
+        for (spec, msg) in msgs:
+            data = spec[msg['msgtype']].emit(msg)
+            s = Stream()
+            s.append(data + '\x00')
+            parse_unsigned_byte(s)
+            spec[msg['msgtype']].skip(s)
+            self.assertEqual(data, s.packet_finished())
+
+    def testMultiBlockChangeArrays(self):
+        coords = [15 << 12 | 3 << 8 | 127, 1 << 12 | 14 << 8 | 0, 0]
+        msg = {'msgtype': 0x34, 'chunk_x': 1, 'chunk_z': -2,
+               'changes': {'coord_array': [c - 0x10000 if c > 0x7fff else c for c in coords],
+                           'type_array': [1, 2, -3], 'metadata_array': [0, 15, 4]}}
+        data = srv_msgs[0x34].emit(msg)
+        self.assertEqual(1 + 4 + 4 + 2 + 3 * 4, len(data))
+        s = Stream()
+        s.append(data)
+        changes = parse_one(s, srv_msgs)['changes']
+        self.assertEqual(msg['changes']['coord_array'], changes['coord_array'].tolist())
+        self.assertEqual([1, 2, -3], changes['type_array'].tolist())
+        self.assertEqual([0, 15, 4], changes['metadata_array'].tolist())
+        self.assertEqual(data, srv_msgs[0x34].emit(dict(msg, changes=changes)))
+        (xs, ys, zs) = unpack_block_coords(changes['coord_array'])
+        self.assertEqual([15, 1, 0], xs.tolist())
+        self.assertEqual([127, 0, 0], ys.tolist())
+        self.assertEqual([3, 14, 0], zs.tolist())
+
+class TestPatch(unittest.TestCase):
+
+    def testPatchFixedWidthFields(self):
+        msg = {'msgtype': 0x0b, 'x': 1.5, 'y': 64.0, 'stance': 65.62, 'z': -3.0,
+               'on_ground': True}
+        raw = cli_msgs[0x0b].emit(msg)
+        msg.update(x=2.5, on_ground=False)
+        patched = cli_msgs[0x0b].patch(raw, msg, ['x', 'on_ground'])
+        self.assertEqual(cli_msgs[0x0b].emit(msg), patched)
+
+    def testPatchFieldsBeforeVariableWidthField(self):
+        msg = {'msgtype': 0x14, 'eid': 7, 'name': u'Notch', 'x': 32, 'y': 2048, 'z': -64,
+               'rotation': 0, 'pitch': 0, 'curr_item': 0}
+        raw = srv_msgs[0x14].emit(msg)
+        msg['eid'] = 8
+        self.assertEqual(srv_msgs[0x14].emit(msg), srv_msgs[0x14].patch(raw, msg, ['eid']))
+
+    def testVariableWidthFieldsAreNotPatched(self):
+        msg = {'msgtype': 0x14, 'eid': 7, 'name': u'Notch', 'x': 32, 'y': 2048, 'z': -64,
+               'rotation': 0, 'pitch': 0, 'curr_item': 0}
+        raw = srv_msgs[0x14].emit(msg)
+        self.assertEqual(None, srv_msgs[0x14].patch(raw, msg, ['eid', 'name']))
+        # x follows name, so its offset varies.
+        self.assertEqual(None, srv_msgs[0x14].patch(raw, msg, ['x']))
+        self.assertEqual(None, srv_msgs[0x14].patch(raw, msg, ['chunk_view']))
+        self.assertEqual(None, MC_int.patch(raw, msg, ['x']))
+
+    def testEmitModifiedPacket(self):
+        data = srv_msgs[0x14].emit({'msgtype': 0x14, 'eid': 7, 'name': u'Notch', 'x': 32,
+                                    'y': 2048, 'z': -64, 'rotation': 0, 'pitch': 0,
+                                    'curr_item': 0})
+        s = Stream()
+        s.append(data)
+        packet = parse_packet(s, srv_msgs, 'server')
+        self.assertFalse(packet.modified)
+        packet['eid'] = 7
+        self.assertFalse(packet.modified)
+        packet['eid'] = 8
+        packet['name'] = u'Notch'
+        self.assertEqual(set(['eid']), packet.modified)
+        self.assertEqual(srv_msgs[0x14].emit(packet), emit_packet(packet, srv_msgs))
+        packet['name'] = u'jeb_'
+        self.assertEqual(set(['eid', 'name']), packet.modified)
+        self.assertEqual(srv_msgs[0x14].emit(packet), emit_packet(packet, srv_msgs))
+
+class TestRecords(unittest.TestCase):
+
+    def parse(self, spec, msg):
+        s = Stream()
+        s.append(spec[msg['msgtype']].emit(msg))
+        return parse_packet(s, spec, 'server')
+
+    def testDictAccess(self):
+        fields = {'msgtype': 0x14, 'eid': 7, 'name': u'Notch', 'x': 32, 'y': 2048,
+                  'z': -64, 'rotation': 0, 'pitch': 0, 'curr_item': 0}
+        msg = self.parse(srv_msgs, fields)
+        self.assertTrue(isinstance(msg, srv_msgs[0x14].record))
+        self.assertEqual(32, msg['x'])
+        self.assertEqual(32, msg.x)
+        self.assertEqual(0x14, msg['msgtype'])
+        self.assertTrue('raw_bytes' in msg and 'x' in msg)
+        self.assertFalse('chunk_view' in msg)
+        self.assertEqual(None, msg.get('chunk_view'))
+        self.assertRaises(KeyError, lambda: msg['chunk_view'])
+        self.assertEqual(['msgtype', 'eid', 'name', 'x', 'y', 'z', 'rotation', 'pitch',
+                          'curr_item', 'raw_bytes'], msg.keys())
+        raw = msg.pop('raw_bytes')
+        self.assertEqual(fields, msg)
+        self.assertEqual(dict(fields, raw_bytes=raw), dict(msg, raw_bytes=raw))
+        self.assertRaises(TypeError, msg.pop, 'x')
+        self.assertRaises(ValueError, msg.__setitem__, 'msgtype', 0x15)
+
+    def testModifiedKeys(self):
+        msg = self.parse(srv_msgs, {'msgtype': 0x22, 'eid': 1, 'x': 1, 'y': 2, 'z': 3,
+                                    'yaw': 0, 'pitch': 0})
+        msg['x'] = 1
+        msg['chunk_view'] = 'view'
+        self.assertFalse(msg.modified)
+        msg.update(x=5, y=2)
+        msg['chunk_view'] = 'other view'
+        self.assertEqual(set(['x', 'chunk_view']), msg.modified)
+        self.assertEqual('other view', msg['chunk_view'])
+
+    def testRecordClasses(self):
+        self.assertEqual('EntityLookRelativeMove', srv_msgs[0x21].record.__name__)
+        self.assertRaises(ValueError, record_class, 0x99, 'Test message', ('x', 'keys'))
+        self.assertRaises(ValueError, record_class, 0x99, 'Test message', ('x', 'x'))
+
+class TestProtocolTables(unittest.TestCase):
+
+    def testLazyCompilation(self):
+        pairs = [('eid', MC_int), ('name', MC_string)]
+        parsem = defmsg(0x99, "Test message", pairs)
+        self.assertTrue(parsem is defmsg(0x99, "Test message", list(pairs)))
+        self.assertFalse(parsem is defmsg(0x99, "Test message", pairs[:1]))
+        self.assertFalse(parsem.compiled)
+        data = parsem.emit({'msgtype': 0x99, 'eid': 3, 'name': u'x'})
+        self.assertTrue(parsem.compiled)
+        s = Stream()
+        s.append(data)
+        parse_unsigned_byte(s)
+        self.assertEqual({'msgtype': 0x99, 'eid': 3, 'name': u'x'}, parsem.parse(s))
+
+    def testTables(self):
+        cli, srv = messages.tables(23)
+        self.assertTrue(messages.tables(23)[0] is cli)
+        self.assertTrue(isinstance(srv, tuple))
+        self.assertEqual(list(srv), messages.protocol[23][1])
+        self.assertTrue(all(p.compiled for p in cli if hasattr(p, 'compiled')))
+        # Versions share the codecs of messages they have in common.
+        self.assertTrue(messages.tables(22)[0][0x0f] is cli[0x0f])
+        self.assertRaises(KeyError, messages.tables, 1)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
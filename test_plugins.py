@@ -15,9 +15,11 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import sys, unittest, shutil, tempfile, os, os.path, logging, imp
+import sys, unittest, shutil, tempfile, os, os.path, logging, imp, asyncore
 
 from mc3p.plugins import PluginConfig, PluginManager, MC3Plugin, msghdlr
+from mc3p.plugins import InjectionChannel
+from mc3p import messages
 
 MOCK_PLUGIN_CODE = """
 from mc3p.plugins import MC3Plugin, msghdlr
@@ -225,6 +227,151 @@ class TestPluginManager(unittest.TestCase):
         p1.drop_next_msg = True
         self.assertTrue(self.pmgr.filter({'msgtype': 0x04, 'time': 42}, 'client'))
 
+    def testInspectedMsgtypes(self):
+        mockplugin = self._write_and_load('mockplugin', MOCK_PLUGIN_CODE)
+        pcfg = PluginConfig().add('mockplugin', 'p1')
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.assertEqual(None, self.pmgr.inspected)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        self.assertEqual(set([0x03]), self.pmgr.inspected)
+
+    def testDispatchSkipsIgnoringPlugins(self):
+        mockplugin = self._write_and_load('mockplugin', MOCK_PLUGIN_CODE)
+        pcfg = PluginConfig().add('mockplugin', 'p1').add('mockplugin', 'p2')
+        pcfg.order(0x03, ['p2', 'p1'])
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        dispatch = getattr(self.pmgr, '_PluginManager__dispatch')
+        self.assertEqual((), dispatch[0x04])
+        self.assertEqual(2, len(dispatch[0x03]))
+        p1, p2 = mockplugin.instances
+        # p2 comes first for chat messages, so p1 never sees a dropped one.
+        p2.drop_next_msg = True
+        self.assertFalse(self.pmgr.filter({'msgtype': 0x03, 'chat_msg': 'x'}, 'client'))
+        self.assertEqual(None, p1.last_msg)
+
+    def testWorldCacheSharedWithPlugins(self):
+        code = MOCK_PLUGIN_CODE.replace("class MockPlugin(MC3Plugin):\n",
+                                        "class MockPlugin(MC3Plugin):\n    uses_world = True\n")
+        worldplugin = self._write_and_load('worldplugin', code)
+        pcfg = PluginConfig().add('worldplugin', 'p1').add('worldplugin', 'p2')
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        p1, p2 = worldplugin.instances
+        self.assertTrue(p1.world is not None)
+        self.assertTrue(p1.world is p2.world)
+        self.assertTrue(0x35 in self.pmgr.inspected)
+        self.pmgr.filter({'msgtype': 0x32, 'x': 0, 'z': 0, 'mode': False}, 'server')
+        self.assertEqual(0, len(p1.world))
+
+    def testNoWorldCacheUnlessUsed(self):
+        noworldplugin = self._write_and_load('noworldplugin', MOCK_PLUGIN_CODE)
+        pcfg = PluginConfig().add('noworldplugin', 'p1')
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        self.assertEqual(None, noworldplugin.instances[0].world)
+        self.assertFalse(0x35 in self.pmgr.inspected)
+
+    def testEntityTrackerSharedWithPlugins(self):
+        code = MOCK_PLUGIN_CODE.replace("class MockPlugin(MC3Plugin):\n",
+                                        "class MockPlugin(MC3Plugin):\n    uses_entities = True\n")
+        entityplugin = self._write_and_load('entityplugin', code)
+        pcfg = PluginConfig().add('entityplugin', 'p1').add('entityplugin', 'p2')
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        p1, p2 = entityplugin.instances
+        self.assertTrue(p1.entities is p2.entities)
+        self.assertEqual(None, p1.world)
+        self.assertTrue(0x1f in self.pmgr.inspected)
+        self.pmgr.filter({'msgtype': 0x1a, 'eid': 7, 'x': 32, 'y': 64, 'z': 96,
+                          'count': 1}, 'server')
+        self.assertEqual((1.0, 2.0, 3.0), p1.entities.position(7))
+
+    def testInjectedMessagesAreEncoded(self):
+        class Channel(list):
+            put = list.append
+        from_client, from_server = Channel(), Channel()
+        p = MC3Plugin(23, from_client, from_server)
+        p.to_server({'msgtype': 0x03, 'chat_msg': u'hi'})
+        p.to_client({'msgtype': 0x04, 'time': 1000})
+        p.to_client({'msgtype': 0xf0})
+        p.to_client({'time': 1000})
+        self.assertEqual(['\x03\x00\x02\x00h\x00i'], from_client)
+        self.assertEqual([messages.tables(23)[1][0x04].emit({'time': 1000})], from_server)
+
+    def testDefaultHandlerInspectsEverything(self):
+        class A(MC3Plugin):
+            @msghdlr(0x03)
+            def hdlr(self, msg, dir): pass
+        class B(A):
+            def default_handler(self, msg, dir): return True
+        self.assertEqual(set([0x03]), A(21, None, None)._inspected_msgtypes())
+        self.assertEqual(None, B(21, None, None)._inspected_msgtypes())
+
+    def testObserversGetForwardedMessagesOnFlush(self):
+        code = MOCK_PLUGIN_CODE.replace("class MockPlugin(MC3Plugin):\n",
+                                        "class MockPlugin(MC3Plugin):\n    observer = True\n")
+        obsplugin = self._write_and_load('obsplugin', code)
+        pcfg = PluginConfig().add('obsplugin', 'p1')
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        p1 = obsplugin.instances[0]
+        # Observers are not called while filtering, so nothing is decoded for them.
+        self.assertEqual(frozenset(), self.pmgr.inspected)
+        self.assertEqual(frozenset([0x03]), self.pmgr.observed)
+
+        raw = messages.tables(21)[0][0x03].emit({'msgtype': 0x03, 'chat_msg': u'foo!'})
+        self.pmgr.observe(0x03, raw, 'client')
+        self.assertEqual(None, p1.last_msg)
+        self.pmgr.flush()
+        self.assertEqual(u'foo!', p1.last_msg['chat_msg'])
+        self.assertEqual(raw, p1.last_msg['raw_bytes'])
+
+    def testObserveOverrideGetsRawBatches(self):
+        class A(MC3Plugin):
+            observer = True
+            def init(self, args):
+                self.batches = []
+            def observe(self, batch):
+                self.batches.append(batch)
+        self.assertEqual(None, A(21, None, None)._inspected_msgtypes())
+        a = A(21, None, None)
+        a.init('')
+        pcfg = PluginConfig().add('mockplugin', 'p1')
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        getattr(self.pmgr, '_PluginManager__instances')['p1'] = a
+        self.pmgr._build_dispatch()
+        self.assertEqual(frozenset(xrange(256)), self.pmgr.observed)
+        self.pmgr.observe(0x04, 'x', 'server')
+        self.pmgr.observe(0x0a, 'y', 'client')
+        self.pmgr.flush()
+        self.pmgr.flush()
+        self.assertEqual(1, len(a.batches))
+        self.assertEqual([('server', 0x04, 'x'), ('client', 0x0a, 'y')],
+                         [m[1:] for m in a.batches[0]])
+
+class TestInjectionChannel(unittest.TestCase):
+
+    def testBatchingAndWakeup(self):
+        woken = []
+        chan = InjectionChannel(lambda: woken.append(chan.get_all()))
+        try:
+            self.assertEqual(None, chan.get_all())
+            chan.put('ab')
+            chan.put('cd')
+            asyncore.loop(timeout=1, count=1, map={chan.fileno(): chan})
+            self.assertEqual(['abcd'], woken)
+            self.assertEqual(2, chan.delivered)
+            self.assertTrue(chan.latency_max >= 0)
+        finally:
+            chan.close()
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     unittest.main()
@@ -0,0 +1,77 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, os, shutil, tempfile, asyncore
+
+from mc3p.profiling import SessionProfile
+from mc3p.proxy import ProfilingSwitch
+
+class TestSessionProfile(unittest.TestCase):
+
+    def testTimedAndReport(self):
+        prof = SessionProfile('s1')
+        hdlr = prof.timed(lambda msg, source: msg['x'], 'plugin mute', 0x03)
+        self.assertEqual(1, hdlr({'x': 1}, 'client'))
+        self.assertEqual(2, hdlr({'x': 2}, 'client'))
+        prof.add('parse client', 0x03, 0.5)
+        self.assertEqual(2, prof.stats[('plugin mute', 0x03)][0])
+        lines = prof.report().split('\n')
+        self.assertTrue(lines[0].startswith('Profile of session s1'))
+        # Most expensive scope first.
+        self.assertTrue(lines[2].startswith('parse client'))
+        self.assertTrue(lines[3].startswith('plugin mute'))
+        self.assertTrue('0x03' in lines[3])
+
+    def testUnusedScopesAreNotReported(self):
+        prof = SessionProfile('s2')
+        prof.timed(lambda msg, source: None, 'plugin p', 0x0b)
+        self.assertEqual(2, len(prof.report().strip().split('\n')))
+
+    def testWriteReport(self):
+        dir = tempfile.mkdtemp()
+        try:
+            prof = SessionProfile('s3')
+            prof.add('emit server', 0x33, 0.001)
+            path = prof.write_report(dir)
+            self.assertEqual(dir, os.path.dirname(path))
+            self.assertEqual(prof.report().split('\n')[1:], open(path).read().split('\n')[1:])
+        finally:
+            shutil.rmtree(dir)
+
+class StubListener(object):
+    def __init__(self):
+        self.toggles = 0
+
+    def toggle_profiling(self):
+        self.toggles += 1
+
+class TestProfilingSwitch(unittest.TestCase):
+
+    def testToggledByEventLoop(self):
+        listener = StubListener()
+        switch = ProfilingSwitch(listener)
+        try:
+            switch.request()
+            switch.request()
+            self.assertEqual(0, listener.toggles)
+            asyncore.loop(timeout=1.0, map={switch.fileno(): switch}, count=1)
+            self.assertEqual(2, listener.toggles)
+        finally:
+            switch.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import sys, os, os.path, unittest, tempfile, shutil, mmap, time, uuid, asyncore, socket
+
+from mc3p import workers, messages
+from mc3p.workers import RingBuffer
+from mc3p.plugins import PluginConfig, PluginManager
+
+OBSERVER_CODE = """
+from mc3p.plugins import MC3Plugin, msghdlr
+
+class LogPlugin(MC3Plugin):
+    observer = True
+
+    def init(self, args):
+        self.path = args
+        self.lines = []
+
+    @msghdlr(0x03)
+    def handle_chat(self, msg, source):
+        self.lines.append('%s %s' % (source, msg['chat_msg']))
+
+    def destroy(self):
+        with open(self.path, 'w') as f:
+            f.write('\\n'.join(self.lines))
+"""
+
+FILTER_CODE = """
+import time
+from mc3p.plugins import MC3Plugin, msghdlr
+
+class CensorPlugin(MC3Plugin):
+    def init(self, args):
+        self.delay = float(args or 0)
+
+    @msghdlr(0x03)
+    def handle_chat(self, msg, source):
+        if msg['chat_msg'].startswith('slow'):
+            time.sleep(self.delay)
+        if msg['chat_msg'] == 'drop':
+            return False
+        if msg['chat_msg'] == 'ping':
+            self.to_client({'msgtype': 0x03, 'chat_msg': 'pong'})
+        msg['chat_msg'] = msg['chat_msg'].upper()
+        return True
+"""
+
+class TestRingBuffer(unittest.TestCase):
+
+    def _ring(self, capacity):
+        return RingBuffer(mmap.mmap(-1, RingBuffer.HEADER_SIZE + capacity))
+
+    def testRecordsAreSeenOnceCommitted(self):
+        ring = self._ring(256)
+        self.assertTrue(ring.put(1.0, 0, 'abc'))
+        self.assertTrue(ring.put(2.0, workers.FROM_SERVER, 'de'))
+        self.assertEqual([], ring.get())
+        ring.commit()
+        self.assertEqual([(1.0, 0, 'abc'), (2.0, workers.FROM_SERVER, 'de')], ring.get())
+        self.assertEqual([], ring.get())
+
+    def testWrapAround(self):
+        n = RingBuffer.RECORD.size + 10
+        ring = self._ring(3 * n + 4)
+        for i in xrange(20):
+            raw = chr(ord('a') + i) * 10
+            self.assertTrue(ring.put(float(i), 0, raw))
+            ring.commit()
+            self.assertEqual([(float(i), 0, raw)], ring.get())
+
+    def testFullRingRefusesRecords(self):
+        n = RingBuffer.RECORD.size + 10
+        ring = self._ring(2 * n)
+        self.assertTrue(ring.put(0.0, 0, 'a' * 10))
+        self.assertTrue(ring.put(0.0, 0, 'b' * 10))
+        self.assertFalse(ring.put(0.0, 0, 'c' * 10))
+        self.assertFalse(ring.put(0.0, 0, 'x' * 100))
+        ring.commit()
+        self.assertEqual(2, len(ring.get()))
+        self.assertTrue(ring.put(0.0, 0, 'c' * 10))
+
+    def testWakeIdleConsumer(self):
+        ring = self._ring(256)
+        ring.put(0.0, 0, 'a')
+        self.assertTrue(ring.commit()) # The ring was empty.
+        ring.put(0.0, 0, 'b')
+        self.assertFalse(ring.commit()) # 'a' is still pending.
+        self.assertFalse(ring.wait())
+        ring.get()
+        self.assertTrue(ring.wait())
+        ring.put(0.0, 0, 'c')
+        self.assertTrue(ring.commit())
+        self.assertFalse(ring.commit()) # Nothing new.
+
+    def testWakeConsumerThatHasNotArmedItsWait(self):
+        # The consumer drained the ring, but its waiting flag is not set,
+        # or not seen yet: it must still be woken up.
+        ring = self._ring(256)
+        ring.put(0.0, 0, 'a')
+        ring.commit()
+        ring.get()
+        ring.put(0.0, 0, 'b')
+        self.assertTrue(ring.commit())
+
+
+@unittest.skipUnless(workers.supported(), "worker processes not supported")
+class TestWorkerPlugin(unittest.TestCase):
+
+    handshake_msg1 = {'msgtype':0x01, 'proto_version': 21, 'username': 'foo',
+                      'nu1': 0, 'nu2': 0, 'nu3': 0, 'nu4': 0, 'nu5': 0, 'nu6': 0}
+    handshake_msg2 = {'msgtype':0x01, 'eid': 1, 'reserved': '',
+                      'map_seed': 42, 'server_mode': 0, 'dimension': 0,
+                      'difficulty': 2, 'world_height': 128, 'max_players': 16}
+
+    @classmethod
+    def setUpClass(cls):
+        cls.pdir = tempfile.mkdtemp()
+        sys.path.append(cls.pdir)
+
+    @classmethod
+    def tearDownClass(cls):
+        sys.path.remove(cls.pdir)
+        shutil.rmtree(cls.pdir)
+
+    def setUp(self):
+        self.pmgr = None
+
+    def tearDown(self):
+        if self.pmgr:
+            self.pmgr.destroy()
+
+    def _start(self, code, argstr='', timeout=None):
+        """Run a plugin with code in a worker, and return its PluginManager."""
+        name = 'workerplugin_%s' % uuid.uuid4().hex
+        with open(os.path.join(self.pdir, name + '.py'), 'w') as f:
+            f.write(code)
+        pcfg = PluginConfig().add(name, 'p', argstr).run_in_worker('p')
+        if timeout is not None:
+            pcfg.worker_timeout = timeout
+        self.pmgr = PluginManager(pcfg, None, None)
+        self.pmgr.filter(dict(self.handshake_msg1), 'client')
+        self.pmgr.filter(dict(self.handshake_msg2), 'server')
+        self.assertEqual(set([0x03]), self.pmgr.inspected | self.pmgr.observed)
+        self.worker = getattr(self.pmgr, '_PluginManager__instances')['p']
+        self.assertTrue(self.worker.wait_until_ready())
+        return self.pmgr
+
+    def _chat(self, text):
+        return {'msgtype': 0x03, 'chat_msg': text}
+
+    def testObserverGetsMessagesInBatches(self):
+        path = os.path.join(self.pdir, 'observed.txt')
+        pmgr = self._start(OBSERVER_CODE, path)
+        self.assertEqual(frozenset(), pmgr.inspected)
+        cli_msgs, srv_msgs = messages.tables(21)
+        pmgr.observe(0x03, cli_msgs[0x03].emit(self._chat('hello')), 'client')
+        pmgr.observe(0x03, srv_msgs[0x03].emit(self._chat('world')), 'server')
+        pmgr.flush()
+        pmgr.destroy()
+        self.pmgr = None
+        with open(path) as f:
+            self.assertEqual('client hello\nserver world', f.read())
+
+    def testVetoAndChanges(self):
+        pmgr = self._start(FILTER_CODE)
+        self.assertFalse(pmgr.filter(self._chat('drop'), 'client'))
+        msg = self._chat('keep')
+        self.assertTrue(pmgr.filter(msg, 'server'))
+        self.assertEqual('KEEP', msg['chat_msg'])
+
+    def testInjectedMessages(self):
+        pmgr = self._start(FILTER_CODE)
+        self.assertTrue(pmgr.filter(self._chat('ping'), 'client'))
+        from_server = getattr(pmgr, '_PluginManager__from_server_q')
+        self.assertEqual(messages.tables(21)[1][0x03].emit(self._chat('pong')),
+                         from_server.get_all())
+
+    def testSlowWorkerFailsOpen(self):
+        pmgr = self._start(FILTER_CODE, '0.5', timeout=0.01)
+        t0 = time.time()
+        msg = self._chat('slow')
+        self.assertTrue(pmgr.filter(msg, 'client'))
+        self.assertTrue(time.time() - t0 < 0.4)
+        self.assertEqual('slow', msg['chat_msg'])
+
+    def testSlowWorkerIsSkippedUntilItCatchesUp(self):
+        pmgr = self._start(FILTER_CODE, '0.3', timeout=0.1)
+        # Frames larger than the socket's buffer are queued, not sent at once.
+        conn = getattr(self.worker, '_WorkerPlugin__conn')
+        conn.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+        msgs = [self._chat('slow' + 'x' * 30000) for i in xrange(3)]
+        t0 = time.time()
+        for msg in msgs:
+            self.assertTrue(pmgr.filter(msg, 'client'))
+        self.assertTrue(time.time() - t0 < 0.25)
+        self.assertTrue(all(msg['chat_msg'].startswith('slowx') for msg in msgs))
+        self.assertEqual((1, 2), (self.worker.timeouts, self.worker.skipped))
+        # The worker is kept, and filters messages again once it caught up.
+        deadline = time.time() + 5
+        while pmgr.filter(self._chat('drop'), 'client') and time.time() < deadline:
+            asyncore.loop(timeout=0.05, count=1)
+        self.assertFalse(pmgr.filter(self._chat('drop'), 'client'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, zlib
+
+from mc3p import blocks
+from mc3p.world import WorldCache, ChunkColumn, COLUMN_BLOCKS
+
+def column_msg(cx, cz, fill=blocks.STONE_BLOCK, extra=()):
+    """Return a whole-column Chunk message, with (x, y, z, id, meta) blocks set."""
+    col = ChunkColumn(bytearray(chr(fill) * COLUMN_BLOCKS))
+    for (x, y, z, block_type, meta) in extra:
+        col.set(y + z * 128 + x * 2048, block_type, meta)
+    data = zlib.compress(str(col.blocks) + str(col.metadata) + '\xff' * COLUMN_BLOCKS)
+    return {'msgtype': 0x33, 'x': cx * 16, 'y': 0, 'z': cz * 16,
+            'size_x': 15, 'size_y': 127, 'size_z': 15,
+            'chunk': {'size': len(data), 'data': data}}
+
+class TestWorldCache(unittest.TestCase):
+
+    def testWholeColumn(self):
+        world = WorldCache()
+        world.update(column_msg(-1, 2, extra=[(3, 70, 5, blocks.DIAMOND_ORE_BLOCK, 7)]))
+        self.assertEqual(1, len(world))
+        self.assertTrue((-1, 2) in world)
+        self.assertEqual(blocks.DIAMOND_ORE_BLOCK, world.block_at(-13, 70, 37))
+        self.assertEqual(7, world.metadata_at(-13, 70, 37))
+        self.assertEqual(blocks.STONE_BLOCK, world.block_at(-16, 0, 32))
+        self.assertEqual(0, world.metadata_at(-16, 0, 32))
+        self.assertEqual(None, world.block_at(0, 70, 37))
+        self.assertEqual(None, world.block_at(-13, 128, 37))
+
+    def testBlockChanges(self):
+        world = WorldCache()
+        world.update(column_msg(0, 0))
+        world.update({'msgtype': 0x35, 'x': 1, 'y': 127, 'z': 2,
+                      'block_type': blocks.GOLD_ORE_BLOCK, 'block_metadata': 3})
+        self.assertEqual(blocks.GOLD_ORE_BLOCK, world.block_at(1, 127, 2))
+        self.assertEqual(3, world.metadata_at(1, 127, 2))
+        # Coordinates are packed as x << 12 | z << 8 | y.
+        world.update({'msgtype': 0x34, 'chunk_x': 0, 'chunk_z': 0,
+                      'changes': {'coord_array': [-1 << 12 | 2 << 8 | 5, 1 << 8 | 6],
+                                  'type_array': [blocks.GLASS_BLOCK, blocks.SAND_BLOCK],
+                                  'metadata_array': [0, 9]}})
+        self.assertEqual(blocks.GLASS_BLOCK, world.block_at(15, 5, 2))
+        self.assertEqual(blocks.SAND_BLOCK, world.block_at(0, 6, 1))
+        self.assertEqual(9, world.metadata_at(0, 6, 1))
+        # Changes to columns that are not loaded are ignored.
+        world.update({'msgtype': 0x35, 'x': 100, 'y': 5, 'z': 2,
+                      'block_type': 1, 'block_metadata': 0})
+        self.assertEqual(1, len(world))
+
+        world.update({'msgtype': 0x32, 'x': 0, 'z': 0, 'mode': True})
+        self.assertEqual(1, len(world))
+        world.update({'msgtype': 0x32, 'x': 0, 'z': 0, 'mode': False})
+        self.assertEqual(0, len(world))
+        self.assertEqual(0, world.nbytes)
+
+    def testRespawnClears(self):
+        world = WorldCache()
+        world.update(column_msg(0, 0))
+        world.update({'msgtype': 0x09, 'world': -1, 'difficulty': 1, 'mode': 0,
+                      'world_height': 128, 'map_seed': 0})
+        self.assertEqual(0, len(world))
+
+    def testRegion(self):
+        # A 2x3x2 region straddling columns (0,0) and (1,0), starting at y=10.
+        ids = range(1, 13)
+        meta = '\x21\x43\x65\x87\xa9\xcb'
+        data = zlib.compress(''.join(chr(i) for i in ids) + meta + '\x00' * 12)
+        world = WorldCache()
+        world.update({'msgtype': 0x33, 'x': 15, 'y': 10, 'z': 4,
+                      'size_x': 1, 'size_y': 2, 'size_z': 1,
+                      'chunk': {'size': len(data), 'data': data}})
+        self.assertEqual(2, len(world))
+        # index = dy + dz*3 + dx*6
+        self.assertEqual(1, world.block_at(15, 10, 4))
+        self.assertEqual(6, world.block_at(15, 12, 5))
+        self.assertEqual(7, world.block_at(16, 10, 4))
+        self.assertEqual(12, world.block_at(16, 12, 5))
+        self.assertEqual(1, world.metadata_at(15, 10, 4))
+        self.assertEqual(12, world.metadata_at(16, 12, 5))
+        self.assertEqual(0, world.block_at(15, 13, 4))
+
+    def testLeastRecentlyUsedEviction(self):
+        column_bytes = ChunkColumn().nbytes()
+        world = WorldCache(max_bytes=2 * column_bytes)
+        world.update(column_msg(0, 0))
+        world.update(column_msg(1, 0))
+        world.block_at(0, 0, 0)
+        world.update(column_msg(2, 0))
+        self.assertEqual(1, world.evictions)
+        self.assertEqual(2 * column_bytes, world.nbytes)
+        self.assertTrue((0, 0) in world)
+        self.assertFalse((1, 0) in world)
+        self.assertTrue((2, 0) in world)
+        world.column(0, 0)
+        world.update(column_msg(3, 0))
+        self.assertEqual([(0, 0), (3, 0)], world.columns.keys())
+        self.assertEqual(2, world.evictions)
+
+if __name__ == '__main__':
+    unittest.main()